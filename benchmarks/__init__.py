@@ -0,0 +1,10 @@
+"""Micro-benchmarks for the hot paths of the site. Run them from the repository root
+with ``python -m benchmarks.<module>``; each module documents its own options."""
+import os
+
+import django
+
+
+def setup_django():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+    django.setup()
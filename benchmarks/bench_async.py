@@ -0,0 +1,250 @@
+"""Requests per second one process serves when S3 is slow: the direct-upload finalize
+view (one ranged GET to S3 per request) served by a sync WSGI worker, and under ASGI
+by the sync and the async (ASYNC_VIEWS) views.
+
+    python -m benchmarks.bench_async [--requests N] [--concurrency N [N ...]]
+                                     [--latency SECONDS]
+
+Every S3 call is delayed by --latency to stand in for a real bucket (moto answers in
+well under a millisecond). A sync gunicorn worker serves one request at a time, so the
+WSGI run sends them one after another; the ASGI runs keep --concurrency requests in
+flight. Both go through Django's own WSGI/ASGI handlers and the configured middleware,
+except that the async runs use mysite.middleware.AccountMiddleware in place of
+allauth's sync-only one, as mysite/asgi.py says to. Any middleware still sync-only is
+listed first, since it puts the ASGI runs back on a thread per request. The peak
+thread count shows what each mode spends on concurrency. As in
+benchmarks.bench_lifecycle the run uses a throwaway test database (kept in a file, so
+concurrent requests get a connection each) and S3 is replaced by moto.
+"""
+import argparse
+import asyncio
+import importlib
+import io
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from moto import mock_aws
+
+from benchmarks import setup_django
+
+PDF = b'%PDF-1.4\nBenchmark evidence\n'
+CSRF_SECRET = 'b' * 32
+ASYNC_MIDDLEWARE = {'allauth.account.middleware.AccountMiddleware': 'mysite.middleware.AccountMiddleware'}
+
+
+def route(async_views):
+    from django.conf import settings
+    from django.urls import clear_url_caches
+
+    settings.ASYNC_VIEWS = async_views
+    for module in ('login.urls', 's3.urls', 'mysite.urls'):
+        importlib.reload(importlib.import_module(module))
+    clear_url_caches()
+
+
+def slow_s3(latency):
+    from mysite.storage_backends import PublicMediaStorage
+
+    read_head = PublicMediaStorage.read_head
+
+    def delayed_read_head(self, name, length):
+        time.sleep(latency)
+        return read_head(self, name, length)
+
+    PublicMediaStorage.read_head = delayed_read_head
+
+
+def prepare(storage, count):
+    """Store `count` objects and return a session key allowed to finalize each one."""
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.core.files.base import ContentFile
+    from s3.views import DIRECT_UPLOAD_SESSION_KEY
+
+    sessions = []
+    for i in range(count):
+        name = 'direct/bench%d/file.pdf' % i
+        storage.save(name, ContentFile(PDF))
+        session = SessionStore()
+        session[DIRECT_UPLOAD_SESSION_KEY] = [name]
+        session.create()
+        sessions.append((session.session_key, name))
+    return sessions
+
+
+class PeakThreads:
+    def __init__(self):
+        self.peak = threading.active_count()
+        self.running = True
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        while self.running:
+            self.peak = max(self.peak, threading.active_count())
+            time.sleep(0.001)
+
+    def stop(self):
+        self.running = False
+        self.sampler.join()
+        return self.peak
+
+
+def request_body(name):
+    return urlencode({'name': name, 'title': 'Benchmark report', 'user_comment': 'Details', 'priority': 3}).encode()
+
+
+def cookie(session_key):
+    from django.conf import settings
+
+    return '%s=%s; %s=%s' % (settings.SESSION_COOKIE_NAME, session_key, settings.CSRF_COOKIE_NAME, CSRF_SECRET)
+
+
+def run_wsgi(sessions):
+    from django.core.handlers.wsgi import WSGIHandler
+    from django.urls import reverse
+
+    handler = WSGIHandler()
+    path = reverse('s3:finalize_upload')
+    threads = PeakThreads()
+    start = time.perf_counter()
+    for session_key, name in sessions:
+        body = request_body(name)
+        environ = {
+            'REQUEST_METHOD': 'POST', 'PATH_INFO': path, 'SCRIPT_NAME': '', 'QUERY_STRING': '',
+            'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'testserver', 'HTTP_COOKIE': cookie(session_key), 'HTTP_X_CSRFTOKEN': CSRF_SECRET,
+            'CONTENT_TYPE': 'application/x-www-form-urlencoded', 'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': io.BytesIO(body), 'wsgi.errors': io.StringIO(), 'wsgi.url_scheme': 'http',
+        }
+        statuses = []
+        response = handler(environ, lambda status, headers: statuses.append(status))
+        b''.join(response)
+        response.close()
+        if not statuses[0].startswith('200'):
+            raise RuntimeError('finalize returned %s' % statuses[0])
+    return time.perf_counter() - start, threads.stop()
+
+
+def run_asgi(sessions, concurrency):
+    from django.core.handlers.asgi import ASGIHandler
+    from django.urls import reverse
+
+    handler = ASGIHandler()
+    path = reverse('s3:finalize_upload')
+
+    async def finalize(limit, session_key, name):
+        body = request_body(name)
+        scope = {
+            'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+            'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'', 'root_path': '',
+            'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+            'headers': [
+                (b'host', b'testserver'), (b'cookie', cookie(session_key).encode()),
+                (b'x-csrftoken', CSRF_SECRET.encode()),
+                (b'content-type', b'application/x-www-form-urlencoded'),
+                (b'content-length', str(len(body)).encode()),
+            ],
+        }
+        messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+        statuses = []
+
+        async def receive():
+            if messages:
+                return messages.pop()
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                statuses.append(message['status'])
+
+        async with limit:
+            await handler(scope, receive, send)
+        if statuses != [200]:
+            raise RuntimeError('finalize returned %s' % statuses)
+
+    async def send_all():
+        limit = asyncio.Semaphore(concurrency)
+        await asyncio.gather(*(finalize(limit, session_key, name) for session_key, name in sessions))
+
+    threads = PeakThreads()
+    start = time.perf_counter()
+    asyncio.run(send_all())
+    return time.perf_counter() - start, threads.stop()
+
+
+def async_middleware():
+    from django.conf import settings
+
+    return [ASYNC_MIDDLEWARE.get(path, path) for path in settings.MIDDLEWARE]
+
+
+def sync_only_middleware(middleware):
+    from django.utils.module_loading import import_string
+
+    return [path for path in middleware if not getattr(import_string(path), 'async_capable', False)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=200, help='Requests per run.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64],
+                        help='Requests in flight for the ASGI runs.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds added to every S3 call.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    if connection.vendor == 'sqlite':
+        test_name = os.path.join(tempfile.mkdtemp(), 'bench_async.sqlite3')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = test_name
+        connection.settings_dict.setdefault('OPTIONS', {})['timeout'] = 60
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+    storages = {
+        'default': {'BACKEND': 'mysite.storage_backends.PublicMediaStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    }
+    try:
+        with mock_aws(), override_settings(STORAGES=storages, AWS_STORAGE_BUCKET_NAME='bench'):
+            import boto3
+            from s3.models import Upload
+
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='bench')
+            storage = Upload._meta.get_field('file').storage
+            slow_s3(args.latency)
+            runs = [('wsgi, sync views', None, False)]
+            for concurrency in args.concurrency:
+                runs.append(('asgi, sync views', concurrency, False))
+                runs.append(('asgi, async views', concurrency, True))
+            print('%d requests per run, %.0f ms per S3 call' % (args.requests, args.latency * 1e3))
+            for label, middleware in (('sync', settings.MIDDLEWARE), ('async', async_middleware())):
+                for path in sync_only_middleware(middleware):
+                    print('sync-only middleware in the %s runs: %s' % (label, path))
+            for label, concurrency, async_views in runs:
+                route(async_views)
+                sessions = prepare(storage, args.requests)
+                if concurrency is None:
+                    elapsed, peak = run_wsgi(sessions)
+                else:
+                    with override_settings(MIDDLEWARE=async_middleware() if async_views else settings.MIDDLEWARE):
+                        elapsed, peak = run_asgi(sessions, concurrency)
+                print('%-18s concurrency %-3s %8.1f req/s  %7.2f ms/request  peak threads %d'
+                      % (label, concurrency or 1, args.requests / elapsed, elapsed / args.requests * 1e3, peak))
+    finally:
+        route(False)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
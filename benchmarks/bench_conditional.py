@@ -0,0 +1,78 @@
+"""Bytes sent and server CPU time per request for the staff queue, a reporter's queue
+and a report's detail page: a plain render, a gzipped render, and a revalidation of an
+unchanged page that ends in a 304 (login.conditional).
+
+    python -m benchmarks.bench_conditional [--uploads N] [--requests N]
+
+Reports are seeded into a throwaway test database, like benchmarks.bench_search, and
+the pages are fetched through Django's test client with the configured middleware.
+CPU time is the process time of the whole request, database included.
+"""
+import argparse
+import time
+
+from benchmarks import setup_django
+
+COMMENT = 'The expense claims for the northern warehouse were approved without receipts. '
+
+
+def measure(client, url, requests, **headers):
+    """Return (bytes per response, CPU ms per request, status) for `requests` GETs."""
+    size = 0
+    start = time.process_time()
+    for _ in range(requests):
+        response = client.get(url, **headers)
+        size += len(response.content)
+    return size / requests, (time.process_time() - start) / requests * 1e3, response.status_code
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--uploads', type=int, default=1000, help='Reports to seed.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per page and mode.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from django.urls import reverse
+    from s3.models import Upload
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        reporter = User.objects.create_user(username='reporter', first_name='Rae')
+        staff = User.objects.create_user(username='staff', first_name='Sam', is_staff=True)
+        Upload.objects.bulk_create([
+            Upload(user=reporter, title='Report %d' % i, user_comment=COMMENT * 3, priority=i % 5 + 1)
+            for i in range(args.uploads)
+        ])
+        report = Upload.objects.filter(user=reporter).latest('id')
+        pages = [
+            ('staff queue', staff, reverse('login:staffpage')),
+            ('reporter queue', reporter, reverse('login:mainpage')),
+            ('report detail', staff, reverse('login:upload_detail', args=[report.pk])),
+        ]
+        print('%d reports, %d requests per row' % (args.uploads, args.requests))
+        for label, user, url in pages:
+            client = Client()
+            client.force_login(user)
+            etag = client.get(url)['ETag']
+            plain_size = plain_cpu = None
+            for mode, headers in (('plain', {}), ('gzip', {'HTTP_ACCEPT_ENCODING': 'gzip'}),
+                                  ('304', {'HTTP_IF_NONE_MATCH': etag})):
+                size, cpu, status = measure(client, url, args.requests, **headers)
+                if plain_size is None:
+                    plain_size, plain_cpu = size, cpu
+                print('%-15s %-6s %d  %9.0f bytes (%5.1f%%)  %7.2f ms CPU (%5.1f%%)'
+                      % (label, mode, status, size, size / plain_size * 100, cpu, cpu / plain_cpu * 100))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Query time and peak memory of one queue page when the reports have large comments:
+reading whole rows (as before the excerpt columns) against reading only the columns a
+card shows (Upload.CARD_FIELDS, with the stored comment excerpts).
+
+    python -m benchmarks.bench_excerpts [--uploads N] [--comment KIB] [--pages N]
+
+Reports are seeded into a throwaway test database, like benchmarks.bench_conditional,
+each with a user and an admin comment of --comment KiB. A page is the first
+QUEUE_PAGE_SIZE reports in "priority" order, fetched through login.pagination as the
+queue views do; peak memory is what tracemalloc saw allocated while it was read.
+"""
+import argparse
+import time
+import tracemalloc
+
+from benchmarks import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--uploads', type=int, default=2000, help='Reports to seed.')
+    parser.add_argument('--comment', type=int, default=16, help='KiB of each comment.')
+    parser.add_argument('--pages', type=int, default=200, help='Pages read per projection.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from login.pagination import page_size, paginate
+    from login.views import QUEUE_ORDERINGS
+    from s3.models import Upload
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        comment = 'Details of the report. ' * (args.comment * 1024 // 23)
+        Upload.objects.bulk_create([
+            Upload(title='Report %d' % i, user_comment=comment, admin_comment=comment, priority=i % 5 + 1)
+            for i in range(args.uploads)
+        ], batch_size=500)
+        ordering = QUEUE_ORDERINGS['priority']
+        projections = [
+            ('whole rows', Upload.objects.defer('extracted_text')),
+            ('card fields', Upload.objects.only(*Upload.CARD_FIELDS)),
+        ]
+        print('%d reports with %d KiB comments, %d reports per page'
+              % (args.uploads, args.comment, page_size()))
+        for label, queryset in projections:
+            start = time.perf_counter()
+            for _ in range(args.pages):
+                paginate(queryset, ordering, key='priority')
+            elapsed = (time.perf_counter() - start) / args.pages
+            tracemalloc.start()
+            page = paginate(queryset, ordering, key='priority')
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del page
+            print('%-12s %7.2f ms per page  peak memory %8.1f KiB' % (label, elapsed * 1e3, peak / 1024))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Time to first byte, total time and peak memory of a report export (s3.export) when
+S3 is slow, fetching one file at a time and several ahead.
+
+    python -m benchmarks.bench_export [--reports N] [--size KIB] [--latency SECONDS]
+                                      [--prefetch N [N ...]]
+
+Every download is delayed by --latency to stand in for a real bucket, as in
+benchmarks.bench_async; S3 is replaced by moto and the reports live in a throwaway test
+database. Peak memory is what tracemalloc saw allocated during the export, moto's
+copies of the objects included.
+"""
+import argparse
+import os
+import time
+import tracemalloc
+
+from moto import mock_aws
+
+from benchmarks import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--reports', type=int, default=50, help='Reports in the export.')
+    parser.add_argument('--size', type=int, default=512, help='KiB per report file.')
+    parser.add_argument('--latency', type=float, default=0.2, help='Seconds added to every download.')
+    parser.add_argument('--prefetch', type=int, nargs='+', default=[1, 4, 8], help='Files fetched ahead.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+    from mysite.storage_backends import PublicMediaStorage
+    from s3 import export
+    from s3.models import Upload
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    storages = {
+        'default': {'BACKEND': 'mysite.storage_backends.PublicMediaStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    }
+    try:
+        with mock_aws(), override_settings(STORAGES=storages, AWS_STORAGE_BUCKET_NAME='bench'):
+            import boto3
+
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='bench')
+            storage = Upload._meta.get_field('file').storage
+            for i in range(args.reports):
+                content = b'%PDF-1.4\n' + os.urandom(args.size * 1024)
+                Upload.objects.create(title='Report %d' % i, file=SimpleUploadedFile('report%d.pdf' % i, content))
+            uploads = list(Upload.objects.order_by('id'))
+
+            download = PublicMediaStorage.download
+
+            def slow_download(self, name, fileobj):
+                time.sleep(args.latency)
+                return download(self, name, fileobj)
+
+            # Warm up: the S3 threads create their boto3 clients on first use.
+            with override_settings(EXPORT_PREFETCH=max(args.prefetch)):
+                for chunk in export.stream(storage, uploads[:max(args.prefetch)]):
+                    pass
+            PublicMediaStorage.download = slow_download
+            print('%d reports of %d KiB, %.0f ms per download' % (args.reports, args.size, args.latency * 1e3))
+            for prefetch in args.prefetch:
+                with override_settings(EXPORT_PREFETCH=prefetch):
+                    tracemalloc.start()
+                    start = time.perf_counter()
+                    chunks = export.stream(storage, uploads)
+                    size = len(next(chunks))
+                    first_byte = time.perf_counter() - start
+                    for chunk in chunks:
+                        size += len(chunk)
+                    elapsed = time.perf_counter() - start
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                print('prefetch %-2d first byte %7.1f ms  total %6.2fs  %6.1f MiB/s  peak memory %6.1f MiB'
+                      % (prefetch, first_byte * 1e3, elapsed, size / elapsed / 2 ** 20, peak / 2 ** 20))
+            PublicMediaStorage.download = download
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
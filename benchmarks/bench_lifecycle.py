@@ -0,0 +1,217 @@
+"""Throughput and latency of the report lifecycle at a configurable data volume: submit,
+the staff and reporter queues under every sort_by, the detail page, resolve, priority
+change and delete.
+
+    python -m benchmarks.bench_lifecycle [--uploads N] [--users N] [--requests N]
+                                         [--output results.json]
+                                         [--baseline old.json [--tolerance 0.2]]
+
+The run uses a throwaway test database (as the test runner would create it) seeded
+with --uploads reports, and S3 is replaced by moto, so neither the configured database
+nor the bucket is touched. The queue caches are cleared before every queue request
+unless --warm-cache is given, so the listings measure the database.
+
+Results are written as JSON. With --baseline, each operation's p50 and p99 are compared
+with a previous run's and the command exits with status 1 if any of them got slower by
+more than --tolerance (a fraction).
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from moto import mock_aws
+
+from benchmarks import setup_django
+
+SEED_BATCH_SIZE = 10000
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(int(round(percent / 100 * (len(values) - 1))), len(values) - 1)]
+
+
+def summarise(latencies):
+    total = sum(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput_per_s': round(len(latencies) / total, 2) if total else None,
+        'mean_ms': round(statistics.mean(latencies) * 1e3, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1e3, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1e3, 3),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print the change against a baseline run; return the operations that regressed."""
+    regressions = []
+    for operation, result in results.items():
+        previous = baseline.get('results', {}).get(operation)
+        if previous is None:
+            continue
+        for metric in ('p50_ms', 'p99_ms'):
+            change = result[metric] / previous[metric] - 1 if previous[metric] else 0
+            flag = ''
+            if change > tolerance:
+                regressions.append('%s %s' % (operation, metric))
+                flag = '  REGRESSION'
+            print('%-32s %-7s %10.2f -> %10.2f ms (%+.0f%%)%s'
+                  % (operation, metric, previous[metric], result[metric], change * 100, flag))
+    return regressions
+
+
+def seed(users, uploads, rng):
+    from django.contrib.auth.models import User
+    from s3.models import Upload
+
+    User.objects.bulk_create(
+        [User(username='reporter%d' % i, password='!') for i in range(users)], batch_size=SEED_BATCH_SIZE
+    )
+    user_ids = list(User.objects.values_list('id', flat=True))
+    statuses = [status for status, _ in Upload.STATUS_CHOICES]
+    for start in range(0, uploads, SEED_BATCH_SIZE):
+        batch = []
+        for i in range(start, min(start + SEED_BATCH_SIZE, uploads)):
+            status = rng.choice(statuses)
+            batch.append(Upload(
+                user_id=rng.choice(user_ids), title='Report %d' % i, user_comment='Seeded report %d' % i,
+                file='bench/report-%d.txt' % i, status=status,
+                priority=rng.randint(1, 5),
+            ))
+        Upload.objects.bulk_create(batch)
+
+
+def run(args, rng):
+    from django.contrib.auth.models import User
+    from django.core.cache import caches
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from django.urls import reverse
+    from login.views import QUEUE_ORDERINGS
+    from s3.models import Upload
+
+    staff = User.objects.create_user(username='bench-staff', is_staff=True)
+    reporter = User.objects.create_user(username='bench-reporter')
+    staff_client, reporter_client = Client(), Client()
+    staff_client.force_login(staff)
+    reporter_client.force_login(reporter)
+    Upload.objects.bulk_create([
+        Upload(user=reporter, title='Own report %d' % i, file='bench/own-%d.txt' % i)
+        for i in range(args.requests)
+    ])
+    own_ids = list(Upload.objects.filter(user=reporter).values_list('id', flat=True))
+    upload_ids = list(Upload.objects.exclude(user=reporter).values_list('id', flat=True))
+
+    def clear_caches():
+        if not args.warm_cache:
+            for cache in caches.all():
+                cache.clear()
+
+    def submit(i):
+        report = SimpleUploadedFile('report.txt', b'Something happened on the site.\n' * 64, 'text/plain')
+        return reporter_client.post(reverse('s3:submission_page'), {
+            'title': 'Benchmark report %d' % i, 'user_comment': 'Details', 'priority': 3, 'file': report,
+        }), 302
+
+    def queue(client, url_name, sort_by):
+        def request(i):
+            clear_caches()
+            return client.get(reverse(url_name), {'sort_by': sort_by}), 200
+        return request
+
+    def detail(i):
+        return staff_client.get(reverse('login:upload_detail', args=[rng.choice(upload_ids)])), 200
+
+    def resolve(i):
+        url = reverse('login:admin_resolve', args=[rng.choice(upload_ids)])
+        return staff_client.post(url, {'comment': 'Handled'}), 302
+
+    def priority(i):
+        url = reverse('login:change_priority', args=[rng.choice(upload_ids)])
+        return staff_client.post(url, {'priority': rng.randint(1, 5)}), 200
+
+    def delete(i):
+        return reporter_client.post(reverse('login:delete', args=[own_ids[i]])), 302
+
+    operations = [('submit', submit)]
+    for sort_by in QUEUE_ORDERINGS:
+        operations.append(('queue_staff_%s' % sort_by, queue(staff_client, 'login:staffpage', sort_by)))
+        operations.append(('queue_reporter_%s' % sort_by, queue(reporter_client, 'login:mainpage', sort_by)))
+    operations += [('detail', detail), ('resolve', resolve), ('priority', priority), ('delete', delete)]
+
+    results = {}
+    for name, operation in operations:
+        latencies = []
+        for i in range(args.requests):
+            start = time.perf_counter()
+            response, expected_status = operation(i)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != expected_status:
+                raise RuntimeError('%s returned %s, expected %s' % (name, response.status_code, expected_status))
+        results[name] = summarise(latencies)
+        print('%-32s %8.1f req/s  p50 %8.2f ms  p99 %8.2f ms'
+              % (name, results[name]['throughput_per_s'], results[name]['p50_ms'], results[name]['p99_ms']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--uploads', type=int, default=10000, help='Reports to seed.')
+    parser.add_argument('--users', type=int, default=100, help='Reporters to spread them over.')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per operation.')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the data and the requests.')
+    parser.add_argument('--warm-cache', action='store_true', help='Keep the queue caches between requests.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against the baseline, as a fraction.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+
+    rng = random.Random(args.seed)
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    storages = {
+        'default': {'BACKEND': 'mysite.storage_backends.PublicMediaStorage'},
+        'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    }
+    try:
+        with mock_aws(), override_settings(STORAGES=storages, AWS_STORAGE_BUCKET_NAME='bench'):
+            import boto3
+            boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='bench')
+            start = time.perf_counter()
+            seed(args.users, args.uploads, rng)
+            print('Seeded %d reports for %d users in %.1fs' % (args.uploads, args.users, time.perf_counter() - start))
+            results = run(args, rng)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    report = {
+        'config': {
+            'uploads': args.uploads, 'users': args.users, 'requests': args.requests, 'seed': args.seed,
+            'warm_cache': args.warm_cache, 'database': connection.vendor, 'python': platform.python_version(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        if regressions:
+            print('Regressed: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
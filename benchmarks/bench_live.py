@@ -0,0 +1,132 @@
+"""Idle cost and fan-out latency of the staff queue's live updates (login.live) under
+ASGI: hundreds of open event streams in one process, then a new report.
+
+    python -m benchmarks.bench_live [--streams N] [--idle SECONDS]
+
+The streams go through Django's ASGIHandler and the configured middleware, with the
+async views routed as under settings.ASYNC_VIEWS, against a throwaway test database
+kept in a file (like benchmarks.bench_async). The report is created from another
+thread, as by a request served elsewhere; the time is until every stream has sent it.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+from benchmarks import setup_django
+from benchmarks.bench_async import route
+
+
+def rss():
+    # Peak resident set size in KiB (Linux).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--streams', type=int, default=500, help='Event streams held open.')
+    parser.add_argument('--idle', type=float, default=5.0, help='Seconds the streams are left idle.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.handlers.asgi import ASGIHandler
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from django.urls import reverse
+    from s3 import events
+    from s3.models import Upload
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    if connection.vendor == 'sqlite':
+        test_name = os.path.join(tempfile.mkdtemp(), 'bench_live.sqlite3')
+        connection.settings_dict.setdefault('TEST', {})['NAME'] = test_name
+        connection.settings_dict.setdefault('OPTIONS', {})['timeout'] = 60
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    polls = []
+    since = events.since
+
+    def counted_since(*args):
+        polls.append(time.perf_counter())
+        return since(*args)
+
+    events.since = counted_since
+    try:
+        route(True)
+        client = Client()
+        client.force_login(User.objects.create_user(username='staff', is_staff=True))
+        cookie = '%s=%s' % (settings.SESSION_COOKIE_NAME, client.cookies[settings.SESSION_COOKIE_NAME].value)
+        path = reverse('login:upload_events')
+        query = urlencode({'since': events.latest_id()}).encode()
+        handler = ASGIHandler()
+
+        async def run():
+            opened = asyncio.Semaphore(0)
+            received = []
+
+            async def listen():
+                scope = {
+                    'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                    'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query,
+                    'root_path': '', 'client': ('127.0.0.1', 0), 'server': ('testserver', 80),
+                    'headers': [(b'host', b'testserver'), (b'cookie', cookie.encode())],
+                }
+                request_sent = False
+
+                async def receive():
+                    nonlocal request_sent
+                    if not request_sent:
+                        request_sent = True
+                        return {'type': 'http.request', 'body': b'', 'more_body': False}
+                    await asyncio.Event().wait()
+
+                async def send(message):
+                    body = message.get('body', b'')
+                    if body.startswith(b'retry:'):
+                        opened.release()
+                    elif b'event: upload' in body:
+                        received.append(time.perf_counter())
+                        raise asyncio.CancelledError
+
+                try:
+                    await handler(scope, receive, send)
+                except asyncio.CancelledError:
+                    pass
+
+            baseline = rss()
+            tasks = [asyncio.create_task(listen()) for _ in range(args.streams)]
+            start = time.perf_counter()
+            for _ in range(args.streams):
+                await opened.acquire()
+            print('%d streams open in %.2fs' % (args.streams, time.perf_counter() - start))
+            polls.clear()
+            await asyncio.sleep(args.idle)
+            print('idle %.0fs: %d feed queries, %d threads, %.0f KiB more peak RSS per stream'
+                  % (args.idle, len(polls), threading.active_count(), (rss() - baseline) / args.streams))
+
+            writer = threading.Thread(target=lambda: Upload.objects.create(title='Live'))
+            created = time.perf_counter()
+            writer.start()
+            await asyncio.gather(*tasks)
+            writer.join()
+            received.sort()
+            print('new report reached %d streams: first after %.0f ms, last after %.0f ms'
+                  % (len(received), (received[0] - created) * 1e3, (received[-1] - created) * 1e3))
+
+        asyncio.run(run())
+    finally:
+        events.since = since
+        route(False)
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
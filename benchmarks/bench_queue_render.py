@@ -0,0 +1,65 @@
+"""Render time of a large staff queue, with the queue cards rendered from scratch and
+served from the template fragment cache.
+
+    python -m benchmarks.bench_queue_render [--cards N] [--renders N]
+
+The cards are unsaved Upload objects, so no database is needed; the fragment cache is
+a private local-memory cache.
+"""
+import argparse
+import time
+
+from benchmarks import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cards', type=int, default=10000, help='Reports on the page.')
+    parser.add_argument('--renders', type=int, default=5, help='Page renders to average over.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.contrib.auth.models import User
+    from django.core.cache import caches
+    from django.template.loader import render_to_string
+    from django.test import RequestFactory, override_settings
+    from login.pagination import KeysetPage
+    from s3.models import Upload
+
+    statuses = [status for status, _ in Upload.STATUS_CHOICES]
+    uploads = [
+        Upload(
+            id=i, title='Report %d' % i, user_comment='Comment on report %d' % i,
+            status=statuses[i % len(statuses)], priority=i % 5 + 1,
+        )
+        for i in range(1, args.cards + 1)
+    ]
+    request = RequestFactory().get('/staffpage')
+    request.user = User(username='staff', is_staff=True)
+    request.session = {}
+    context = {
+        'all_uploaded_files': uploads,
+        'page': KeysetPage(uploads, None, None),
+        'sort_by': 'most_recent',
+        'card_cache_timeout': 600,
+    }
+
+    caches_setting = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                  'LOCATION': 'bench-queue-render', 'OPTIONS': {'MAX_ENTRIES': args.cards * 2}}}
+    with override_settings(CACHES=caches_setting):
+        cache = caches['default']
+        for label, warm in (('cold', False), ('cached', True)):
+            cache.clear()
+            if warm:
+                render_to_string('login/site-staff.html', context, request)
+            start = time.perf_counter()
+            for _ in range(args.renders):
+                if not warm:
+                    cache.clear()
+                render_to_string('login/site-staff.html', context, request)
+            elapsed = (time.perf_counter() - start) / args.renders
+            print('%-8s %8.1fms/page' % (label, elapsed * 1e3))
+
+
+if __name__ == '__main__':
+    main()
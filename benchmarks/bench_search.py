@@ -0,0 +1,69 @@
+"""Latency of the staff full-text search (s3.search) on a large report corpus.
+
+    python -m benchmarks.bench_search [--uploads N] [--queries N]
+
+Reports are seeded into a throwaway test database, like benchmarks.bench_lifecycle;
+the search index is filled by the database as rows are inserted.
+"""
+import argparse
+import random
+import statistics
+import time
+
+from benchmarks import setup_django
+
+SEED_BATCH_SIZE = 10000
+WORDS = ('invoice', 'payment', 'harassment', 'safety', 'contract', 'overtime', 'expense', 'supplier',
+         'manager', 'shredded', 'audit', 'bribe', 'warehouse', 'timesheet', 'discrimination', 'leak')
+VOCABULARY = 50000
+QUERIES = ('invoice', 'shredded audit', 'overtime timesheet manager', 'bri', 'discrimination leak safety')
+
+
+def sentence(rng, length):
+    # Mostly filler from a large vocabulary, so each query word is in a few percent of
+    # the reports, as in a real corpus, rather than in all of them.
+    return ' '.join(rng.choice(WORDS) if rng.random() < 0.01 else 'term%d' % rng.randrange(VOCABULARY)
+                    for _ in range(length))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--uploads', type=int, default=100000, help='Reports to seed.')
+    parser.add_argument('--queries', type=int, default=20, help='Runs of each query.')
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+    from s3 import search
+    from s3.models import Upload
+
+    rng = random.Random(0)
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        start = time.perf_counter()
+        for batch_start in range(0, args.uploads, SEED_BATCH_SIZE):
+            Upload.objects.bulk_create([
+                Upload(title=sentence(rng, 3), user_comment=sentence(rng, 12), extracted_text=sentence(rng, 60),
+                       file='bench/report-%d.txt' % i)
+                for i in range(batch_start, min(batch_start + SEED_BATCH_SIZE, args.uploads))
+            ])
+        print('Seeded and indexed %d reports in %.1fs (%s)'
+              % (args.uploads, time.perf_counter() - start, connection.vendor))
+        for query in QUERIES:
+            for label, offset in (('first page', 0), ('page 5', 100)):
+                latencies = []
+                for _ in range(args.queries):
+                    started = time.perf_counter()
+                    search.search(query, offset=offset, limit=25)
+                    latencies.append(time.perf_counter() - started)
+                print('%-30s %-10s median %8.2f ms' % (query, label, statistics.median(latencies) * 1e3))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+
+if __name__ == '__main__':
+    main()
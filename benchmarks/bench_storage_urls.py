@@ -0,0 +1,47 @@
+"""URL generation cost of one queue page, before and after PublicMediaStorage's URL cache.
+
+    python -m benchmarks.bench_storage_urls [--cards N] [--pages N]
+
+S3 is replaced by moto, so only the local signing and client work is measured.
+"""
+import argparse
+import time
+
+from moto import mock_aws
+
+from benchmarks import setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cards', type=int, default=300, help='File links per page.')
+    parser.add_argument('--pages', type=int, default=20, help='Page renders to average over.')
+    args = parser.parse_args()
+
+    setup_django()
+    from storages.backends.s3boto3 import S3Boto3Storage
+    from mysite.storage_backends import PublicMediaStorage
+
+    names = ['previews/%d/preview.jpg' % i for i in range(args.cards)]
+    with mock_aws():
+        storage = PublicMediaStorage(bucket_name='spotz')
+
+        def uncached_page():
+            for name in names:
+                S3Boto3Storage.url(storage, name)
+
+        def cached_page():
+            storage.urls(names)
+            for name in names:
+                storage.url(name)
+
+        for label, render_page in (('uncached', uncached_page), ('cached', cached_page)):
+            start = time.perf_counter()
+            for _ in range(args.pages):
+                render_page()
+            elapsed = (time.perf_counter() - start) / args.pages
+            print('%-9s %8.2f ms/page  %6.1f us/link' % (label, elapsed * 1e3, elapsed / args.cards * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+import json
+from functools import wraps
+
+from django.db.models import Count
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET, require_POST
+
+from s3.models import Upload
+from . import conditional
+from .pagination import page_size, paginate
+from .views import QUEUE_ORDERINGS, can_view_upload, parse_priority, queue_filter, resolve_upload, set_priority
+
+# JSON API over the report queue for staff tooling, authenticated by the same allauth
+# session (and CSRF token, for the writes) as the pages. Reporters can list and read
+# their own reports; staff can read every report and resolve or re-prioritise it.
+#
+#   GET  api/reports?sort_by=&cursor=&limit=&fields=   a page of the queue
+#   GET  api/reports/<id>?fields=                      one report
+#   POST api/reports/<id>/resolve    comment=          resolve it
+#   POST api/reports/<id>/priority   priority=         change its priority
+#
+# Lists use the queue's keyset cursors (login.pagination) and load only the columns of
+# the fields asked for, so the comment text is not read unless requested (lists have
+# the stored excerpts of the comments instead). A page costs
+# the same few queries however many reports it has: file URLs are signed in one batch
+# and duplicate counts come from one GROUP BY over the page's hashes.
+
+MAX_LIMIT = 100
+
+# Columns each field is read from.
+FIELDS = {
+    'id': ['id'],
+    'title': ['title'],
+    'status': ['status'],
+    'priority': ['priority'],
+    'processing_status': ['processing_status'],
+    'created_at': ['created_at'],
+    'version': ['version'],
+    'sha256': ['sha256'],
+    'user_comment': ['user_comment'],
+    'admin_comment': ['admin_comment'],
+    'user_comment_excerpt': ['user_comment_excerpt'],
+    'admin_comment_excerpt': ['admin_comment_excerpt'],
+    'file_url': ['file'],
+    'preview_url': ['preview'],
+    'duplicates': ['sha256'],
+}
+# Left out of lists unless asked for.
+LARGE_FIELDS = ('user_comment', 'admin_comment')
+# Other reports with the same file are only shown to staff, as on the detail page.
+STAFF_FIELDS = ('duplicates',)
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+def authenticated(view):
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return error('Log in to use the API.', status=403)
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def available_fields(user):
+    return [field for field in FIELDS if user.is_staff or field not in STAFF_FIELDS]
+
+
+def requested_fields(request, default):
+    """The fields named in ?fields=, or `default`; None if one is unknown."""
+    value = request.GET.get('fields')
+    if not value:
+        return default
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    available = available_fields(request.user)
+    if not fields or any(field not in available for field in fields):
+        return None
+    return list(dict.fromkeys(fields))
+
+
+def columns(fields, *extra):
+    # user is always read for the permission checks.
+    return {'user'}.union(*(FIELDS[field] for field in fields), extra)
+
+
+def file_urls(field_name, names):
+    storage = Upload._meta.get_field(field_name).storage
+    names = [name for name in set(names) if name]
+    if hasattr(storage, 'urls'):
+        return storage.urls(names)
+    return {name: storage.url(name) for name in names}
+
+
+def duplicate_counts(uploads):
+    hashes = {upload.sha256 for upload in uploads if upload.sha256}
+    if not hashes:
+        return {}
+    counts = Upload.objects.filter(sha256__in=hashes).order_by().values('sha256').annotate(count=Count('id'))
+    return {row['sha256']: row['count'] - 1 for row in counts}
+
+
+def serialize(uploads, fields):
+    """The JSON objects for `uploads`, with `fields`, in as few queries as possible."""
+    file_url = file_urls('file', [upload.file.name for upload in uploads]) if 'file_url' in fields else {}
+    preview_url = {}
+    if 'preview_url' in fields:
+        preview_url = file_urls('preview', [upload.preview.name for upload in uploads])
+    duplicates = duplicate_counts(uploads) if 'duplicates' in fields else {}
+    results = []
+    for upload in uploads:
+        item = {}
+        for field in fields:
+            if field == 'created_at':
+                item[field] = upload.created_at.isoformat()
+            elif field == 'file_url':
+                item[field] = file_url.get(upload.file.name)
+            elif field == 'preview_url':
+                item[field] = preview_url.get(upload.preview.name)
+            elif field == 'duplicates':
+                item[field] = duplicates.get(upload.sha256, 0)
+            else:
+                item[field] = getattr(upload, field)
+        results.append(item)
+    return results
+
+
+def report_response(request, pk, fields):
+    uploaded_file = Upload.objects.only(*columns(fields)).filter(pk=pk).first()
+    if uploaded_file is None:
+        return error('No such report.', status=404)
+    if not can_view_upload(request.user, uploaded_file):
+        return error('You cannot view this report.', status=403)
+    return JsonResponse(serialize([uploaded_file], fields)[0])
+
+
+def payload(request):
+    # Writes take a form-encoded or a JSON body.
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+@conditional.compress
+@require_GET
+@authenticated
+def reports(request):
+    sort_by = request.GET.get('sort_by', 'most_recent')
+    if sort_by not in QUEUE_ORDERINGS:
+        return error('Unknown sort_by.')
+    try:
+        limit = int(request.GET.get('limit', page_size()))
+    except ValueError:
+        return error('limit must be a number.')
+    if not 1 <= limit <= MAX_LIMIT:
+        return error('limit must be between 1 and %d.' % MAX_LIMIT)
+    default = [field for field in available_fields(request.user) if field not in LARGE_FIELDS]
+    fields = requested_fields(request, default)
+    if fields is None:
+        return error('Unknown field.')
+
+    uploaded_files = Upload.objects.all() if request.user.is_staff else Upload.objects.filter(user=request.user)
+    ordering = QUEUE_ORDERINGS[sort_by]
+    # The sort keys are read too, for the cursors.
+    uploaded_files = queue_filter(uploaded_files, sort_by).only(*columns(fields, *(f.lstrip('-') for f in ordering)))
+    page = paginate(uploaded_files, ordering, request.GET.get('cursor'), key=sort_by, size=limit)
+    return JsonResponse({
+        'results': serialize(page.object_list, fields),
+        'next': page.next_cursor,
+        'previous': page.previous_cursor,
+    })
+
+
+@conditional.compress
+@require_GET
+@authenticated
+def report(request, pk):
+    # Unlike the detail page, reading a report here does not mark it as in progress.
+    fields = requested_fields(request, available_fields(request.user))
+    if fields is None:
+        return error('Unknown field.')
+    return report_response(request, pk, fields)
+
+
+def staff_write(view):
+    @wraps(view)
+    def wrapper(request, pk):
+        if not request.user.is_staff:
+            return error('Only staff can change reports.', status=403)
+        data = payload(request)
+        if data is None:
+            return error('The body must be a JSON object.')
+        owner = list(Upload.objects.filter(pk=pk).values_list('user_id', flat=True))
+        if not owner:
+            return error('No such report.', status=404)
+        response = view(request, pk, owner[0], data)
+        return response or report_response(request, pk, available_fields(request.user))
+    return wrapper
+
+
+@require_POST
+@authenticated
+@staff_write
+def resolve(request, pk, user_id, data):
+    comment = data.get('comment')
+    if not isinstance(comment, str) or not comment.strip():
+        return error('A comment is required.')
+    resolve_upload(pk, user_id, comment)
+
+
+@require_POST
+@authenticated
+@staff_write
+def priority(request, pk, user_id, data):
+    value = parse_priority(data.get('priority'))
+    if value is None:
+        return error('Unknown priority.')
+    set_priority(pk, user_id, value)
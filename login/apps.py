@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class LoginConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "login"
+
+    def ready(self):
+        # Connects the queue cache invalidation to s3.signals.upload_changed.
+        from . import queue_cache
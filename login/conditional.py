@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import time
+from functools import wraps
+
+from django.middleware.csrf import get_token
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import queue_cache
+
+# Conditional GET for the queue and detail pages. Their ETag is worked out before the
+# page is queried or rendered, from watermarks that change whenever what the page shows
+# does: the queue cache version of a queue's scope (bumped by every write to one of its
+# reports, see login.queue_cache) and Upload.version for a single report. A browser
+# revalidating an unchanged page gets an empty 304 instead.
+#
+# The pages embed signed preview and file URLs, so every ETag also changes each
+# queue_cache.card_timeout() seconds, soon enough that a page revalidated until then
+# never holds an expired URL (see queue_cache.card_timeout). That also bounds how
+# long the few things not covered by a watermark (the dashboard ages, a report's list
+# of duplicates) can stay stale. The pages embed the CSRF token too, so the ETag
+# covers the browser's CSRF secret and session: logging in again rotates both, and the
+# page is then sent anew instead of keeping a stale token.
+#
+# The pages also carry a Last-Modified, for clients that revalidate with
+# If-Modified-Since alone (If-None-Match takes precedence when both are sent). It is
+# the latest of the things above that are times: when the queue's scope last changed
+# (queue_cache.changed_at), the start of the current ETag bucket and the user's last
+# login.
+#
+# Pages are gzipped but not Brotli-compressed: Django's gzip mitigates BREACH by
+# padding the gzip header with random bytes, and a Brotli stream has nowhere to put
+# such padding, while these pages carry the CSRF token.
+
+_gzip = GZipMiddleware(lambda request: None)
+
+
+def make_etag(*parts):
+    parts += (int(time.time() // queue_cache.card_timeout()),)
+    return quote_etag(hashlib.md5(repr(parts).encode()).hexdigest())
+
+
+def client_parts(request):
+    # get_token() picks the CSRF secret the page will be rendered with, creating it on a
+    # first visit, so the ETag is the same when the page is next revalidated.
+    get_token(request)
+    return request.META['CSRF_COOKIE'], request.session.session_key
+
+
+def queue_etag(request, scope, sort_by):
+    version = queue_cache.get_version(queue_cache.get_cache(), scope)
+    user = request.user
+    return make_etag('queue', scope, version, user.pk, user.first_name, sort_by, request.GET.get('cursor'),
+                     *client_parts(request))
+
+
+def detail_etag(request, uploaded_file):
+    user = request.user
+    return make_etag('detail', uploaded_file.pk, uploaded_file.version, user.pk, user.is_staff,
+                     request.GET.get('full') == '1', *client_parts(request))
+
+
+def last_modified(request, scope):
+    # The detail pages use the staff scope, which every write to a report changes.
+    bucket = queue_cache.card_timeout()
+    times = [queue_cache.changed_at(queue_cache.get_cache(), scope), time.time() // bucket * bucket]
+    if request.user.last_login is not None:
+        times.append(request.user.last_login.timestamp())
+    return int(max(times))
+
+
+def validate(response, etag, modified):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(modified)
+    # Browsers may keep the page, but must check it is current before showing it again.
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def not_modified(request, etag, modified):
+    """The 304 response to send if the client's copy of the page is current, else None."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    response = get_conditional_response(request, etag=etag, last_modified=modified)
+    return validate(response, etag, modified) if response is not None else None
+
+
+def compress(view):
+    """gzip the responses of a sync or async view, as GZipMiddleware would (including
+    its BREACH mitigation) for clients that accept it."""
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            return _gzip.process_response(request, await view(request, *args, **kwargs))
+    else:
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return _gzip.process_response(request, view(request, *args, **kwargs))
+    return wrapper
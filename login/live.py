@@ -0,0 +1,211 @@
+import asyncio
+import collections
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from s3 import events
+
+# Live updates of the staff queue over Server-Sent Events, read from the change feed in
+# s3.events. Under ASGI (aupload_events) a process keeps one EventHub per event loop:
+# a single task polls the feed every UPLOAD_EVENTS_POLL_INTERVAL seconds on a thread of
+# its own and wakes the streams waiting on it, so an idle connection costs a coroutine
+# and no queries. Each stream ends after STREAM_LIFETIME (Django 4.2 does not notice a
+# client going away mid-stream) and the browser's EventSource reconnects, resuming from
+# the Last-Event-ID it sends. The sync view (upload_events) answers with the events
+# waiting and closes, so under WSGI the browser polls every SYNC_RETRY instead.
+
+logger = logging.getLogger(__name__)
+
+KEEPALIVE = 15
+STREAM_LIFETIME = 300
+SYNC_RETRY = timedelta(seconds=5)
+# Events kept in memory for the streams of one process.
+BUFFER_SIZE = 1000
+# A stream further behind than this is told to reload the page instead.
+MAX_REPLAY = 200
+# Ids are taken when a transaction inserts its event but it may commit after later
+# ones, so the feed is only read up to the first missing id, until that gap is older
+# than GAP_TIMEOUT (its transaction rolled back).
+GAP_TIMEOUT = timedelta(seconds=5)
+
+
+def poll_interval():
+    return getattr(settings, 'UPLOAD_EVENTS_POLL_INTERVAL', 1.0)
+
+
+def cursor_from(request):
+    """Feed position to resume from: the browser's Last-Event-ID on a reconnect, else
+    the one the page was rendered at."""
+    value = request.headers.get('Last-Event-ID') or request.GET.get('since')
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def published(cursor, rows, now):
+    """The events of `rows` (ids after cursor, in order) that can be sent on."""
+    ready = []
+    for row in rows:
+        if row.id != cursor + 1 and now - row.created_at < GAP_TIMEOUT:
+            break
+        ready.append(row)
+        cursor = row.id
+    return ready
+
+
+def message(event):
+    data = json.dumps({'id': event.upload_id, 'action': event.action})
+    return 'id: %d\nevent: upload\ndata: %s\n\n' % (event.id, data)
+
+
+def control(name, cursor):
+    # "ready" only moves the browser's Last-Event-ID on; "reset" makes it reload the page.
+    return 'id: %d\nevent: %s\ndata: {}\n\n' % (cursor, name)
+
+
+def retry():
+    return 'retry: %d\n\n' % (SYNC_RETRY.total_seconds() * 1000)
+
+
+def sync_stream(cursor):
+    """The body of the sync view: the events after cursor, and when to ask again."""
+    if cursor is None:
+        return [retry(), control('ready', events.latest_id())]
+    rows = events.since(cursor, MAX_REPLAY + 1)
+    if len(rows) > MAX_REPLAY:
+        return [retry(), control('reset', events.latest_id())]
+    return [retry()] + [message(event) for event in published(cursor, rows, timezone.now())]
+
+
+class EventHub:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-events')
+        self.events = collections.deque()
+        # Every event after floor up to cursor is in self.events.
+        self.floor = self.cursor = None
+        self.changed = asyncio.Condition()
+        self.subscribers = 0
+        self.started = self.task = None
+
+    async def run(self, func, *args):
+        def call():
+            try:
+                return func(*args)
+            except Exception:
+                # Reconnect on the next call, in case the connection was lost.
+                connections.close_all()
+                raise
+        return await asyncio.get_running_loop().run_in_executor(self.executor, call)
+
+    async def start(self):
+        self.floor = self.cursor = await self.run(events.latest_id)
+        self.task = asyncio.get_running_loop().create_task(self.poll())
+
+    def stop(self):
+        for task in (self.started, self.task):
+            if task is not None:
+                task.cancel()
+        self.executor.submit(connections.close_all)
+        self.executor.shutdown(wait=False)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(poll_interval())
+            try:
+                rows = await self.run(events.since, self.cursor, BUFFER_SIZE)
+            except Exception:
+                logger.exception("Reading the upload change feed failed")
+                continue
+            ready = published(self.cursor, rows, timezone.now())
+            if ready:
+                async with self.changed:
+                    self.publish(ready)
+                    self.changed.notify_all()
+
+    def publish(self, ready):
+        self.events.extend(ready)
+        self.cursor = ready[-1].id
+        while len(self.events) > BUFFER_SIZE:
+            self.floor = self.events.popleft().id
+
+    def after(self, cursor):
+        return [event for event in self.events if event.id > cursor]
+
+    async def backlog(self, cursor):
+        """(events after cursor up to the hub's cursor, read from the database, and the
+        position they reach), or None if there are too many to replay."""
+        upto = self.cursor
+        rows = await self.run(events.since, cursor, MAX_REPLAY + 1, upto)
+        return (rows, upto) if len(rows) <= MAX_REPLAY else None
+
+    async def wait(self, cursor, timeout):
+        """Events after cursor, waiting up to timeout seconds for one."""
+        async with self.changed:
+            try:
+                await asyncio.wait_for(self.changed.wait_for(lambda: self.cursor > cursor), timeout)
+            except asyncio.TimeoutError:
+                return []
+            return self.after(cursor)
+
+
+hubs = {}
+
+
+async def subscribe():
+    loop = asyncio.get_running_loop()
+    hub = hubs.get(loop)
+    if hub is None:
+        hub = hubs[loop] = EventHub()
+        hub.started = loop.create_task(hub.start())
+    hub.subscribers += 1
+    try:
+        await asyncio.shield(hub.started)
+    except BaseException:
+        unsubscribe(hub)
+        raise
+    return hub
+
+
+def unsubscribe(hub):
+    hub.subscribers -= 1
+    if hub.subscribers == 0:
+        hub.stop()
+        loop = asyncio.get_running_loop()
+        if hubs.get(loop) is hub:
+            del hubs[loop]
+
+
+async def stream(cursor):
+    """The body of the async view: the feed from cursor on, for STREAM_LIFETIME seconds."""
+    hub = await subscribe()
+    try:
+        if cursor is None:
+            cursor = hub.cursor
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + STREAM_LIFETIME
+        yield retry()
+        while loop.time() < deadline:
+            if cursor < hub.floor:
+                backlog = await hub.backlog(cursor)
+                if backlog is None:
+                    yield control('reset', hub.cursor)
+                    return
+                rows, cursor = backlog
+                for event in rows:
+                    yield message(event)
+                continue
+            rows = await hub.wait(cursor, min(KEEPALIVE, deadline - loop.time()))
+            for event in rows:
+                yield message(event)
+                cursor = event.id
+            if not rows:
+                yield ': keepalive\n\n'
+    finally:
+        unsubscribe(hub)
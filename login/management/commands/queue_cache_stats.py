@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from login import queue_cache
+
+
+class Command(BaseCommand):
+    help = "Show hit/miss counters of the queue page cache."
+
+    def handle(self, *args, **options):
+        stats = queue_cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        ratio = stats["hits"] / lookups if lookups else 0
+        self.stdout.write("hits: %d  misses: %d  hit ratio: %.1f%%" % (stats["hits"], stats["misses"], ratio * 100))
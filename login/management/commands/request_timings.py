@@ -0,0 +1,41 @@
+import math
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mysite import instrumentation
+
+METRICS = ("total_ms", "queries", "db_ms", "s3_calls", "s3_ms", "template_ms")
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile of an already sorted list.
+    return values[max(math.ceil(percent / 100 * len(values)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = "Summarise the per-request timings recorded by mysite.instrumentation, per view."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--log", help="Timings file (default: settings.REQUEST_INSTRUMENTATION_LOG).")
+        parser.add_argument("--view", help="Only report this view, e.g. login:staffpage.")
+
+    def handle(self, *args, **options):
+        path = options["log"] or instrumentation.log_path()
+        try:
+            samples = instrumentation.read_samples(path)
+        except FileNotFoundError:
+            raise CommandError("No timings recorded at %s" % path)
+
+        by_view = defaultdict(list)
+        for sample in samples:
+            if options["view"] in (None, sample["view"]):
+                by_view[sample["view"]].append(sample)
+
+        for view, view_samples in sorted(by_view.items()):
+            self.stdout.write("%s (%d requests)" % (view, len(view_samples)))
+            self.stdout.write("  %-12s" % "" + "".join("%10s" % ("p%d" % percent) for percent in PERCENTILES))
+            for metric in METRICS:
+                values = sorted(sample[metric] for sample in view_samples)
+                self.stdout.write("  %-12s" % metric + "".join("%10g" % percentile(values, percent) for percent in PERCENTILES))
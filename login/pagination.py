@@ -0,0 +1,121 @@
+from django.conf import settings
+from django.core import signing
+from django.db.models import Q
+
+# Keyset ("seek") pagination for the report queues. Instead of OFFSET we remember the
+# sort key of the last row that was shown and ask the database for the rows after it,
+# so every page costs the same no matter how deep into the queue you are, and reports
+# filed while someone is paging never shift rows between pages.
+
+CURSOR_SALT = "login.pagination"
+
+
+def page_size():
+    return getattr(settings, "QUEUE_PAGE_SIZE", 25)
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(key, direction, values):
+    return signing.dumps([key, direction, list(values)], salt=CURSOR_SALT)
+
+
+def decode_cursor(cursor, key):
+    """Return (direction, values) for a cursor issued for `key`, or (None, None) if it
+    is missing, tampered with or belongs to another sort order."""
+    if not cursor:
+        return None, None
+    try:
+        cursor_key, direction, values = signing.loads(cursor, salt=CURSOR_SALT)
+    except (signing.BadSignature, ValueError, TypeError):
+        return None, None
+    if cursor_key != key or direction not in ("next", "previous"):
+        return None, None
+    return direction, values
+
+
+def keyset_filter(ordering, values, reverse=False, inclusive=False):
+    # For ordering (a, -b, -id) the rows after (va, vb, vid) are
+    #   a > va  OR  (a = va AND b < vb)  OR  (a = va AND b = vb AND id < vid)
+    fields = [field.lstrip("-") for field in ordering]
+    condition = Q()
+    for i, field in enumerate(ordering):
+        descending = field.startswith("-") != reverse
+        lookup = "%s__%s" % (fields[i], "lt" if descending else "gt")
+        term = Q(**{lookup: values[i]})
+        for name, value in zip(fields[:i], values[:i]):
+            term &= Q(**{name: value})
+        condition |= term
+    if inclusive:
+        condition |= Q(**dict(zip(fields, values)))
+    return condition
+
+
+def row_values(row, ordering):
+    return [getattr(row, field.lstrip("-")) for field in ordering]
+
+
+def paginate(queryset, ordering, cursor=None, key="", size=None):
+    """Return a KeysetPage of `queryset` sorted by `ordering`.
+
+    The last entry of `ordering` must be unique (normally "-id") so every row has a
+    distinct position. object_list is a list of the page's rows. A page costs a single
+    query, plus one over the sort keys when going back.
+    """
+    size = size or page_size()
+    queryset = queryset.order_by(*ordering)
+    direction, values = decode_cursor(cursor, key)
+    has_previous = False
+
+    if direction == "next":
+        page_queryset = queryset.filter(keyset_filter(ordering, values))
+        has_previous = True
+    elif direction == "previous":
+        # Walk backwards over just the sort keys to find where the previous page starts,
+        # then read that page forwards like any other.
+        fields = [field.lstrip("-") for field in ordering]
+        before = list(
+            queryset.reverse()
+            .filter(keyset_filter(ordering, values, reverse=True))
+            .values_list(*fields)[:size + 1]
+        )
+        has_previous = len(before) > size
+        if before:
+            start = before[:size][-1]
+            page_queryset = queryset.filter(keyset_filter(ordering, start, inclusive=True))
+        else:
+            page_queryset = queryset
+    else:
+        page_queryset = queryset
+
+    # One row more than the page tells whether another page follows, in the same query.
+    rows = list(page_queryset[:size + 1])
+    has_next = len(rows) > size
+    rows = rows[:size]
+
+    next_cursor = previous_cursor = None
+    if rows:
+        if has_next:
+            next_cursor = encode_cursor(key, "next", row_values(rows[-1], ordering))
+        if has_previous:
+            previous_cursor = encode_cursor(key, "previous", row_values(rows[0], ordering))
+    return KeysetPage(rows, next_cursor, previous_cursor)
@@ -0,0 +1,132 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.dispatch import receiver
+
+from mysite.storage_backends import PublicMediaStorage
+from s3.signals import upload_changed
+
+# Caches the queue pages built by login.views.queue_page. Every page is stored under a
+# version number for its scope: "staff" for the staff queue and "user:<id>" for one
+# reporter's queue. A write to an upload bumps the version of the staff scope and of its
+# reporter's scope, so exactly the affected queues miss the cache on their next read
+# while every other reporter keeps their cached pages.
+#
+# settings.QUEUE_CACHE names the entry of settings.CACHES to use. The default cache is
+# local memory, which is only right for a single process; with several workers point
+# it at a shared FileBasedCache or DatabaseCache so invalidations reach all of them.
+
+STAFF_SCOPE = 'staff'
+
+
+def get_cache():
+    return caches[getattr(settings, 'QUEUE_CACHE', 'default')]
+
+
+def timeout():
+    return getattr(settings, 'QUEUE_CACHE_TIMEOUT', 300)
+
+
+def card_timeout():
+    # The queue cards are template fragments keyed on (upload id, version), and they
+    # embed signed preview URLs. A URL out of PublicMediaStorage's URL cache may have
+    # only url_cache_margin seconds of signature left; a card can be this old when it
+    # goes into a page, and the browser can keep reusing the page for as long again
+    # (the ETag buckets of login.conditional), so both together must fit in the margin.
+    limit = PublicMediaStorage.url_cache_margin // 2
+    return min(getattr(settings, 'QUEUE_CARD_CACHE_TIMEOUT', limit), limit)
+
+
+def user_scope(user_id):
+    return 'user:%s' % user_id
+
+
+def version_key(scope):
+    return 'queue:version:%s' % scope
+
+
+def get_version(cache, scope):
+    version = cache.get(version_key(scope))
+    if version is None:
+        # Start from the clock rather than 1, so pages cached under an evicted version
+        # can never be mistaken for current ones.
+        cache.add(version_key(scope), time.time_ns(), None)
+        version = cache.get(version_key(scope))
+    return version
+
+
+def changed_key(scope):
+    return 'queue:changed:%s' % scope
+
+
+def changed_at(cache, scope):
+    """When the scope's queue last changed, as a Unix time (the Last-Modified of its pages)."""
+    changed = cache.get(changed_key(scope))
+    if changed is None:
+        # Evicted or never set: say now, so no page is taken to be older than it is.
+        cache.add(changed_key(scope), time.time(), None)
+        changed = cache.get(changed_key(scope))
+    return changed
+
+
+def bump_version(cache, scope):
+    # The change time is recorded first, so a reader that sees the new version never
+    # sees an older change time with it.
+    cache.set(changed_key(scope), time.time(), None)
+    try:
+        cache.incr(version_key(scope))
+    except ValueError:
+        get_version(cache, scope)
+
+
+def page_key(scope, version, sort_by, cursor):
+    cursor_hash = hashlib.md5((cursor or '').encode()).hexdigest()
+    return 'queue:page:%s:%s:%s:%s' % (scope, version, sort_by, cursor_hash)
+
+
+def count(cache, name):
+    key = 'queue:stats:%s' % name
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        pass
+
+
+def get_page(scope, sort_by, cursor):
+    """Return (key, page); page is None on a miss, and should then be stored under key.
+
+    The key is taken before the queue is queried, so a page built while a write lands
+    is stored under the already outdated version and never served."""
+    cache = get_cache()
+    key = page_key(scope, get_version(cache, scope), sort_by, cursor)
+    page = cache.get(key)
+    count(cache, 'hits' if page is not None else 'misses')
+    return key, page
+
+
+def set_page(key, page):
+    get_cache().set(key, page, timeout())
+
+
+def stats():
+    hits, misses = (get_cache().get('queue:stats:%s' % name, 0) for name in ('hits', 'misses'))
+    return {'hits': hits, 'misses': misses}
+
+
+def invalidate(user_id):
+    cache = get_cache()
+    bump_version(cache, STAFF_SCOPE)
+    if user_id is not None:
+        bump_version(cache, user_scope(user_id))
+
+
+@receiver(upload_changed)
+def invalidate_changed_upload(sender, upload_id, user_id, action, **kwargs):
+    # Invalidate now so this transaction reads its own writes, and again after the commit
+    # in case a concurrent reader cached the old rows in between.
+    invalidate(user_id)
+    transaction.on_commit(lambda: invalidate(user_id))
@@ -1,16 +1,32 @@
 from allauth.account.views import LoginView
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import api, views
+
+# Under ASGI with settings.ASYNC_VIEWS on, the async versions of the queue, detail and
+# delete views, and the streaming staff queue events, are served instead (see
+# mysite/asgi.py).
+ASYNC_VIEWS = getattr(settings, "ASYNC_VIEWS", False)
 
 app_name = "login"
 urlpatterns = [
     #path("", LoginView.as_view(), name="login"),
     path("", views.home, name="home"),
-    path("mainpage", views.mainpage, name="mainpage"),
-    path("site-staff", views.staffpage, name="staffpage"),
-    path("upload/<int:pk>/", views.upload_detail, name="upload_detail"),
+    path("mainpage", views.amainpage if ASYNC_VIEWS else views.mainpage, name="mainpage"),
+    path("site-staff", views.astaffpage if ASYNC_VIEWS else views.staffpage, name="staffpage"),
+    path("upload/<int:pk>/", views.aupload_detail if ASYNC_VIEWS else views.upload_detail, name="upload_detail"),
+    path("upload/<int:pk>/preview", views.upload_preview, name="upload_preview"),
     path("upload/<int:pk>/admin_resolve", views.upload_admin_resolve, name="admin_resolve"),
     path("logout", views.logout_view, name="logout"),
-    path("upload/<int:pk>/delete", views.delete, name="delete"),
+    path("upload/<int:pk>/delete", views.adelete if ASYNC_VIEWS else views.delete, name="delete"),
     path("upload/<int:pk>/change_priority", views.change_priority, name="change_priority"),
+    path("site-staff/bulk", views.bulk_triage, name="bulk_triage"),
+    path("site-staff/search", views.search, name="search"),
+    path("site-staff/events", views.aupload_events if ASYNC_VIEWS else views.upload_events, name="upload_events"),
+    path("upload/<int:pk>/card", views.upload_card, name="upload_card"),
+    path("export", views.export, name="export"),
+    path("api/reports", api.reports, name="api_reports"),
+    path("api/reports/<int:pk>", api.report, name="api_report"),
+    path("api/reports/<int:pk>/resolve", api.resolve, name="api_resolve"),
+    path("api/reports/<int:pk>/priority", api.priority, name="api_priority"),
 ]
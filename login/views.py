@@ -1,14 +1,24 @@
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponseForbidden, StreamingHttpResponse
 from django.shortcuts import render
 from django.views import generic
 from django.shortcuts import redirect, get_object_or_404
+from django.db import transaction
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
+from django.utils import timezone
 import boto3
 from s3.models import Upload
-from django.db import models
-from django.db.models import Case, When
+from s3 import dedup, deletion, events, stats
+from s3.forms import ExportForm
+from s3.previews import generate_preview
+from s3.signals import upload_changed
+from s3 import search as upload_search
+from s3 import export as upload_export
+from s3.aio import request_user
 from django.contrib.auth import logout
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from .pagination import page_size, paginate
+from . import conditional, live, queue_cache
 
 # Create your views here.
 class LoginView:
@@ -24,90 +34,375 @@ def home(request):
         return mainpage(request)
     else:
         return render(request, "login/home.html")
+# Sort key for each sort_by mode. Every ordering ends in '-id' so the keyset cursors
+# in login.pagination always have a unique row to resume from.
+QUEUE_ORDERINGS = {
+    'most_recent': ['-id'],
+    'not_yet_seen': ['status_rank', '-id'],
+    'priority': ['-priority', 'status_rank', '-id'],
+    'hide_resolved': ['status_rank', '-priority', '-id'],
+}
+
+def get_sort_by(request):
+    sort_by = request.GET.get('sort_by')
+    if sort_by:
+        request.session['sort_by'] = sort_by
+    sort_by = request.session.get('sort_by', 'most_recent')
+    if sort_by not in QUEUE_ORDERINGS:
+        sort_by = 'most_recent'
+    return sort_by
+
+def queue_filter(uploaded_files, sort_by):
+    if sort_by == 'hide_resolved':
+        return uploaded_files.filter(status_rank__lt=Upload.STATUS_RANKS['Resolved'])
+    return uploaded_files
+
+def queue_page(request, uploaded_files, sort_by, scope):
+    cursor = request.GET.get('cursor')
+    cache_key, page = queue_cache.get_page(scope, sort_by, cursor)
+    if page is None:
+        uploaded_files = queue_filter(uploaded_files, sort_by)
+        # Only the columns the cards show: the comments are read as their excerpts, and
+        # the extracted file text is only needed by the search index.
+        page = paginate(uploaded_files.only(*Upload.CARD_FIELDS), QUEUE_ORDERINGS[sort_by], cursor, key=sort_by)
+        queue_cache.set_page(cache_key, page)
+    prime_file_urls(page.object_list)
+    return page
+
+def prime_file_urls(uploaded_files):
+    # Sign every preview link on the page in one call; the template's .url lookups then
+    # come out of PublicMediaStorage's URL cache.
+    storage = Upload._meta.get_field('preview').storage
+    if hasattr(storage, 'urls'):
+        storage.urls([file.preview.name for file in uploaded_files if file.has_image_preview])
+
+def user_queue_context(request, sort_by):
+    page = queue_page(request, Upload.objects.filter(user=request.user), sort_by, queue_cache.user_scope(request.user.pk))
+    return {
+        'user_uploaded_files': page.object_list, 'page': page, 'sort_by': sort_by,
+        'card_cache_timeout': queue_cache.card_timeout(), 'export_form': ExportForm(),
+    }
+
+def staff_queue_context(request, sort_by):
+    page = queue_page(request, Upload.objects.all(), sort_by, queue_cache.STAFF_SCOPE)
+    return {
+        'all_uploaded_files': page.object_list, 'page': page, 'sort_by': sort_by,
+        'card_cache_timeout': queue_cache.card_timeout(), 'priority_choices': Upload.PRIORITY_CHOICES,
+        'dashboard': stats.dashboard(), 'events_since': events.latest_id(), 'export_form': ExportForm(),
+    }
+
+def render_user_queue(request):
+    sort_by = get_sort_by(request)
+    scope = queue_cache.user_scope(request.user.pk)
+    etag = conditional.queue_etag(request, scope, sort_by)
+    modified = conditional.last_modified(request, scope)
+    response = conditional.not_modified(request, etag, modified)
+    if response is None:
+        response = render(request, 'login/mainpage.html', user_queue_context(request, sort_by))
+        conditional.validate(response, etag, modified)
+    return response
+
+def render_staff_queue(request):
+    sort_by = get_sort_by(request)
+    scope = queue_cache.STAFF_SCOPE
+    etag = conditional.queue_etag(request, scope, sort_by)
+    modified = conditional.last_modified(request, scope)
+    response = conditional.not_modified(request, etag, modified)
+    if response is None:
+        response = render(request, 'login/site-staff.html', staff_queue_context(request, sort_by))
+        conditional.validate(response, etag, modified)
+    return response
+
+@conditional.compress
 def mainpage(request):
     if request.user.is_authenticated:
-        status_ordering = Case(
-            When(status='New', then=0),
-            When(status='In Progress', then=1),
-            When(status='Resolved', then=2),
-            default=0,
-            output_field=models.IntegerField()
-        )
-        sort_by = request.GET.get('sort_by')
-        if sort_by:
-            request.session['sort_by'] = sort_by
-        sort_by = request.session.get('sort_by', 'most_recent')
-        if sort_by == 'most_recent':
-            user_uploaded_files = Upload.objects.all().filter(user=request.user).order_by('-id')
-        elif sort_by == 'not_yet_seen':
-            user_uploaded_files = Upload.objects.all().filter(user=request.user).order_by(status_ordering, '-id')
-        elif sort_by == 'priority':
-            user_uploaded_files = Upload.objects.all().filter(user=request.user).order_by('-priority', status_ordering, '-id')
-        elif sort_by == 'hide_resolved':
-            user_uploaded_files = Upload.objects.all().filter(user=request.user).exclude(status="Resolved").order_by(status_ordering,'-priority', '-id')
-        else:
-            user_uploaded_files = Upload.objects.all().filter(user=request.user).order_by('-id')
-        return render(request, 'login/mainpage.html', {'user_uploaded_files': user_uploaded_files, 'sort_by': sort_by})
+        return render_user_queue(request)
     else:
         return render(request, 'login/mainpage.html', {})
 
+@conditional.compress
 def staffpage(request):
     if request.user.is_staff:
-        status_ordering = Case(
-            When(status='New', then=0),
-            When(status='In Progress', then=1),
-            When(status='Resolved', then=2),
-            default=0,
-            output_field=models.IntegerField()
-        )
-        sort_by = request.GET.get('sort_by')
-        if sort_by:
-            request.session['sort_by'] = sort_by
-        sort_by = request.session.get('sort_by', 'most_recent')
-        if sort_by == 'most_recent':
-            all_uploaded_files = Upload.objects.all().order_by('-id')
-        elif sort_by == 'not_yet_seen':
-            all_uploaded_files = Upload.objects.all().order_by(status_ordering, '-id')
-        elif sort_by == 'priority':
-            all_uploaded_files = Upload.objects.all().order_by('-priority', status_ordering, '-id')
-        elif sort_by == 'hide_resolved':
-            all_uploaded_files = Upload.objects.all().exclude(status="Resolved").order_by(status_ordering, '-priority', '-id')
-
-        return render(request, 'login/site-staff.html', {'all_uploaded_files': all_uploaded_files, 'sort_by': sort_by})
+        return render_staff_queue(request)
     else:
         return render(request, 'login/error.html')
 
+def upload_card(request, pk):
+    # One staff queue card, fetched by the live updates of the staff page.
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    uploaded_file = get_object_or_404(Upload.objects.only(*Upload.CARD_FIELDS), pk=pk)
+    prime_file_urls([uploaded_file])
+    return render(request, 'login/staff_card.html', {
+        'file': uploaded_file, 'card_cache_timeout': queue_cache.card_timeout(),
+    })
+
+def event_stream(content):
+    response = StreamingHttpResponse(content, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keep proxies such as nginx from buffering the stream.
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+def upload_events(request):
+    # Server-Sent Events of the report change feed for the staff page; see login.live.
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    return event_stream(live.sync_stream(live.cursor_from(request)))
+
+@conditional.compress
+def search(request):
+    if not request.user.is_staff:
+        return render(request, 'login/error.html')
+    query = request.GET.get('q', '').strip()
+    try:
+        page_number = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page_number = 1
+    size = page_size()
+    results, has_next = upload_search.search(query, offset=(page_number - 1) * size, limit=size)
+    prime_file_urls(results)
+    return render(request, 'login/search.html', {
+        'query': query, 'results': results, 'page_number': page_number, 'has_next': has_next,
+        'card_cache_timeout': queue_cache.card_timeout(), 'priority_choices': Upload.PRIORITY_CHOICES,
+    })
+
+# The write paths below update only the columns they change, in a single UPDATE, so
+# they never overwrite each other's changes (or the comment fields) with stale values.
+# resolve_upload and set_priority are shared with the JSON API (login.api).
+
+def parse_priority(value):
+    try:
+        priority = int(value)
+    except (TypeError, ValueError):
+        return None
+    return priority if priority in dict(Upload.PRIORITY_CHOICES) else None
+
+def resolve_upload(pk, user_id, comment):
+    with transaction.atomic():
+        Upload.objects.filter(pk=pk).update(admin_comment=comment, status='Resolved')
+        upload_changed.send(sender=Upload, upload_id=pk, user_id=user_id, action='resolved')
+
+def set_priority(pk, user_id, priority):
+    with transaction.atomic():
+        Upload.objects.filter(pk=pk).update(priority=priority)
+        upload_changed.send(sender=Upload, upload_id=pk, user_id=user_id, action='priority')
+
 def upload_admin_resolve(request, pk):
-    uploaded_file = get_object_or_404(Upload, pk=pk)
     if (request.method == "POST"):
-        uploaded_file.admin_comment = request.POST["comment"]
-        uploaded_file.status = 'Resolved'
-        uploaded_file.save()
+        user_id = get_object_or_404(Upload.objects.values_list('user_id', flat=True), pk=pk)
+        resolve_upload(pk, user_id, request.POST["comment"])
         return redirect('login:staffpage')
     else:
         return render(request, 'login/error.html')
 
 def change_priority(request, pk):
-    uploaded_file = get_object_or_404(Upload, pk=pk)
     if (request.method == "POST"):
-        uploaded_file.priority = request.POST["priority"]
-        uploaded_file.save()
+        priority = parse_priority(request.POST.get("priority"))
+        if priority is None:
+            return render(request, 'login/error.html')
+        user_id = get_object_or_404(Upload.objects.values_list('user_id', flat=True), pk=pk)
+        set_priority(pk, user_id, priority)
         return upload_detail(request, pk)
     else:
         return render(request, 'login/error.html')
 
+# Most reports one bulk action may touch, so a single request cannot lock the whole table.
+BULK_TRIAGE_LIMIT = 500
+# upload_changed action sent for each report a bulk action changes.
+BULK_SIGNAL_ACTIONS = {'resolve': 'resolved', 'priority': 'priority', 'comment': 'comment'}
+
+def bulk_triage(request):
+    # Resolve, re-prioritise or comment on the reports ticked on the staff queue with one
+    # UPDATE. The rows are locked first so the outcome listed for each report is what
+    # the UPDATE actually did to it.
+    if request.method != "POST" or not request.user.is_staff:
+        return render(request, 'login/error.html')
+    action = request.POST.get("action")
+    comment = request.POST.get("comment", "")
+    try:
+        ids = list(dict.fromkeys(int(pk) for pk in request.POST.getlist("selected")))
+        priority = int(request.POST["priority"]) if action == "priority" else None
+    except (KeyError, ValueError):
+        return render(request, 'login/error.html')
+    if action not in BULK_SIGNAL_ACTIONS or not ids or len(ids) > BULK_TRIAGE_LIMIT:
+        return render(request, 'login/error.html')
+    if action == 'priority' and priority not in dict(Upload.PRIORITY_CHOICES):
+        return render(request, 'login/error.html')
+
+    with transaction.atomic():
+        found = {
+            pk: (user_id, status)
+            for pk, user_id, status in Upload.objects.select_for_update().filter(pk__in=ids).values_list('id', 'user_id', 'status')
+        }
+        if action == 'resolve':
+            changed = [pk for pk, (user_id, status) in found.items() if status != 'Resolved']
+            Upload.objects.filter(pk__in=changed).update(admin_comment=comment, status='Resolved')
+        elif action == 'priority':
+            changed = list(found)
+            Upload.objects.filter(pk__in=changed).update(priority=priority)
+        else:
+            changed = list(found)
+            Upload.objects.filter(pk__in=changed).update(admin_comment=comment)
+        for pk in changed:
+            upload_changed.send(sender=Upload, upload_id=pk, user_id=found[pk][0], action=BULK_SIGNAL_ACTIONS[action])
+
+    changed = set(changed)
+    outcomes = []
+    for pk in ids:
+        if pk not in found:
+            outcomes.append((pk, 'Not found'))
+        elif pk in changed:
+            outcomes.append((pk, 'Updated'))
+        else:
+            outcomes.append((pk, 'Already resolved'))
+    return render(request, 'login/bulk_result.html', {
+        'action': action, 'outcomes': outcomes, 'updated': len(changed),
+    })
+
+def export(request):
+    # A ZIP of reports and their files (s3.export): the ones ticked on the staff queue,
+    # POSTed from the bulk form, or those matching the export form. Reporters can only
+    # export their own.
+    if not request.user.is_authenticated:
+        return render(request, 'login/error.html')
+    uploads = Upload.objects.defer('extracted_text')
+    if not request.user.is_staff:
+        uploads = uploads.filter(user=request.user)
+    if request.method == "POST":
+        try:
+            uploads = uploads.filter(pk__in=[int(pk) for pk in request.POST.getlist("selected")])
+        except ValueError:
+            return render(request, 'login/error.html')
+    else:
+        form = ExportForm(request.GET)
+        if not form.is_valid():
+            return render(request, 'login/error.html')
+        uploads = form.filter(uploads)
+    uploads = list(uploads.order_by('id')[:upload_export.max_reports() + 1])
+    if not uploads or len(uploads) > upload_export.max_reports():
+        return render(request, 'login/error.html')
+    response = StreamingHttpResponse(upload_export.stream(deletion.get_storage(), uploads),
+                                     content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="reports-%s.zip"' % timezone.now().strftime('%Y%m%d-%H%M%S')
+    return response
+
+# Most reports with identical evidence listed on a report's detail page.
+DUPLICATES_SHOWN = 20
+
+def can_view_upload(user, uploaded_file):
+    return user.is_authenticated and (uploaded_file.user_id == user.pk or user.is_staff)
+
+def start_review(uploaded_file):
+    # Only the first staff member to open the report moves it on; anyone racing them
+    # (or resolving it meanwhile) leaves the row alone and we show its current state.
+    with transaction.atomic():
+        transitioned = Upload.objects.filter(pk=uploaded_file.pk, status='New').update(status='In Progress')
+        if transitioned:
+            upload_changed.send(sender=Upload, upload_id=uploaded_file.pk, user_id=uploaded_file.user_id, action='status')
+    if transitioned:
+        uploaded_file.status = 'In Progress'
+        uploaded_file.status_rank = Upload.STATUS_RANKS['In Progress']
+        uploaded_file.version += 1
+    else:
+        uploaded_file.refresh_from_db(fields=['status', 'status_rank', 'admin_comment', 'version'])
+
+def detail_context(request, uploaded_file):
+    full_size = request.GET.get('full') == '1'
+    duplicate_reports = []
+    if request.user.is_staff:
+        duplicate_reports = dedup.duplicates(uploaded_file).only('id', 'title')[:DUPLICATES_SHOWN]
+    return {'uploaded_file': uploaded_file, 'full_size': full_size, 'duplicate_reports': duplicate_reports}
+
+def render_detail(request, uploaded_file):
+    etag = conditional.detail_etag(request, uploaded_file)
+    modified = conditional.last_modified(request, queue_cache.STAFF_SCOPE)
+    response = conditional.not_modified(request, etag, modified)
+    if response is None:
+        response = render(request, 'login/upload_detail.html', detail_context(request, uploaded_file))
+        conditional.validate(response, etag, modified)
+    return response
+
+@conditional.compress
 def upload_detail(request, pk):
-    uploaded_file = get_object_or_404(Upload, pk=pk)
-    if request.user.is_authenticated == False or (uploaded_file.user != request.user and request.user.is_staff == False):
+    uploaded_file = get_object_or_404(Upload.objects.defer('extracted_text'), pk=pk)
+    if not can_view_upload(request.user, uploaded_file):
         return render(request, 'login/error.html')
     if uploaded_file.status == 'New' and request.user.is_staff:
-        uploaded_file.status = 'In Progress'
-        uploaded_file.save()
-    return render(request, 'login/upload_detail.html', {'uploaded_file': uploaded_file})
+        start_review(uploaded_file)
+    return render_detail(request, uploaded_file)
+
+def upload_preview(request, pk):
+    # Previews are normally made by the processing worker; build one here if it has not
+    # got to this upload yet, and fall back to the original for unsupported files.
+    uploaded_file = get_object_or_404(Upload, pk=pk)
+    if not can_view_upload(request.user, uploaded_file):
+        return render(request, 'login/error.html')
+    if not generate_preview(uploaded_file):
+        return redirect(uploaded_file.file.url)
+    return redirect(uploaded_file.preview.url)
+
+def can_delete_upload(user, uploaded_file):
+    return not (user.is_authenticated == False or (uploaded_file.user_id != user.pk and user.is_staff == True))
+
+def delete_upload(uploaded_file):
+    # The stored files are removed later by the process_deletions command (s3.deletion).
+    with transaction.atomic():
+        deletion.schedule_upload(uploaded_file)
+        uploaded_file.delete()
+
 def delete(request, pk):
     uploaded_file = get_object_or_404(Upload, pk=pk)
-    if request.user.is_authenticated == False or (uploaded_file.user != request.user and request.user.is_staff == True):
+    if not can_delete_upload(request.user, uploaded_file):
         return render(request, 'login/error.html')
-    uploaded_file.file.delete(save=False)
-    uploaded_file.delete()
+    delete_upload(uploaded_file)
+    return redirect('login:mainpage')
+
+# Async versions of the queue, detail and delete pages, routed in place of the ones
+# above when settings.ASYNC_VIEWS is on (see mysite/asgi.py). Single-row reads use the
+# async ORM; transactions, the session, the caches and template rendering are blocking
+# and run on the request's thread through sync_to_async.
+
+async def aget_upload(pk):
+    try:
+        return await Upload.objects.defer('extracted_text').aget(pk=pk)
+    except Upload.DoesNotExist:
+        raise Http404("No report matches the given query.")
+
+@conditional.compress
+async def amainpage(request):
+    user = await request_user(request)
+    if not user.is_authenticated:
+        return await sync_to_async(render)(request, 'login/mainpage.html', {})
+    return await sync_to_async(render_user_queue)(request)
+
+@conditional.compress
+async def astaffpage(request):
+    user = await request_user(request)
+    if not user.is_staff:
+        return await sync_to_async(render)(request, 'login/error.html')
+    return await sync_to_async(render_staff_queue)(request)
+
+@conditional.compress
+async def aupload_detail(request, pk):
+    user = await request_user(request)
+    uploaded_file = await aget_upload(pk)
+    if not can_view_upload(user, uploaded_file):
+        return await sync_to_async(render)(request, 'login/error.html')
+    if uploaded_file.status == 'New' and user.is_staff:
+        await sync_to_async(start_review)(uploaded_file)
+    return await sync_to_async(render_detail)(request, uploaded_file)
+
+async def aupload_events(request):
+    user = await request_user(request)
+    if not user.is_staff:
+        return HttpResponseForbidden()
+    return event_stream(live.stream(live.cursor_from(request)))
+
+async def adelete(request, pk):
+    user = await request_user(request)
+    uploaded_file = await aget_upload(pk)
+    if not can_delete_upload(user, uploaded_file):
+        return await sync_to_async(render)(request, 'login/error.html')
+    await sync_to_async(delete_upload)(uploaded_file)
     return redirect('login:mainpage')
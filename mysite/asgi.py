@@ -5,6 +5,40 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+
+The Procfile serves the site with sync gunicorn workers (mysite.wsgi), where every
+request holds a worker process until it finishes, including while it waits on S3. To
+serve it from this module instead, use uvicorn's gunicorn worker class:
+
+    web: gunicorn mysite.asgi:application -k uvicorn.workers.UvicornWorker
+
+and set ASYNC_VIEWS = True in the settings, which routes the async versions of the
+queue, detail, delete and direct-upload finalize views (login/urls.py, s3/urls.py).
+Their S3 calls run on a pool of ASYNC_S3_THREADS threads (default 32, see s3.aio),
+which keep their boto3 clients between requests, and their database work on the
+request's own thread, so one process keeps serving while many requests wait on the
+bucket. The other views stay synchronous; Django runs each of them on a new thread,
+which builds a new boto3 client the first time it touches S3.
+
+In MIDDLEWARE, list mysite.middleware.AccountMiddleware in place of django-allauth's
+AccountMiddleware, which is sync-only: with it in the stack Django gives every request
+a thread to run the middleware in and awaits the async views from there.
+
+That includes the form submit view (s3.views.UploadCreateView), which has no async
+version. Under ASGI Django also reads the whole request body before any view runs
+(into memory, then a temporary file past FILE_UPLOAD_MAX_MEMORY_SIZE), so
+S3MultipartUploadHandler only starts sending the file to S3 once the browser has sent
+all of it, instead of while it arrives as under WSGI. Large files are better sent
+through the direct-to-bucket or resumable submit pages, which never pass the file
+through a request to this process in one piece.
+
+The staff queue's live updates (login.live) are streamed for as long as a staff page
+is open. Under ASGI hundreds of streams share one process and one feed poller, each
+costing a coroutine and the idle thread asgiref keeps for the request until it ends
+(see benchmarks/bench_live.py); a sync worker can only answer each with the changes
+so far and have the browser ask again.
+
+benchmarks/bench_async.py compares the modes with simulated S3 latency.
 """
 
 import os
@@ -0,0 +1,71 @@
+import importlib
+
+import boto3
+import pytest
+from django.db.backends.signals import connection_created
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from django.urls import clear_url_caches
+from moto import mock_aws
+
+from mysite.storage_backends import PublicMediaStorage
+from s3.models import Upload
+
+
+def reload_urls():
+    for module in ('login.urls', 's3.urls', 'mysite.urls'):
+        importlib.reload(importlib.import_module(module))
+    clear_url_caches()
+
+
+def use_wal(sender, connection, **kwargs):
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+
+
+def begin_immediate(self):
+    self.cursor().execute("BEGIN IMMEDIATE")
+
+
+@pytest.fixture(scope="session")
+def django_db_modify_db_settings(django_db_modify_db_settings, tmp_path_factory):
+    """Give SQLite test databases the locking of a real deployment.
+
+    By default the test database is a shared-cache in-memory one, where a connection
+    that finds a table in use by another fails at once with "database table is locked",
+    so the concurrency tests could not have their threads' requests wait for each other.
+    It is kept in a file instead, in WAL mode and with a busy timeout, and transactions
+    take the write lock when they begin (Django 5.1's "transaction_mode": "IMMEDIATE"):
+    a deferred one whose first write goes through the search index triggers (s3
+    migration 0018) reads first and fails with "database is locked" rather than waiting.
+    """
+    from django.conf import settings
+
+    for database in settings.DATABASES.values():
+        if database["ENGINE"] == "django.db.backends.sqlite3":
+            database.setdefault("TEST", {})["NAME"] = str(tmp_path_factory.mktemp("db") / "test.sqlite3")
+            database.setdefault("OPTIONS", {}).setdefault("timeout", 30)
+    connection_created.connect(use_wal)
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(SQLiteDatabaseWrapper, "_start_transaction_under_autocommit", begin_immediate)
+        yield
+
+
+@pytest.fixture
+def async_views(settings):
+    """Route the async views, as settings.ASYNC_VIEWS does under ASGI."""
+    settings.ASYNC_VIEWS = True
+    reload_urls()
+    yield
+    del settings.ASYNC_VIEWS
+    reload_urls()
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    """A PublicMediaStorage on a moto bucket, used for the report files."""
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="spotz")
+        storage = PublicMediaStorage(bucket_name="spotz")
+        monkeypatch.setattr(Upload._meta.get_field("file"), "storage", storage)
+        yield storage
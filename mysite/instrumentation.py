@@ -0,0 +1,153 @@
+import contextvars
+import json
+import threading
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends import django as django_backend
+
+# Per-request cost accounting, switched on with settings.REQUEST_INSTRUMENTATION = True
+# and RequestTimingMiddleware at the top of MIDDLEWARE. For every request it records the
+# SQL query count and time, the S3 call count and time (PublicMediaStorage registers
+# hooks on its boto3 clients), the template render time and the total time. They are
+# sent back in a Server-Timing header, so they show up in the browser's network panel,
+# and appended as one JSON line per request to settings.REQUEST_INSTRUMENTATION_LOG,
+# which the request_timings command summarises.
+#
+# When the setting is off the middleware removes itself (MiddlewareNotUsed) and nothing
+# is hooked, so there is no per-request cost.
+
+current = contextvars.ContextVar('request_metrics', default=None)
+log_lock = threading.Lock()
+
+
+def enabled():
+    return getattr(settings, 'REQUEST_INSTRUMENTATION', False)
+
+
+def log_path():
+    return getattr(settings, 'REQUEST_INSTRUMENTATION_LOG', 'request-timings.jsonl')
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.s3_calls = 0
+        self.s3_time = 0.0
+        self.template_time = 0.0
+
+    def sample(self, view):
+        return {
+            'view': view,
+            'total_ms': round((time.perf_counter() - self.started) * 1e3, 3),
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1e3, 3),
+            's3_calls': self.s3_calls,
+            's3_ms': round(self.s3_time * 1e3, 3),
+            'template_ms': round(self.template_time * 1e3, 3),
+        }
+
+
+def server_timing(sample):
+    return ', '.join([
+        'db;dur=%.1f;desc="%d queries"' % (sample['db_ms'], sample['queries']),
+        's3;dur=%.1f;desc="%d calls"' % (sample['s3_ms'], sample['s3_calls']),
+        'tpl;dur=%.1f' % sample['template_ms'],
+        'total;dur=%.1f' % sample['total_ms'],
+    ])
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - start
+
+
+def s3_call_started(context, **kwargs):
+    if current.get() is not None:
+        context['instrumentation_started'] = time.perf_counter()
+
+
+def s3_call_finished(context, **kwargs):
+    metrics = current.get()
+    started = context.pop('instrumentation_started', None)
+    if metrics is not None and started is not None:
+        metrics.s3_calls += 1
+        metrics.s3_time += time.perf_counter() - started
+
+
+def instrument_s3_client(client):
+    """Count and time the API calls of a boto3 S3 client. Safe to call more than once."""
+    if getattr(client, 'request_instrumentation', False):
+        return
+    client.meta.events.register('before-call.s3', s3_call_started)
+    client.meta.events.register('after-call.s3', s3_call_finished)
+    client.meta.events.register('after-call-error.s3', s3_call_finished)
+    client.request_instrumentation = True
+
+
+def instrument_templates():
+    # Only the backend Template is wrapped, i.e. each render()/render_to_string() call;
+    # {% include %} and {% extends %} happen inside it and are not counted twice.
+    render = django_backend.Template.render
+    if getattr(render, 'instrumented', False):
+        return
+
+    def timed_render(self, context=None, request=None):
+        metrics = current.get()
+        if metrics is None:
+            return render(self, context, request)
+        start = time.perf_counter()
+        try:
+            return render(self, context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+    timed_render.instrumented = True
+    django_backend.Template.render = timed_render
+
+
+def write_sample(sample):
+    line = json.dumps(sample) + '\n'
+    with log_lock, open(log_path(), 'a') as log:
+        log.write(line)
+
+
+def read_samples(path):
+    with open(path) as log:
+        return [json.loads(line) for line in log if line.strip()]
+
+
+class RequestTimingMiddleware:
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        instrument_templates()
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(record_query))
+                response = self.get_response(request)
+        finally:
+            current.reset(token)
+        match = request.resolver_match
+        sample = metrics.sample(match.view_name if match else request.path)
+        response['Server-Timing'] = server_timing(sample)
+        write_sample(sample)
+        return response
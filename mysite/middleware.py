@@ -0,0 +1,31 @@
+from allauth.account.middleware import AccountMiddleware as AllauthAccountMiddleware
+from allauth.core import context
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+# django-allauth's AccountMiddleware (as of 0.57) is sync-only, so under ASGI Django runs
+# it, and every middleware below it, on a thread for each request and awaits the async
+# views from there. This is the same middleware with an async path as well: list it in
+# MIDDLEWARE in place of allauth.account.middleware.AccountMiddleware. Under WSGI it
+# behaves exactly like allauth's.
+
+
+class AccountMiddleware(AllauthAccountMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        with context.request_context(request):
+            response = await self.get_response(request)
+            # Reads the session, which may not be loaded yet.
+            await sync_to_async(self._remove_dangling_login)(request, response)
+            return response
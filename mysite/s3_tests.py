@@ -6,10 +6,28 @@ from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
 import boto3
 from botocore.stub import Stubber
-from s3.models import Upload
+from s3.models import Upload, ProcessingJob, DeletedObject, StoredObject, UploadSession, SUPPORTED_MIME_TYPES
+from s3 import processing, previews, deletion, dedup, search, resumable, export
+import hashlib
+from PIL import Image
+import pypdfium2
+from django.core.management import call_command
+from django.utils import timezone
 import io
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from moto import mock_aws
+from mysite.storage_backends import PublicMediaStorage
+from s3.upload_handlers import S3MultipartUploadHandler, PART_SIZE
+from s3.mime import MimeDetector, sniff_mime_type
+import magic
+import threading
+import zipfile
+import json
+import csv
+from storages.backends.s3boto3 import S3Boto3Storage
+from mysite import instrumentation
 
 
 class TestUpload():
@@ -110,4 +128,760 @@ class UploadModelTestCase(TestCase):
             None
         )
         with self.assertRaises(ValidationError):
-            Upload.validate_mime_type(large_file)
\ No newline at end of file
+            Upload.validate_mime_type(large_file)
+
+
+class TestS3MultipartUploadHandler():
+    def stream(self, handler, name, content, chunk_size=64 * 1024):
+        try:
+            handler.new_file("file", name, "application/octet-stream", None)
+        except StopFutureHandlers:
+            pass
+        for start in range(0, len(content), chunk_size):
+            handler.receive_data_chunk(content[start:start + chunk_size], start)
+        return handler.file_complete(len(content))
+
+    def in_progress_uploads(self, storage):
+        return storage.connection.meta.client.list_multipart_uploads(Bucket="spotz").get("Uploads", [])
+
+    @pytest.mark.django_db
+    def test_small_file_is_stored(self, storage):
+        content = b"Testing text file content"
+        streamed = self.stream(S3MultipartUploadHandler(None, storage), "file.txt", content)
+        assert streamed.stored_name.startswith("uploads/") and streamed.stored_name.endswith("/file.txt")
+        assert streamed.size == len(content)
+        assert storage.open(streamed.stored_name).read() == content
+
+    @pytest.mark.django_db
+    def test_same_file_name_gets_separate_objects(self, storage):
+        first = self.stream(S3MultipartUploadHandler(None, storage), "evidence.txt", b"First report")
+        second = self.stream(S3MultipartUploadHandler(None, storage), "evidence.txt", b"Second report")
+        assert first.stored_name != second.stored_name
+        assert storage.open(first.stored_name).read() == b"First report"
+        assert storage.open(second.stored_name).read() == b"Second report"
+
+    @pytest.mark.django_db
+    def test_large_file_is_streamed_in_parts(self, storage):
+        content = b"%PDF-1.4\n" + b"A" * (PART_SIZE + 1024)
+        handler = S3MultipartUploadHandler(None, storage)
+        streamed = self.stream(handler, "large.pdf", content)
+        assert len(handler.parts) == 2
+        assert storage.open(streamed.stored_name).read() == content
+        assert self.in_progress_uploads(storage) == []
+
+    def test_unsupported_file_is_rejected(self, storage):
+        content = b"PK\x03\x04\n" + b"A" * 4096
+        streamed = self.stream(S3MultipartUploadHandler(None, storage), "test.zip", content)
+        assert streamed.stored_name is None
+        assert not storage.exists("test.zip")
+        with pytest.raises(ValidationError):
+            Upload.validate_mime_type(streamed)
+
+    def test_oversized_file_is_aborted(self, storage):
+        content = b"%PDF-1.4\n" + b"A" * (1024 * 1024 * 11)
+        streamed = self.stream(S3MultipartUploadHandler(None, storage), "large.pdf", content)
+        assert streamed.stored_name is None
+        assert streamed.size == len(content)
+        assert not storage.exists("large.pdf")
+        assert self.in_progress_uploads(storage) == []
+        with pytest.raises(ValidationError):
+            Upload.validate_mime_type(streamed)
+
+    def test_unsupported_file_never_reaches_bucket(self, storage):
+        # The Stubber fails on any request to the bucket.
+        with Stubber(storage.connection.meta.client) as stubber:
+            self.stream(S3MultipartUploadHandler(None, storage), "test.zip", b"PK\x03\x04\n" + b"A" * 4096)
+            stubber.assert_no_pending_responses()
+
+    @pytest.mark.django_db
+    def test_submission_is_streamed_to_bucket(self, storage):
+        client = Client()
+        pdf_file = SimpleUploadedFile("file.pdf", b"%PDF-1.4\nTesting pdf content", content_type="application/pdf")
+        response = client.post(reverse("s3:submission_page"), {"title": "Report", "user_comment": "Details", "file": pdf_file, "priority": 2})
+        assert response.status_code == 302
+        uploaded_file = Upload.objects.get()
+        assert uploaded_file.file.name.startswith("uploads/") and uploaded_file.file.name.endswith("/file.pdf")
+        assert storage.open(uploaded_file.file.name).read() == b"%PDF-1.4\nTesting pdf content"
+
+
+class TestDirectUpload():
+    def presign(self, client, filename, content_type):
+        return client.post(reverse("s3:presign_upload"), {"filename": filename, "content_type": content_type})
+
+    @pytest.mark.django_db
+    def test_presign_limits_type_and_size(self, storage):
+        client = Client()
+        response = self.presign(client, "file.pdf", "application/pdf")
+        assert response.status_code == 200
+        assert response.json()["fields"]["Content-Type"] == "application/pdf"
+        assert response.json()["name"].endswith("/file.pdf")
+
+        response = self.presign(client, "file.zip", "application/zip")
+        assert response.status_code == 400
+
+    @pytest.mark.django_db
+    def test_finalize_creates_upload(self, storage):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        name = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        storage.save(name, ContentFile(b"%PDF-1.4\nTesting pdf content"))
+
+        response = client.post(reverse("s3:finalize_upload"),
+                               {"name": name, "title": "Report", "user_comment": "Details", "priority": 3})
+        assert response.status_code == 200
+        assert response.json()["redirect"] == reverse("s3:submit")
+        uploaded_file = Upload.objects.get()
+        assert uploaded_file.file.name == name
+        assert uploaded_file.user == user
+        assert uploaded_file.priority == 3
+
+    @pytest.mark.django_db
+    def test_finalize_rejects_unsupported_content(self, storage):
+        client = Client()
+        name = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        storage.save(name, ContentFile(b"PK\x03\x04\n..."))
+
+        response = client.post(reverse("s3:finalize_upload"),
+                               {"name": name, "title": "Report", "user_comment": "Details", "priority": 3})
+        assert response.status_code == 400
+        assert not storage.exists(name)
+        assert not Upload.objects.exists()
+
+    @pytest.mark.django_db
+    def test_finalize_without_uploaded_file(self, storage):
+        client = Client()
+        name = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        fields = {"name": name, "title": "Report", "user_comment": "Details", "priority": 3}
+        response = client.post(reverse("s3:finalize_upload"), fields)
+        assert response.status_code == 404
+        assert response.json()["error"] == "The file was not uploaded."
+        storage.save(name, ContentFile(b""))
+        assert client.post(reverse("s3:finalize_upload"), fields).status_code == 400
+        assert not Upload.objects.exists()
+
+    @pytest.mark.django_db
+    def test_finalize_requires_presigned_name(self, storage):
+        client = Client()
+        storage.save("direct/other/file.pdf", ContentFile(b"%PDF-1.4\nTesting pdf content"))
+        response = client.post(reverse("s3:finalize_upload"),
+                               {"name": "direct/other/file.pdf", "title": "Report", "user_comment": "Details", "priority": 3})
+        assert response.status_code == 403
+        assert not Upload.objects.exists()
+
+    @pytest.mark.django_db
+    def test_async_finalize(self, storage, async_views):
+        from s3 import views
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        name = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        storage.save(name, ContentFile(b"%PDF-1.4\nTesting pdf content"))
+        rejected = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        storage.save(rejected, ContentFile(b"PK\x03\x04\n..."))
+
+        fields = {"title": "Report", "user_comment": "Details", "priority": 3}
+        response = client.post(reverse("s3:finalize_upload"), {"name": rejected, **fields})
+        assert response.resolver_match.func is views.afinalize_upload
+        assert response.status_code == 400
+        assert not storage.exists(rejected)
+        missing = self.presign(client, "file.pdf", "application/pdf").json()["name"]
+        assert client.post(reverse("s3:finalize_upload"), {"name": missing, **fields}).status_code == 404
+        response = client.post(reverse("s3:finalize_upload"), {"name": name, **fields})
+        assert response.status_code == 200
+        assert Upload.objects.get().user == user
+        assert name not in client.session[views.DIRECT_UPLOAD_SESSION_KEY]
+        assert client.get(reverse("s3:finalize_upload")).status_code == 405
+
+
+class TestResumableUpload():
+    def start(self, client, size, filename="file.pdf"):
+        return client.post(reverse("s3:start_resumable_upload"), {"filename": filename, "size": size})
+
+    def put_chunk(self, client, session_id, index, data):
+        return client.put(reverse("s3:upload_chunk", args=[session_id, index]), data=data,
+                          content_type="application/octet-stream")
+
+    @pytest.mark.django_db
+    def test_chunks_resume_and_assemble(self, storage):
+        client = Client()
+        content = b"%PDF-1.4\n" + b"A" * (resumable.CHUNK_SIZE + 1024)
+        chunks = [content[:resumable.CHUNK_SIZE], content[resumable.CHUNK_SIZE:]]
+        response = self.start(client, len(content))
+        assert response.status_code == 201
+        session_id = response.json()["id"]
+        assert response.json()["chunk_count"] == 2
+
+        # Chunks may arrive out of order and be sent again after a dropped connection.
+        assert self.put_chunk(client, session_id, 1, chunks[1]).status_code == 200
+        assert self.put_chunk(client, session_id, 1, chunks[1]).status_code == 200
+        status = client.get(reverse("s3:resumable_upload_status", args=[session_id])).json()
+        assert status["received"] == [1]
+        response = client.post(reverse("s3:complete_resumable_upload", args=[session_id]),
+                               {"title": "Report", "user_comment": "Details", "priority": 2})
+        assert response.status_code == 400
+        assert not Upload.objects.exists()
+
+        assert self.put_chunk(client, session_id, 0, chunks[0]).status_code == 200
+        response = client.post(reverse("s3:complete_resumable_upload", args=[session_id]),
+                               {"title": "Report", "user_comment": "Details", "priority": 2})
+        assert response.status_code == 200
+        upload = Upload.objects.get()
+        assert upload.file.name.startswith("resumable/") and upload.file.name.endswith("/file.pdf")
+        assert storage.open(upload.file.name).read() == content
+        assert UploadSession.objects.get().state == "Completed"
+
+    @pytest.mark.django_db
+    def test_chunk_must_have_exact_size(self, storage):
+        client = Client()
+        session_id = self.start(client, 100).json()["id"]
+        assert self.put_chunk(client, session_id, 0, b"%PDF-1.4\n").status_code == 400
+        assert self.put_chunk(client, session_id, 1, b"A" * 100).status_code == 400
+
+    @pytest.mark.django_db
+    def test_unsupported_type_aborts_upload(self, storage):
+        client = Client()
+        content = b"PK\x03\x04\n..."
+        session_id = self.start(client, len(content), filename="file.pdf").json()["id"]
+        assert self.put_chunk(client, session_id, 0, content).status_code == 400
+        assert UploadSession.objects.get().state == "Aborted"
+        assert storage.connection.meta.client.list_multipart_uploads(Bucket="spotz").get("Uploads", []) == []
+
+    @pytest.mark.django_db
+    def test_size_limit(self, storage, settings):
+        settings.RESUMABLE_MAX_UPLOAD_SIZE = 1024
+        assert self.start(Client(), 1025).status_code == 400
+        assert self.start(Client(), 1024).status_code == 201
+
+    @pytest.mark.django_db
+    def test_sessions_are_private(self, storage):
+        owner = Client()
+        session_id = self.start(owner, 100).json()["id"]
+        other = Client()
+        assert other.get(reverse("s3:resumable_upload_status", args=[session_id])).status_code == 404
+        assert self.put_chunk(other, session_id, 0, b"%PDF-1.4\n" + b"A" * 91).status_code == 404
+
+        User.objects.create_user(username="testuser", password="12345")
+        User.objects.create_user(username="otheruser", password="12345")
+        owner.login(username="testuser", password="12345")
+        session_id = self.start(owner, 100).json()["id"]
+        assert UploadSession.objects.get(pk=session_id).user.username == "testuser"
+        other.login(username="otheruser", password="12345")
+        assert other.get(reverse("s3:resumable_upload_status", args=[session_id])).status_code == 404
+        assert owner.get(reverse("s3:resumable_upload_status", args=[session_id])).status_code == 200
+
+    @pytest.mark.django_db
+    def test_abandoned_uploads_collected(self, storage):
+        client = Client()
+        stale_id = self.start(client, 100).json()["id"]
+        fresh_id = self.start(client, 100).json()["id"]
+        UploadSession.objects.filter(pk=stale_id).update(updated_at=timezone.now() - resumable.SESSION_TTL * 2)
+
+        output = io.StringIO()
+        call_command("gc_upload_sessions", stdout=output)
+        assert "Aborted 1 abandoned upload(s)" in output.getvalue()
+        assert not UploadSession.objects.filter(pk=stale_id).exists()
+        assert UploadSession.objects.get(pk=fresh_id).state == "Open"
+        uploads = storage.connection.meta.client.list_multipart_uploads(Bucket="spotz").get("Uploads", [])
+        assert len(uploads) == 1
+
+
+class TestMimeDetector():
+    def test_fast_path_agrees_with_libmagic(self):
+        libmagic = magic.Magic(mime=True)
+        for head in [b"%PDF-1.4\n...", b"\xff\xd8\xff\xe0\x00\x10JFIF"]:
+            assert sniff_mime_type(head) == libmagic.from_buffer(head)
+
+    def test_fast_path_leaves_other_content_to_libmagic(self):
+        for head in [b"PK\x03\x04\n...", b"<html><body></body></html>", b"#!/bin/sh\necho", b"\x00\x01binary", b"",
+                     b"Testing text file content"]:
+            assert sniff_mime_type(head) is None
+        assert MimeDetector().from_buffer(b"<html><body></body></html>") == "text/html"
+
+    def test_text_like_content_accepted_only_as_plain_text(self):
+        detector = MimeDetector()
+        for head in [b"Testing text file content", "Café report\n".encode() * 300,
+                     b"I would like to report the following incident.\n" * 42]:
+            assert detector.from_buffer(head) == "text/plain"
+        for head in [b"def main():\n    return 1\n", b"#!/bin/sh\necho", b"From: a@b.c\nSubject: x\n\nhi",
+                     b'{"a": 1}', b"<html><body></body></html>"]:
+            assert detector.from_buffer(head) not in SUPPORTED_MIME_TYPES
+
+    def test_handle_is_reused_per_thread(self):
+        detector = MimeDetector()
+        handle = detector.handle()
+        assert detector.handle() is handle
+        other = []
+        thread = threading.Thread(target=lambda: other.append(detector.handle()))
+        thread.start()
+        thread.join()
+        assert other[0] is not handle
+
+
+processed_uploads = []
+
+def record_processor(upload):
+    processed_uploads.append(upload.pk)
+
+def failing_processor(upload):
+    raise RuntimeError("preview generation failed")
+
+
+class TestProcessingQueue():
+    @pytest.fixture(autouse=True)
+    def processors(self, settings):
+        processed_uploads.clear()
+        settings.UPLOAD_PROCESSORS = ["mysite.s3_tests.record_processor"]
+
+    @pytest.mark.django_db
+    def test_submission_queues_processing(self):
+        client = Client()
+        txt_file = SimpleUploadedFile("file.txt", b"Testing text file content", content_type="text/plain")
+        response = client.post(reverse("s3:submission_page"),
+                               {"title": "Report", "user_comment": "Details", "file": txt_file, "priority": 1})
+        assert response.status_code == 302
+        uploaded_file = Upload.objects.get()
+        assert uploaded_file.processing_status == "Queued"
+        assert uploaded_file.processing_jobs.get().state == "Queued"
+        assert processed_uploads == []
+
+    @pytest.mark.django_db
+    def test_worker_processes_queued_uploads(self):
+        uploads = [Upload.objects.create() for _ in range(3)]
+        for upload in uploads:
+            processing.enqueue(upload)
+
+        call_command("process_uploads", "--once", "--batch-size", "2")
+        assert sorted(processed_uploads) == [upload.pk for upload in uploads]
+        assert set(Upload.objects.values_list("processing_status", flat=True)) == {"Done"}
+        assert set(ProcessingJob.objects.values_list("state", flat=True)) == {"Done"}
+
+    @pytest.mark.django_db
+    def test_failed_job_is_retried_with_backoff(self, settings):
+        settings.UPLOAD_PROCESSORS = ["mysite.s3_tests.failing_processor"]
+        upload = Upload.objects.create()
+        processing.enqueue(upload)
+
+        assert processing.process_batch("worker-1") == 1
+        job = ProcessingJob.objects.get()
+        assert job.state == "Queued"
+        assert job.attempts == 1
+        assert "preview generation failed" in job.last_error
+        assert job.available_at > timezone.now()
+        assert Upload.objects.get(pk=upload.pk).processing_status == "Queued"
+        # Not ready again until the backoff has passed.
+        assert processing.process_batch("worker-1") == 0
+
+        for attempt in range(processing.MAX_ATTEMPTS - 1):
+            ProcessingJob.objects.update(available_at=timezone.now())
+            processing.process_batch("worker-1")
+        assert ProcessingJob.objects.get().state == "Failed"
+        assert Upload.objects.get(pk=upload.pk).processing_status == "Failed"
+
+    @pytest.mark.django_db
+    def test_jobs_of_dead_workers_are_reclaimed(self):
+        upload = Upload.objects.create()
+        processing.enqueue(upload)
+        assert len(processing.claim_jobs("worker-1", 10)) == 1
+        assert processing.claim_jobs("worker-2", 10) == []
+
+        ProcessingJob.objects.update(locked_at=timezone.now() - processing.LEASE_TIMEOUT * 2)
+        assert processing.process_batch("worker-2") == 1
+        assert processed_uploads == [upload.pk]
+
+
+class TestPreviews():
+    def jpeg(self, size):
+        output = io.BytesIO()
+        Image.new("RGB", size, "red").save(output, "JPEG")
+        return output.getvalue()
+
+    def pdf(self):
+        document = pypdfium2.PdfDocument.new()
+        document.new_page(612, 792)
+        output = io.BytesIO()
+        document.save(output)
+        return output.getvalue()
+
+    @pytest.mark.django_db
+    def test_image_preview_is_bounded(self):
+        upload = Upload.objects.create(file=SimpleUploadedFile("photo.jpg", self.jpeg((3000, 2000))))
+        assert previews.generate_preview(upload)
+        with Image.open(Upload.objects.get(pk=upload.pk).preview) as preview:
+            assert max(preview.size) <= max(previews.PREVIEW_SIZE)
+            assert preview.format == "JPEG"
+
+    @pytest.mark.django_db
+    def test_pdf_preview_renders_first_page(self):
+        upload = Upload.objects.create(file=SimpleUploadedFile("report.pdf", self.pdf()))
+        assert previews.generate_preview(upload)
+        assert upload.has_image_preview
+        with Image.open(upload.preview) as preview:
+            assert preview.size[1] <= previews.PREVIEW_SIZE[1]
+
+    @pytest.mark.django_db
+    def test_text_preview_is_truncated(self):
+        upload = Upload.objects.create(file=SimpleUploadedFile("notes.txt", b"A" * 10000))
+        assert previews.generate_preview(upload)
+        assert not upload.has_image_preview
+        assert upload.preview.read() == b"A" * previews.TEXT_EXCERPT_SIZE + b"\n[...]"
+
+    @pytest.mark.django_db
+    def test_unsupported_file_has_no_preview(self):
+        upload = Upload.objects.create(file=SimpleUploadedFile("archive.zip", b"PK\x03\x04"))
+        assert not previews.generate_preview(upload)
+        assert not upload.preview
+
+    @pytest.mark.django_db
+    def test_renderer_follows_content_not_name(self):
+        upload = Upload.objects.create(file=SimpleUploadedFile("notes.pdf", b"Plain text, not a PDF"))
+        assert previews.generate_preview(upload)
+        assert upload.preview.read() == b"Plain text, not a PDF"
+
+    @pytest.mark.django_db
+    def test_detail_page_shows_preview_by_its_kind(self):
+        User.objects.create_user(username="staffuser", password="12345", is_staff=True)
+        client = Client()
+        client.login(username="staffuser", password="12345")
+        # A .txt name holding a JPEG gets an image preview, and a .jpg name holding text a text one.
+        image = Upload.objects.create(file=SimpleUploadedFile("photo.txt", self.jpeg((300, 200))))
+        text = Upload.objects.create(file=SimpleUploadedFile("notes.jpg", b"Plain text"))
+        for upload in (image, text):
+            assert previews.generate_preview(upload)
+
+        assert b'<img src="%s"' % reverse("login:upload_preview", args=[image.pk]).encode() in \
+            client.get(reverse("login:upload_detail", args=[image.pk])).content
+        assert b'<iframe src="%s"' % reverse("login:upload_preview", args=[text.pk]).encode() in \
+            client.get(reverse("login:upload_detail", args=[text.pk])).content
+
+    @pytest.mark.django_db
+    def test_truncated_files_get_no_preview(self, settings):
+        settings.UPLOAD_PROCESSORS = processing.DEFAULT_PROCESSORS
+        uploads = [
+            Upload.objects.create(file=SimpleUploadedFile("report.pdf", self.pdf()[:200])),
+            Upload.objects.create(file=SimpleUploadedFile("photo.jpg", self.jpeg((300, 200))[:300])),
+        ]
+        for upload in uploads:
+            processing.enqueue(upload)
+        call_command("process_uploads", "--once")
+        for upload in uploads:
+            upload.refresh_from_db()
+            assert upload.processing_status == "Done"
+            assert not upload.preview
+
+        client = Client()
+        User.objects.create_user(username="staffuser", password="12345", is_staff=True)
+        client.login(username="staffuser", password="12345")
+        response = client.get(reverse("login:upload_preview", args=[uploads[0].pk]))
+        assert response.status_code == 302 and response.url == uploads[0].file.url
+
+
+class TestStorageUrlCache():
+    @pytest.fixture
+    def storage(self, monkeypatch):
+        self.signed = []
+        original_url = S3Boto3Storage.url
+        def counting_url(storage, name, *args, **kwargs):
+            self.signed.append(name)
+            return original_url(storage, name, *args, **kwargs)
+        monkeypatch.setattr(S3Boto3Storage, "url", counting_url)
+        with mock_aws():
+            yield PublicMediaStorage(bucket_name="spotz")
+
+    def test_url_is_signed_once(self, storage):
+        url = storage.url("file.pdf")
+        assert storage.url("file.pdf") == url
+        assert self.signed == ["file.pdf"]
+
+    def test_urls_signs_only_missing_names(self, storage):
+        storage.url("a.pdf")
+        urls = storage.urls(["a.pdf", "b.pdf", "c.pdf"])
+        assert set(urls) == {"a.pdf", "b.pdf", "c.pdf"}
+        assert self.signed == ["a.pdf", "b.pdf", "c.pdf"]
+
+    def test_url_is_regenerated_before_signature_expires(self, storage):
+        storage.url_cache_margin = storage.querystring_expire
+        storage.url("file.pdf")
+        storage.url("file.pdf")
+        assert self.signed == ["file.pdf", "file.pdf"]
+
+    def test_least_recently_used_urls_are_evicted(self, storage):
+        storage.url_cache_size = 2
+        storage.urls(["a.pdf", "b.pdf"])
+        storage.url("a.pdf")
+        storage.url("c.pdf")
+        assert list(storage.url_cache) == ["a.pdf", "c.pdf"]
+
+    def test_custom_urls_are_not_cached(self, storage):
+        storage.url("file.pdf", parameters={"ResponseContentDisposition": "attachment"})
+        assert "file.pdf" not in storage.url_cache
+
+
+class TestStorageInstrumentation():
+    def test_s3_calls_counted_for_current_request(self, settings, storage):
+        settings.REQUEST_INSTRUMENTATION = True
+        storage.save("file.txt", ContentFile(b"report"))
+        metrics = instrumentation.RequestMetrics()
+        token = instrumentation.current.set(metrics)
+        try:
+            assert storage.exists("file.txt")
+            storage.read_head("file.txt", 4)
+        finally:
+            instrumentation.current.reset(token)
+        assert metrics.s3_calls == 2
+        assert metrics.s3_time > 0
+
+
+class TestDeletionOutbox():
+    def test_delete_many_batches_requests(self, storage):
+        storage.delete_batch_size = 2
+        names = [storage.save("file%d.txt" % i, ContentFile(b"report")) for i in range(5)]
+        with Stubber(storage.connection.meta.client) as stubber:
+            for batch in (names[0:2], names[2:4], names[4:5]):
+                stubber.add_response("delete_objects", {}, {
+                    "Bucket": "spotz", "Delete": {"Objects": [{"Key": "media/" + name} for name in batch], "Quiet": True},
+                })
+            assert storage.delete_many(names) == {}
+            stubber.assert_no_pending_responses()
+
+    @pytest.mark.django_db
+    def test_drain_deletes_queued_files(self, storage):
+        names = [storage.save("file%d.txt" % i, ContentFile(b"report")) for i in range(3)]
+        deletion.schedule(names + [""])
+        assert deletion.drain() == (3, 0)
+        assert not any(storage.exists(name) for name in names)
+        assert not DeletedObject.objects.exists()
+
+    @pytest.mark.django_db
+    def test_drain_retries_failed_deletions(self, storage):
+        deletion.schedule(["kept.txt", "gone.txt"])
+        with Stubber(storage.connection.meta.client) as stubber:
+            stubber.add_response("delete_objects", {
+                "Errors": [{"Key": "media/kept.txt", "Code": "AccessDenied", "Message": "Access Denied"}],
+            })
+            assert deletion.drain() == (1, 1)
+        entry = DeletedObject.objects.get()
+        assert entry.name == "kept.txt"
+        assert entry.attempts == 1
+        assert "AccessDenied" in entry.last_error
+        assert entry.available_at > timezone.now()
+        assert deletion.drain() == (0, 0)
+
+    @pytest.mark.django_db
+    def test_delete_view_queues_files(self, storage):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, file=SimpleUploadedFile("file.txt", b"Testing text file content"))
+        with Stubber(storage.connection.meta.client):
+            # Any S3 call during the request would fail on the empty stubber.
+            response = client.post(reverse('login:delete', args=[uploaded_file.pk]))
+        assert response.status_code == 302
+        assert list(DeletedObject.objects.values_list("name", flat=True)) == [uploaded_file.file.name]
+        call_command("process_deletions", "--once", stdout=io.StringIO())
+        assert not storage.exists(uploaded_file.file.name)
+
+    @pytest.mark.django_db
+    def test_reconcile_finds_orphans_and_missing_files(self, storage):
+        user = User.objects.create_user(username='testuser', password='12345')
+        kept = Upload.objects.create(user=user, file=SimpleUploadedFile("kept.txt", b"Testing text file content"))
+        missing = Upload.objects.create(user=user, file="missing.txt")
+        storage.save("orphan.txt", ContentFile(b"left behind"))
+        output = io.StringIO()
+        call_command("reconcile_storage", "--min-age", "0", "--delete-orphans", stdout=output)
+        assert "orphaned file: orphan.txt" in output.getvalue()
+        assert "report %s: missing file missing.txt" % missing.pk in output.getvalue()
+        assert kept.file.name not in output.getvalue()
+        assert list(DeletedObject.objects.values_list("name", flat=True)) == ["orphan.txt"]
+
+
+class TestDeduplication():
+    def submit(self, client, content, name="file.pdf"):
+        pdf_file = SimpleUploadedFile(name, content, content_type="application/pdf")
+        return client.post(reverse("s3:submission_page"),
+                           {"title": "Report", "user_comment": "Details", "file": pdf_file, "priority": 2})
+
+    def stored_keys(self, storage):
+        response = storage.connection.meta.client.list_objects_v2(Bucket="spotz")
+        return sorted(entry["Key"] for entry in response.get("Contents", []))
+
+    @pytest.mark.django_db
+    def test_identical_submissions_share_one_object(self, storage):
+        client = Client()
+        content = b"%PDF-1.4\nTesting pdf content"
+        self.submit(client, content)
+        self.submit(client, content, name="copy.pdf")
+        first, second = Upload.objects.order_by("id")
+        assert first.sha256 == second.sha256 == hashlib.sha256(content).hexdigest()
+        assert first.file.name == second.file.name
+        assert self.stored_keys(storage) == ["media/" + first.file.name]
+        assert StoredObject.objects.get().references == 2
+        assert list(dedup.duplicates(first)) == [second]
+
+    @pytest.mark.django_db
+    def test_large_duplicate_aborts_multipart_upload(self, storage):
+        client = Client()
+        content = b"%PDF-1.4\n" + b"A" * (PART_SIZE + 1024)
+        self.submit(client, content)
+        self.submit(client, content, name="copy.pdf")
+        assert self.stored_keys(storage) == ["media/" + Upload.objects.first().file.name]
+        assert storage.connection.meta.client.list_multipart_uploads(Bucket="spotz").get("Uploads", []) == []
+
+    @pytest.mark.django_db
+    def test_shared_object_deleted_with_last_reference(self, storage):
+        client = Client()
+        user = User.objects.create_user(username="testuser", password="12345")
+        client.login(username="testuser", password="12345")
+        content = b"%PDF-1.4\nTesting pdf content"
+        self.submit(client, content)
+        self.submit(client, content, name="copy.pdf")
+        first, second = Upload.objects.order_by("id")
+        assert first.user == second.user == user
+
+        client.post(reverse("login:delete", args=[first.pk]))
+        deletion.drain()
+        assert storage.exists(first.file.name)
+        assert StoredObject.objects.get().references == 1
+
+        client.post(reverse("login:delete", args=[second.pk]))
+        deletion.drain()
+        assert not storage.exists(first.file.name)
+        assert not StoredObject.objects.exists()
+
+    @pytest.mark.django_db
+    def test_direct_upload_deduplicated_by_processing(self, storage):
+        user = User.objects.create_user(username="testuser", password="12345")
+        content = b"%PDF-1.4\nTesting pdf content"
+        self.submit(Client(), content)
+        submitted = Upload.objects.get()
+        storage.save("direct/abc/file.pdf", ContentFile(content))
+        direct = Upload.objects.create(user=user, file="direct/abc/file.pdf")
+
+        dedup.deduplicate_upload(direct)
+        direct.refresh_from_db()
+        assert direct.file.name == submitted.file.name
+        assert StoredObject.objects.get().references == 2
+        assert list(DeletedObject.objects.values_list("name", flat=True)) == ["direct/abc/file.pdf"]
+
+    @pytest.mark.django_db
+    def test_staff_see_reports_with_identical_evidence(self, storage):
+        client = Client()
+        content = b"%PDF-1.4\nTesting pdf content"
+        self.submit(client, content)
+        self.submit(client, content, name="copy.pdf")
+        first, second = Upload.objects.order_by("id")
+        User.objects.create_user(username="staffuser", password="12345", is_staff=True)
+        client.login(username="staffuser", password="12345")
+        response = client.get(reverse("login:upload_detail", args=[first.pk]))
+        assert list(response.context["duplicate_reports"]) == [second]
+
+
+class TestSearchExtraction():
+    @pytest.mark.django_db
+    def test_text_and_pdf_content_is_searchable(self):
+        txt_file = SimpleUploadedFile("file.txt", b"The shredder logs from March", content_type="text/plain")
+        text_upload = Upload.objects.create(title="Report", file=txt_file)
+        pdf = pypdfium2.PdfDocument.new()
+        pdf.new_page(200, 200)
+        output = io.BytesIO()
+        pdf.save(output)
+        pdf_upload = Upload.objects.create(title="Report", file=SimpleUploadedFile("file.pdf", output.getvalue()))
+
+        search.extract_text(text_upload)
+        search.extract_text(pdf_upload)
+        text_upload.refresh_from_db()
+        assert text_upload.extracted_text == "The shredder logs from March"
+        results, has_more = search.search("shredder march")
+        assert results == [text_upload] and not has_more
+
+    @pytest.mark.django_db
+    def test_triggers_restored_after_table_rebuild(self):
+        from django.db import connection
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER s3_upload_fts_insert")
+        Upload.objects.create(title="Bribery")
+        search.ensure_sqlite_triggers()
+        assert [u.title for u in search.search("bribery")[0]] == ["Bribery"]
+        Upload.objects.create(title="Bribery again")
+        assert len(search.search("bribery")[0]) == 2
+
+
+class TestExport():
+    def create(self, user, name, content, **fields):
+        upload = Upload(user=user, title=name, file=SimpleUploadedFile(name, content), **fields)
+        return dedup.save_upload(upload)
+
+    def archive(self, response):
+        assert response["Content-Type"] == "application/zip"
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    @pytest.mark.django_db
+    def test_export_streams_files_and_manifest(self, storage):
+        reporter = User.objects.create_user(username="testuser", password="12345")
+        pdf = self.create(reporter, "evidence.pdf", b"%PDF-1.4\nLedger", priority=5)
+        copy = self.create(reporter, "copy.pdf", b"%PDF-1.4\nLedger", priority=5)
+        notes = self.create(None, "notes.txt", b"Shredded on Friday " * 100, priority=5)
+        self.create(None, "other.txt", b"Low priority", priority=1)
+        User.objects.create_user(username="staffuser", password="12345", is_staff=True)
+        client = Client()
+        client.login(username="staffuser", password="12345")
+
+        archive = self.archive(client.get(reverse("login:export"), {"priority": 5, "status": "New"}))
+        assert archive.namelist() == [
+            "reports/%d/evidence.pdf" % pdf.pk, "reports/%d/evidence.pdf" % copy.pk,
+            "reports/%d/notes.txt" % notes.pk, "manifest.csv", "manifest.json",
+        ]
+        assert archive.read("reports/%d/evidence.pdf" % copy.pk) == b"%PDF-1.4\nLedger"
+        assert archive.getinfo("reports/%d/evidence.pdf" % pdf.pk).compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("reports/%d/notes.txt" % notes.pk).compress_type == zipfile.ZIP_DEFLATED
+        assert archive.read("reports/%d/notes.txt" % notes.pk) == b"Shredded on Friday " * 100
+        manifest = json.loads(archive.read("manifest.json"))
+        assert [row["id"] for row in manifest] == [pdf.pk, copy.pk, notes.pk]
+        assert manifest[2]["file"] == "reports/%d/notes.txt" % notes.pk
+        assert manifest[0]["sha256"] == hashlib.sha256(b"%PDF-1.4\nLedger").hexdigest()
+        rows = list(csv.DictReader(io.StringIO(archive.read("manifest.csv").decode())))
+        assert [row["title"] for row in rows] == ["evidence.pdf", "copy.pdf", "notes.txt"]
+
+    @pytest.mark.django_db
+    def test_export_selection_and_reporter_scope(self, storage):
+        reporter = User.objects.create_user(username="testuser", password="12345")
+        own = self.create(reporter, "own.txt", b"Mine")
+        other = self.create(None, "other.txt", b"Not mine")
+        client = Client()
+        assert client.get(reverse("login:export"))["Content-Type"].startswith("text/html")
+
+        client.login(username="testuser", password="12345")
+        archive = self.archive(client.get(reverse("login:export")))
+        assert [row["id"] for row in json.loads(archive.read("manifest.json"))] == [own.pk]
+        response = client.post(reverse("login:export"), {"selected": [other.pk]})
+        assert response["Content-Type"].startswith("text/html")
+
+        User.objects.create_user(username="staffuser", password="12345", is_staff=True)
+        client.login(username="staffuser", password="12345")
+        archive = self.archive(client.post(reverse("login:export"), {"selected": [other.pk], "priority": 3}))
+        assert archive.namelist() == ["reports/%d/other.txt" % other.pk, "manifest.csv", "manifest.json"]
+
+    @pytest.mark.django_db
+    def test_export_sends_bytes_before_last_fetch(self, storage, settings, monkeypatch):
+        settings.EXPORT_PREFETCH = 2
+        uploads = [self.create(None, "file%d.txt" % i, b"Report %d" % i) for i in range(4)]
+        storage.delete(uploads[1].file.name)
+        release = threading.Event()
+        in_flight = []
+        fetch = export.fetch
+
+        def slow_fetch(storage, name):
+            in_flight.append(name)
+            if name == uploads[-1].file.name:
+                release.wait(5)
+            return fetch(storage, name)
+
+        monkeypatch.setattr(export, "fetch", slow_fetch)
+        chunks = export.stream(storage, uploads)
+        first = next(chunks)
+        assert first.startswith(b"PK") and uploads[-1].file.name not in in_flight
+        release.set()
+        archive = zipfile.ZipFile(io.BytesIO(first + b"".join(chunks)))
+        assert archive.read("reports/%d/file3.txt" % uploads[3].pk) == b"Report 3"
+        assert "reports/%d/file1.txt" % uploads[1].pk not in archive.namelist()
+        assert json.loads(archive.read("manifest.json"))[1]["file"] == ""
@@ -1,7 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
 from django.conf import settings
 from storages.backends.s3boto3 import S3Boto3Storage
+from storages.utils import clean_name
+
+from mysite import instrumentation
 
 class PublicMediaStorage(S3Boto3Storage):
     location = 'media'
     default_acl = 'public-read'
-    file_overwrite = False
\ No newline at end of file
+    file_overwrite = False
+
+    # url() signs every call, and a queue page asks for hundreds of URLs. Generated URLs
+    # are kept per process and dropped url_cache_margin seconds before their signature
+    # expires; unsigned URLs are kept for url_cache_unsigned_ttl. The least recently
+    # used entries are evicted past url_cache_size.
+    url_cache_margin = 300
+    url_cache_unsigned_ttl = 3600
+    url_cache_size = 10000
+    # DeleteObjects accepts at most this many keys per request.
+    delete_batch_size = 1000
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.url_cache = OrderedDict()
+        self.url_cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state.pop('url_cache', None)
+        state.pop('url_cache_lock', None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.url_cache = OrderedDict()
+        self.url_cache_lock = threading.Lock()
+
+    @property
+    def connection(self):
+        connection = super().connection
+        if instrumentation.enabled():
+            instrumentation.instrument_s3_client(connection.meta.client)
+        return connection
+
+    def url(self, name, parameters=None, expire=None, http_method=None):
+        if parameters or expire is not None or http_method:
+            return super().url(name, parameters, expire, http_method)
+        return self.urls([name])[name]
+
+    def urls(self, names):
+        """Return {name: url} for many files at once, signing only the ones not cached."""
+        now = time.monotonic()
+        found = {}
+        with self.url_cache_lock:
+            for name in names:
+                entry = self.url_cache.get(name)
+                if entry is not None and entry[1] > now:
+                    self.url_cache.move_to_end(name)
+                    found[name] = entry[0]
+        missing = [name for name in names if name not in found]
+        if missing:
+            lifetime = self.url_cache_lifetime()
+            generated = {name: super(PublicMediaStorage, self).url(name) for name in missing}
+            with self.url_cache_lock:
+                for name, url in generated.items():
+                    self.url_cache[name] = (url, now + lifetime)
+                    self.url_cache.move_to_end(name)
+                while len(self.url_cache) > self.url_cache_size:
+                    self.url_cache.popitem(last=False)
+            found.update(generated)
+        return found
+
+    def url_cache_lifetime(self):
+        if self.querystring_auth:
+            return max(self.querystring_expire - self.url_cache_margin, 0)
+        return self.url_cache_unsigned_ttl
+
+    def delete(self, name):
+        with self.url_cache_lock:
+            self.url_cache.pop(name, None)
+        super().delete(name)
+
+    def delete_many(self, names):
+        """Delete files with DeleteObjects requests. Returns {name: error message} for the
+        files S3 could not delete; the rest are gone (or were never there)."""
+        names = list(names)
+        with self.url_cache_lock:
+            for name in names:
+                self.url_cache.pop(name, None)
+        client = self.connection.meta.client
+        errors = {}
+        for start in range(0, len(names), self.delete_batch_size):
+            keys = {self._normalize_name(clean_name(name)): name for name in names[start:start + self.delete_batch_size]}
+            response = client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True},
+            )
+            for error in response.get('Errors', []):
+                errors[keys[error['Key']]] = '%s: %s' % (error.get('Code'), error.get('Message'))
+        return errors
+
+    def list_names(self):
+        """Yield (name, last modified) for every file under this storage's location."""
+        prefix = self.location.strip('/') + '/' if self.location else ''
+        paginator = self.connection.meta.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for entry in page.get('Contents', []):
+                yield entry['Key'][len(prefix):], entry['LastModified']
+
+    def save(self, name, content, max_length=None):
+        # Files streamed in by s3.upload_handlers.S3MultipartUploadHandler are already
+        # in the bucket under their final name; saving them again would upload a copy.
+        stored_name = getattr(content, 'stored_name', None)
+        if stored_name is not None:
+            return stored_name
+        return super().save(name, content, max_length=max_length)
+
+    def presigned_post(self, name, content_type, max_size, expires_in=600):
+        """Return the URL and form fields a browser needs to POST `name` straight to the
+        bucket. S3 itself refuses uploads of any other content type or size."""
+        key = self._normalize_name(clean_name(name))
+        fields = {'Content-Type': content_type}
+        conditions = [
+            {'Content-Type': content_type},
+            ['content-length-range', 1, max_size],
+        ]
+        if self.default_acl:
+            fields['acl'] = self.default_acl
+            conditions.append({'acl': self.default_acl})
+        return self.connection.meta.client.generate_presigned_post(
+            self.bucket_name, key, Fields=fields, Conditions=conditions, ExpiresIn=expires_in,
+        )
+
+    def download(self, name, fileobj):
+        """Write a stored file into fileobj as it arrives, rather than reading it all into
+        memory as open() does."""
+        key = self._normalize_name(clean_name(name))
+        self.connection.meta.client.download_fileobj(self.bucket_name, key, fileobj)
+
+    def read_head(self, name, length):
+        """Return (first `length` bytes, total size) of a stored file with one ranged GET."""
+        key = self._normalize_name(clean_name(name))
+        response = self.connection.meta.client.get_object(
+            Bucket=self.bucket_name, Key=key, Range='bytes=0-%d' % (length - 1),
+        )
+        size = int(response['ContentRange'].rsplit('/', 1)[1])
+        return response['Body'].read(), size
@@ -1,11 +1,36 @@
 import pytest
 from django.urls import reverse
-from django.test import Client
+from django.http import HttpResponse
+from django.test import AsyncClient, Client
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
-from s3.models import Upload
+from s3.models import Upload, UploadQuerySet, UploadCounter, UploadEvent
+from s3 import deletion, stats
+from django.utils import timezone
+import datetime
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date, parse_http_date
+import threading
+import time
+import traceback
+from login import live, queue_cache
+from mysite.middleware import AccountMiddleware
+from mysite.storage_backends import PublicMediaStorage
+from login.pagination import paginate
+from asgiref.sync import async_to_sync, sync_to_async
+import asyncio
+from django.core.management import call_command
+from django.db.models import Value
+from django.db.models.functions import Concat
+import io
+import json
 
 class TestLoginApp():
+    @pytest.fixture(autouse=True)
+    def clear_queue_cache(self):
+        queue_cache.get_cache().clear()
+
     @pytest.mark.django_db
     def test_homepage_loading(self):
         client = Client()
@@ -117,7 +142,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:mainpage') + '?sort_by=priority')
         sorted_files = response.context['user_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].priority == 3
         assert sorted_files[1].priority == 2
         assert sorted_files[2].priority == 1
@@ -137,7 +162,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:mainpage') + '?sort_by=not_yet_seen')
         sorted_files = response.context['user_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].status == "New"
         assert sorted_files[1].status == "In Progress"
         assert sorted_files[2].status == "Resolved"
@@ -157,7 +182,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:mainpage') + '?sort_by=most_recent')
         sorted_files = response.context['user_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].priority == 1
         assert sorted_files[1].priority == 2
         assert sorted_files[2].priority == 3
@@ -177,7 +202,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:mainpage') + '?sort_by=hide_resolved')
         sorted_files = response.context['user_uploaded_files']
-        assert sorted_files.count() == 2
+        assert len(sorted_files) == 2
         assert sorted_files[0].priority == 2
         assert sorted_files[1].priority == 3
 
@@ -200,7 +225,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:staffpage') + '?sort_by=priority')
         sorted_files = response.context['all_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].priority == 3
         assert sorted_files[1].priority == 2
         assert sorted_files[2].priority == 1
@@ -224,7 +249,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:staffpage') + '?sort_by=not_yet_seen')
         sorted_files = response.context['all_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].status == "New"
         assert sorted_files[1].status == "In Progress"
         assert sorted_files[2].status == "Resolved"
@@ -247,7 +272,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:staffpage') + '?sort_by=most_recent')
         sorted_files = response.context['all_uploaded_files']
-        assert sorted_files.count() == 3
+        assert len(sorted_files) == 3
         assert sorted_files[0].priority == 1
         assert sorted_files[1].priority == 2
         assert sorted_files[2].priority == 3
@@ -270,7 +295,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:staffpage') + '?sort_by=hide_resolved')
         sorted_files = response.context['all_uploaded_files']
-        assert sorted_files.count() == 2
+        assert len(sorted_files) == 2
         assert sorted_files[0].priority == 2
         assert sorted_files[1].priority == 3
 
@@ -359,7 +384,7 @@ class TestLoginApp():
 
         response = client.get(reverse('login:staffpage') + '?sort_by=priority')
         sorted_files = response.context['all_uploaded_files']
-        assert sorted_files.count() == 4
+        assert len(sorted_files) == 4
         assert sorted_files[0].priority == 3
         assert sorted_files[1].priority == 2
         assert sorted_files[2].priority == 1
@@ -395,3 +420,831 @@ class TestLoginApp():
         uploaded_file = Upload.objects.create(user=user, file=txt_file)
         response = client.post(reverse('s3:submit'), {'file': uploaded_file})
         assert response.url == reverse('login:mainpage')
+
+    @pytest.mark.django_db
+    def test_staffpage_keyset_pagination(self, settings):
+        settings.QUEUE_PAGE_SIZE = 2
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345678', is_staff=True)
+        client.login(username='staffuser', password='12345678')
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploads = [Upload.objects.create(user=user, priority=p, status='New') for p in (1, 5, 3, 5, 2)]
+
+        response = client.get(reverse('login:staffpage') + '?sort_by=priority')
+        first_page = [file.pk for file in response.context['all_uploaded_files']]
+        assert first_page == [uploads[3].pk, uploads[1].pk]
+        assert not response.context['page'].has_previous
+
+        # A report filed while paging must not shift the rows of the following pages.
+        Upload.objects.create(user=user, priority=5, status='New')
+        response = client.get(reverse('login:staffpage'), {'cursor': response.context['page'].next_cursor})
+        second_page = [file.pk for file in response.context['all_uploaded_files']]
+        assert second_page == [uploads[2].pk, uploads[4].pk]
+
+        response = client.get(reverse('login:staffpage'), {'cursor': response.context['page'].next_cursor})
+        assert [file.pk for file in response.context['all_uploaded_files']] == [uploads[0].pk]
+        assert not response.context['page'].has_next
+
+        response = client.get(reverse('login:staffpage'), {'cursor': response.context['page'].previous_cursor})
+        assert [file.pk for file in response.context['all_uploaded_files']] == second_page
+
+    @pytest.mark.django_db
+    def test_keyset_page_costs_one_query(self):
+        uploads = [Upload.objects.create(priority=p) for p in (1, 5, 3, 5, 2)]
+        ordering = ['-priority', 'status_rank', '-id']
+        with CaptureQueriesContext(connection) as queries:
+            page = paginate(Upload.objects.all(), ordering, key='priority', size=2)
+            assert [file.pk for file in page] == [uploads[3].pk, uploads[1].pk] and len(page.object_list) == 2
+            page = paginate(Upload.objects.all(), ordering, page.next_cursor, key='priority', size=2)
+            assert page.has_next and page.has_previous
+            page = paginate(Upload.objects.all(), ordering, page.next_cursor, key='priority', size=2)
+            assert [file.pk for file in page] == [uploads[0].pk] and not page.has_next
+        assert len(queries) == 3
+
+    @pytest.mark.django_db
+    def test_mainpage_pagination_ignores_cursor_from_other_sort(self, settings):
+        settings.QUEUE_PAGE_SIZE = 2
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        for status in ('New', 'In Progress', 'Resolved'):
+            Upload.objects.create(user=user, status=status)
+
+        response = client.get(reverse('login:mainpage') + '?sort_by=not_yet_seen')
+        cursor = response.context['page'].next_cursor
+        assert len(response.context['user_uploaded_files']) == 2
+
+        response = client.get(reverse('login:mainpage') + '?sort_by=most_recent')
+        response = client.get(reverse('login:mainpage'), {'cursor': cursor})
+        assert response.context['user_uploaded_files'][0].status == 'Resolved'
+        assert not response.context['page'].has_previous
+
+    @pytest.mark.django_db
+    def test_status_rank_follows_status(self):
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, status='In Progress')
+        assert uploaded_file.status_rank == 1
+
+        uploaded_file.status = 'Resolved'
+        uploaded_file.save(update_fields=['status'])
+        assert Upload.objects.get(pk=uploaded_file.pk).status_rank == 2
+
+        Upload.objects.filter(pk=uploaded_file.pk).update(status='New')
+        assert Upload.objects.get(pk=uploaded_file.pk).status_rank == 0
+
+    @pytest.mark.django_db
+    def test_upload_preview_generated_on_demand(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345', is_staff=True)
+        client.login(username='testuser', password='12345')
+        txt_file = SimpleUploadedFile("file.txt", b"Testing text file content", content_type="application/txt")
+        uploaded_file = Upload.objects.create(user=user, file=txt_file)
+
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]))
+        assert reverse('login:upload_preview', args=[uploaded_file.pk]) in response.content.decode()
+
+        response = client.get(reverse('login:upload_preview', args=[uploaded_file.pk]))
+        uploaded_file.refresh_from_db()
+        assert response.status_code == 302
+        assert response.url == uploaded_file.preview.url
+        assert uploaded_file.preview.read() == b"Testing text file content"
+
+    @pytest.mark.django_db
+    def test_upload_detail_full_size(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        txt_file = SimpleUploadedFile("file.txt", b"Testing text file content", content_type="application/txt")
+        uploaded_file = Upload.objects.create(user=user, file=txt_file)
+
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]) + '?full=1')
+        assert uploaded_file.file.url in response.content.decode()
+
+    @pytest.mark.django_db
+    def test_delete_removes_files_through_outbox(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345', is_staff=False)
+        client.login(username='testuser', password='12345')
+        txt_file = SimpleUploadedFile("file.txt", b"Testing text file content", content_type="application/txt")
+        uploaded_file = Upload.objects.create(user=user, file=txt_file)
+        client.get(reverse('login:upload_preview', args=[uploaded_file.pk]))
+        uploaded_file.refresh_from_db()
+        preview_name = uploaded_file.preview.name
+
+        client.post(reverse('login:delete', args=[uploaded_file.pk]))
+        assert uploaded_file.preview.storage.exists(preview_name)
+        assert deletion.drain() == (2, 0)
+        assert not uploaded_file.preview.storage.exists(preview_name)
+        assert not uploaded_file.file.storage.exists(uploaded_file.file.name)
+
+    def open_concurrently(self, clients, url, extra=None):
+        # Every client GETs url at once, and extra runs alongside, each on its own thread
+        # and connection; a request that raised or was not answered with the page fails.
+        barrier = threading.Barrier(len(clients) + (1 if extra else 0))
+        responses = []
+        errors = []
+        def run(call):
+            barrier.wait()
+            try:
+                responses.append(call())
+            except Exception:
+                errors.append(traceback.format_exc())
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=(lambda client=client: client.get(url),)) for client in clients]
+        if extra:
+            threads.append(threading.Thread(target=run, args=(extra,)))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert sorted(response.status_code for response in responses) == [200] * len(clients) + ([302] if extra else [])
+
+    def staff_clients(self, count):
+        clients = []
+        for i in range(count):
+            User.objects.create_user(username='staff%d' % i, password='12345', is_staff=True)
+            client = Client()
+            client.login(username='staff%d' % i, password='12345')
+            clients.append(client)
+        return clients
+
+    @pytest.mark.django_db(transaction=True)
+    def test_concurrent_opens_transition_once(self, monkeypatch):
+        transitions = []
+        original_update = UploadQuerySet.update
+        def recording_update(queryset, **kwargs):
+            updated = original_update(queryset, **kwargs)
+            if kwargs.get('status') == 'In Progress':
+                transitions.append(updated)
+            return updated
+        monkeypatch.setattr(UploadQuerySet, 'update', recording_update)
+
+        clients = self.staff_clients(8)
+        uploaded_file = Upload.objects.create(status='New', admin_comment='No comment yet')
+        self.open_concurrently(clients, reverse('login:upload_detail', args=[uploaded_file.pk]))
+
+        assert sum(transitions) == 1
+        assert Upload.objects.get(pk=uploaded_file.pk).status == 'In Progress'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_concurrent_opens_keep_admin_comment(self):
+        clients = self.staff_clients(8)
+        resolver = clients.pop()
+        uploaded_file = Upload.objects.create(status='New')
+
+        def resolve():
+            return resolver.post(reverse('login:admin_resolve', args=[uploaded_file.pk]), {'comment': 'Handled by legal'})
+        self.open_concurrently(clients, reverse('login:upload_detail', args=[uploaded_file.pk]), resolve)
+
+        resolved_file = Upload.objects.get(pk=uploaded_file.pk)
+        assert resolved_file.status == 'Resolved'
+        assert resolved_file.admin_comment == 'Handled by legal'
+
+    @pytest.mark.django_db
+    def test_change_priority_rejects_unknown_priority(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345', is_staff=True)
+        client.login(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, priority=3)
+        client.post(reverse('login:change_priority', args=[uploaded_file.pk]), {'priority': 9})
+        assert Upload.objects.get(pk=uploaded_file.pk).priority == 3
+
+
+    @pytest.mark.django_db
+    def test_staff_queue_is_cached_until_a_report_changes(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, status='New')
+
+        client.get(reverse('login:staffpage'))
+        stats = queue_cache.stats()
+        response = client.get(reverse('login:staffpage'))
+        assert queue_cache.stats()['hits'] == stats['hits'] + 1
+        assert response.context['all_uploaded_files'][0].status == 'New'
+
+        client.post(reverse('login:admin_resolve', args=[uploaded_file.pk]), {'comment': 'Resolved'})
+        response = client.get(reverse('login:staffpage'))
+        assert queue_cache.stats()['misses'] == stats['misses'] + 1
+        assert response.context['all_uploaded_files'][0].status == 'Resolved'
+
+    @pytest.mark.django_db
+    def test_reporter_queue_invalidation_is_per_user(self):
+        first, second = Client(), Client()
+        first_user = User.objects.create_user(username='first', password='12345')
+        User.objects.create_user(username='second', password='12345')
+        first.login(username='first', password='12345')
+        second.login(username='second', password='12345')
+        second.get(reverse('login:mainpage'))
+        first.get(reverse('login:mainpage'))
+
+        Upload.objects.create(user=first_user, status='New')
+        stats = queue_cache.stats()
+        second.get(reverse('login:mainpage'))
+        assert queue_cache.stats()['hits'] == stats['hits'] + 1
+        response = first.get(reverse('login:mainpage'))
+        assert queue_cache.stats()['misses'] == stats['misses'] + 1
+        assert len(response.context['user_uploaded_files']) == 1
+
+    @pytest.mark.django_db
+    def test_upload_version_bumped_on_every_write(self):
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, status='New', priority=1)
+        assert uploaded_file.version == 1
+        uploaded_file.status = 'In Progress'
+        uploaded_file.save(update_fields=['status'])
+        Upload.objects.filter(pk=uploaded_file.pk).update(priority=2)
+        uploaded_file.refresh_from_db()
+        assert uploaded_file.version == 3
+        assert uploaded_file.priority_image == 'new-low.jpg'
+
+    def test_card_cache_fits_in_signed_url_margin(self, settings):
+        margin = PublicMediaStorage.url_cache_margin
+        # A card can be card_timeout() old when a page is built, and the page revalidated
+        # for as long again, while its URLs may have just the margin left.
+        assert 2 * queue_cache.card_timeout() <= margin
+        settings.QUEUE_CARD_CACHE_TIMEOUT = margin * 10
+        assert 2 * queue_cache.card_timeout() <= margin
+        settings.QUEUE_CARD_CACHE_TIMEOUT = 30
+        assert queue_cache.card_timeout() == 30
+
+    @pytest.mark.django_db
+    def test_cached_queue_card_follows_changes(self):
+        client = Client()
+        staff = User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        uploaded_file = Upload.objects.create(user=staff, status='New', priority=4)
+        response = client.get(reverse('login:staffpage'))
+        assert 'src="../../static/images/new-high.jpg"' in str(response.content)
+
+        client.post(reverse('login:change_priority', args=[uploaded_file.pk]), {'priority': 1})
+        response = client.get(reverse('login:staffpage'))
+        assert 'src="../../static/images/new-lowest.jpg"' in str(response.content)
+        assert 'new-high.jpg' not in str(response.content)
+
+    @pytest.mark.django_db
+    def test_request_timings_recorded_per_view(self, settings, tmp_path):
+        log = tmp_path / 'timings.jsonl'
+        settings.REQUEST_INSTRUMENTATION = True
+        settings.REQUEST_INSTRUMENTATION_LOG = str(log)
+        settings.MIDDLEWARE = ['mysite.instrumentation.RequestTimingMiddleware', *settings.MIDDLEWARE]
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        response = client.get(reverse('login:staffpage'))
+        assert 'db;dur=' in response['Server-Timing']
+        sample = json.loads(log.read_text().splitlines()[-1])
+        assert sample['view'] == 'login:staffpage'
+        assert sample['queries'] > 0
+        assert sample['template_ms'] > 0
+
+        output = io.StringIO()
+        call_command('request_timings', log=str(log), view='login:staffpage', stdout=output)
+        assert 'login:staffpage (1 requests)' in output.getvalue()
+
+    @pytest.mark.django_db
+    def test_request_timings_off_by_default(self, settings):
+        settings.MIDDLEWARE = ['mysite.instrumentation.RequestTimingMiddleware', *settings.MIDDLEWARE]
+        response = Client().get(reverse('login:home'))
+        assert 'Server-Timing' not in response
+
+    @pytest.mark.django_db
+    def test_bulk_triage_resolves_selected_reports(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        user = User.objects.create_user(username='testuser', password='12345')
+        new = Upload.objects.create(user=user, status='New', admin_comment='Earlier')
+        resolved = Upload.objects.create(user=user, status='Resolved', admin_comment='Done before')
+        untouched = Upload.objects.create(user=user, status='New')
+
+        response = client.post(reverse('login:bulk_triage'), {
+            'action': 'resolve', 'comment': 'Handled in bulk', 'selected': [new.pk, resolved.pk, 999999],
+        })
+        assert response.context['outcomes'] == [(new.pk, 'Updated'), (resolved.pk, 'Already resolved'), (999999, 'Not found')]
+        new.refresh_from_db()
+        resolved.refresh_from_db()
+        untouched.refresh_from_db()
+        assert (new.status, new.status_rank, new.admin_comment) == ('Resolved', Upload.STATUS_RANKS['Resolved'], 'Handled in bulk')
+        assert resolved.admin_comment == 'Done before'
+        assert untouched.status == 'New'
+
+    @pytest.mark.django_db
+    def test_bulk_triage_priority(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploads = [Upload.objects.create(user=user, priority=1) for _ in range(3)]
+        client.get(reverse('login:staffpage'))
+
+        with CaptureQueriesContext(connection) as queries:
+            client.post(reverse('login:bulk_triage'), {'action': 'priority', 'priority': 5, 'selected': [u.pk for u in uploads]})
+        assert len([query for query in queries if query['sql'].startswith('UPDATE "s3_upload"')]) == 1
+        assert set(Upload.objects.values_list('priority', flat=True)) == {5}
+        response = client.get(reverse('login:staffpage'))
+        assert all(f.priority == 5 for f in response.context['all_uploaded_files'])
+
+    @pytest.mark.django_db
+    def test_bulk_triage_requires_staff(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        upload = Upload.objects.create(user=user, status='New')
+        client.post(reverse('login:bulk_triage'), {'action': 'resolve', 'selected': [upload.pk]})
+        upload.refresh_from_db()
+        assert upload.status == 'New'
+
+    @pytest.mark.django_db
+    def test_search_ranks_and_follows_writes(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        user = User.objects.create_user(username='testuser', password='12345')
+        in_comment = Upload.objects.create(user=user, title='Parking', user_comment='The invoices were forged')
+        in_title = Upload.objects.create(user=user, title='Forged invoices', user_comment='See attached')
+        Upload.objects.create(user=user, title='Unrelated', user_comment='Nothing here')
+
+        response = client.get(reverse('login:search'), {'q': 'forged invoices'})
+        assert [f.pk for f in response.context['results']] == [in_title.pk, in_comment.pk]
+
+        Upload.objects.filter(pk=in_comment.pk).update(user_comment='Resolved elsewhere')
+        in_title.delete()
+        response = client.get(reverse('login:search'), {'q': 'forged'})
+        assert list(response.context['results']) == []
+
+    @pytest.mark.django_db
+    def test_search_pages_and_ignores_query_syntax(self, settings):
+        settings.QUEUE_PAGE_SIZE = 2
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        for i in range(3):
+            Upload.objects.create(title='Harassment report %d' % i)
+        response = client.get(reverse('login:search'), {'q': 'harass'})
+        assert len(response.context['results']) == 2 and response.context['has_next']
+        response = client.get(reverse('login:search'), {'q': 'harass', 'page': 2})
+        assert len(response.context['results']) == 1 and not response.context['has_next']
+        response = client.get(reverse('login:search'), {'q': '"harassment" OR NEAR('})
+        assert response.status_code == 200
+
+    @pytest.mark.django_db
+    def test_search_requires_staff(self):
+        client = Client()
+        User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        response = client.get(reverse('login:search'), {'q': 'report'})
+        assert 'results' not in response.context
+
+    @pytest.mark.django_db
+    def test_async_views_are_routed(self, async_views):
+        from login import views
+        assert reverse('login:mainpage') == '/mainpage'
+        assert Client().get(reverse('login:mainpage')).resolver_match.func is views.amainpage
+
+    @pytest.mark.django_db
+    def test_async_queues(self, async_views):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='testuser', password='12345')
+        own = Upload.objects.create(user=user, title='Mine')
+        Upload.objects.create(title='Someone else')
+        response = client.get(reverse('login:mainpage'), {'sort_by': 'priority'})
+        assert list(response.context['user_uploaded_files']) == [own]
+        assert client.session['sort_by'] == 'priority'
+        response = client.get(reverse('login:staffpage'))
+        assert 'all_uploaded_files' not in response.context
+
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        response = client.get(reverse('login:staffpage'))
+        assert len(response.context['all_uploaded_files']) == 2
+
+    @pytest.mark.django_db(transaction=True)
+    def test_async_account_middleware(self, async_views, settings):
+        settings.MIDDLEWARE = [
+            'mysite.middleware.AccountMiddleware' if path == 'allauth.account.middleware.AccountMiddleware' else path
+            for path in settings.MIDDLEWARE
+        ]
+        async def view(request):
+            return HttpResponse()
+        assert asyncio.iscoroutinefunction(AccountMiddleware(view))
+        assert not asyncio.iscoroutinefunction(AccountMiddleware(lambda request: HttpResponse()))
+
+        client = AsyncClient()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        session = client.session
+        session['account_login'] = {'state': 'abandoned'}
+        session.save()
+        async def get():
+            return await client.get(reverse('login:staffpage'))
+        assert async_to_sync(get)().status_code == 200
+        assert 'account_login' not in client.session
+
+    @pytest.mark.django_db
+    def test_async_detail_and_delete(self, async_views):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        uploaded_file = Upload.objects.create(user=user, status='New')
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]))
+        assert 'uploaded_file' not in response.context
+
+        client.login(username='staffuser', password='12345')
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]))
+        assert response.context['uploaded_file'].status == 'In Progress'
+        assert Upload.objects.get(pk=uploaded_file.pk).status == 'In Progress'
+        assert client.get(reverse('login:upload_detail', args=[uploaded_file.pk + 1])).status_code == 404
+
+        client.login(username='testuser', password='12345')
+        response = client.post(reverse('login:delete', args=[uploaded_file.pk]))
+        assert response.status_code == 302
+        assert not Upload.objects.exists()
+
+    def counters(self):
+        return {(c.status, c.priority): c.count for c in UploadCounter.objects.filter(count__gt=0)}
+
+    @pytest.mark.django_db
+    def test_counters_follow_every_write_path(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        first = Upload.objects.create(user=user, priority=2)
+        second = Upload.objects.create(user=user, priority=2)
+        assert self.counters() == {('New', 2): 2}
+
+        client.get(reverse('login:upload_detail', args=[first.pk]))
+        assert self.counters() == {('New', 2): 1, ('In Progress', 2): 1}
+        client.post(reverse('login:change_priority', args=[first.pk]), {'priority': 5})
+        assert self.counters() == {('New', 2): 1, ('In Progress', 5): 1}
+        client.post(reverse('login:admin_resolve', args=[first.pk]), {'comment': 'Done'})
+        assert self.counters() == {('New', 2): 1, ('Resolved', 5): 1}
+        client.post(reverse('login:bulk_triage'), {'action': 'resolve', 'selected': [first.pk, second.pk]})
+        assert self.counters() == {('Resolved', 2): 1, ('Resolved', 5): 1}
+
+        second.status = 'New'
+        second.save()
+        first.delete()
+        assert self.counters() == {('New', 2): 1}
+        user.delete()
+        assert self.counters() == {}
+
+    @pytest.mark.django_db
+    def test_dashboard_reads_counters_only(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        old = Upload.objects.create(priority=5)
+        Upload.objects.filter(pk=old.pk).update(created_at=timezone.now() - datetime.timedelta(days=3))
+        Upload.objects.create(priority=3, status='Resolved')
+        Upload.objects.create(priority=5)
+        Upload.objects.create(priority=1, status='In Progress')
+
+        with CaptureQueriesContext(connection) as queries:
+            dashboard = stats.dashboard()
+        assert len(queries) == 1 + len(stats.OPEN_STATUSES)
+        assert all('COUNT(' not in query['sql'] for query in queries)
+        assert dashboard['total'] == 4 and dashboard['open'] == 3
+        assert dashboard['by_status'] == [('New', 2), ('In Progress', 1), ('Resolved', 1)]
+        assert dict(dashboard['open_by_priority'])['Highest Priority'] == 2
+        assert dashboard['oldest_open_created'] < timezone.now() - datetime.timedelta(days=2)
+        assert timezone.now() - datetime.timedelta(days=1, hours=1) < dashboard['mean_open_created'] \
+            < timezone.now() - datetime.timedelta(hours=23)
+
+        response = client.get(reverse('login:staffpage'))
+        assert response.context['dashboard']['open'] == 3
+        assert b'Open by priority' in response.content
+
+    @pytest.mark.django_db
+    def test_rebuild_counters_fixes_drift(self):
+        Upload.objects.create(priority=2)
+        Upload.objects.bulk_create([Upload(priority=4) for _ in range(3)])
+        assert self.counters() == {('New', 2): 1, ('New', 4): 3}
+        assert stats.rebuild(dry_run=True) == {}
+
+        UploadCounter.objects.filter(priority=4).update(count=1)
+        output = io.StringIO()
+        call_command('rebuild_upload_counters', '--dry-run', stdout=output)
+        assert 'New, priority 4: 3 counted, 1 stored' in output.getvalue()
+        assert self.counters() == {('New', 2): 1, ('New', 4): 1}
+        call_command('rebuild_upload_counters', stdout=io.StringIO())
+        assert self.counters() == {('New', 2): 1, ('New', 4): 3}
+
+    @pytest.mark.django_db
+    def test_counter_triggers_restored_after_table_rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TRIGGER s3_upload_count_insert")
+        Upload.objects.create(priority=2)
+        stats.ensure_sqlite_triggers()
+        Upload.objects.create(priority=2)
+        assert self.counters() == {('New', 2): 2}
+
+    @pytest.mark.django_db
+    def test_staff_queue_not_modified_until_a_report_changes(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        uploaded_file = Upload.objects.create(status='New')
+        etag = client.get(reverse('login:staffpage'))['ETag']
+
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('login:staffpage'), HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 304 and response.content == b''
+        assert all('s3_upload' not in query['sql'] for query in queries)
+        assert client.get(reverse('login:staffpage'), {'sort_by': 'priority'},
+                          HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+        client.get(reverse('login:staffpage'), {'sort_by': 'most_recent'})
+        client.post(reverse('login:change_priority', args=[uploaded_file.pk]), {'priority': 1})
+        response = client.get(reverse('login:staffpage'), HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == 200 and response['ETag'] != etag
+
+    @pytest.mark.django_db
+    def test_queue_not_modified_since_its_last_change(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        uploaded_file = Upload.objects.create(status='New')
+        response = client.get(reverse('login:staffpage'))
+        modified = parse_http_date(response['Last-Modified'])
+        assert modified <= time.time()
+
+        assert client.get(reverse('login:staffpage'), HTTP_IF_MODIFIED_SINCE=http_date(modified)).status_code == 304
+        assert client.get(reverse('login:staffpage'), HTTP_IF_MODIFIED_SINCE=http_date(modified - 1)).status_code == 200
+        assert client.get(reverse('login:staffpage'), HTTP_IF_MODIFIED_SINCE=http_date(modified),
+                          HTTP_IF_NONE_MATCH='"stale"').status_code == 200
+
+        queue_cache.get_cache().set(queue_cache.changed_key(queue_cache.STAFF_SCOPE), 0)
+        client.post(reverse('login:change_priority', args=[uploaded_file.pk]), {'priority': 4})
+        assert queue_cache.changed_at(queue_cache.get_cache(), queue_cache.STAFF_SCOPE) >= modified
+
+    @pytest.mark.django_db
+    def test_etag_changes_when_logging_in_again(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        uploaded_file = Upload.objects.create(status='In Progress')
+        client.login(username='staffuser', password='12345')
+        urls = [reverse('login:staffpage'), reverse('login:upload_detail', args=[uploaded_file.pk])]
+        for url in urls:
+            client.get(url)
+        etags = [client.get(url)['ETag'] for url in urls]
+        for url, etag in zip(urls, etags):
+            assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+
+        client.post(reverse('account_logout'))
+        client.login(username='staffuser', password='12345')
+        for url, etag in zip(urls, etags):
+            assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+    @pytest.mark.django_db
+    def test_reporter_queue_etag_is_per_user(self):
+        first, second = Client(), Client()
+        first_user = User.objects.create_user(username='first', password='12345')
+        User.objects.create_user(username='second', password='12345')
+        first.login(username='first', password='12345')
+        second.login(username='second', password='12345')
+        first_etag = first.get(reverse('login:mainpage'))['ETag']
+        second_etag = second.get(reverse('login:mainpage'))['ETag']
+        assert first_etag != second_etag
+        assert second.get(reverse('login:mainpage'), HTTP_IF_NONE_MATCH=first_etag).status_code == 200
+
+        Upload.objects.create(user=first_user)
+        assert second.get(reverse('login:mainpage'), HTTP_IF_NONE_MATCH=second_etag).status_code == 304
+        assert first.get(reverse('login:mainpage'), HTTP_IF_NONE_MATCH=first_etag).status_code == 200
+
+    @pytest.mark.django_db
+    def test_detail_compressed_and_not_modified(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, status='New', user_comment='Details ' * 100)
+        url = reverse('login:upload_detail', args=[uploaded_file.pk])
+
+        response = client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        assert response['Content-Encoding'] == 'gzip'
+        assert response['ETag'].startswith('W/"')
+        assert 'no-cache' in response['Cache-Control'] and 'Accept-Encoding' in response['Vary']
+        assert client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+
+        client.post(reverse('login:admin_resolve', args=[uploaded_file.pk]), {'comment': 'Resolved'})
+        assert client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code == 200
+
+    @pytest.mark.django_db
+    def test_async_queue_not_modified(self, async_views):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        uploaded_file = Upload.objects.create(status='New', user_comment='Details ' * 100)
+        response = client.get(reverse('login:staffpage'), HTTP_ACCEPT_ENCODING='gzip')
+        assert response['Content-Encoding'] == 'gzip'
+        assert client.get(reverse('login:staffpage'), HTTP_IF_NONE_MATCH=response['ETag']).status_code == 304
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]), HTTP_ACCEPT_ENCODING='gzip')
+        assert response.resolver_match.func.__name__ == 'aupload_detail'
+        assert response['Content-Encoding'] == 'gzip'
+
+    @pytest.mark.django_db
+    def test_change_feed_follows_write_paths(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        user = User.objects.create_user(username='testuser', password='12345')
+        client.login(username='staffuser', password='12345')
+        since = client.get(reverse('login:staffpage')).context['events_since']
+        uploaded_file = Upload.objects.create(user=user, status='New')
+        client.post(reverse('login:change_priority', args=[uploaded_file.pk]), {'priority': 4})
+        client.post(reverse('login:admin_resolve', args=[uploaded_file.pk]), {'comment': 'Resolved'})
+        upload_id = uploaded_file.pk
+        uploaded_file.delete()
+        feed = UploadEvent.objects.filter(id__gt=since).order_by('id')
+        assert [(event.upload_id, event.action) for event in feed] == [
+            (upload_id, 'created'), (upload_id, 'priority'),
+            # Opened by staff on the detail page the priority form returns to, then resolved.
+            (upload_id, 'status'), (upload_id, 'status'), (upload_id, 'deleted'),
+        ]
+
+        response = client.get(reverse('login:upload_events'), {'since': since})
+        assert response['Content-Type'] == 'text/event-stream'
+        body = b''.join(response.streaming_content).decode()
+        assert body.startswith('retry: 5000\n\n')
+        assert body.count('event: upload') == 5 and '"action": "deleted"' in body
+        response = client.get(reverse('login:upload_events'), {'since': since}, HTTP_LAST_EVENT_ID=str(feed[3].id))
+        assert b''.join(response.streaming_content).decode().count('event: upload') == 1
+
+        client.login(username='testuser', password='12345')
+        assert client.get(reverse('login:upload_events')).status_code == 403
+
+    @pytest.mark.django_db
+    def test_upload_card(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        user = User.objects.create_user(username='testuser', password='12345')
+        uploaded_file = Upload.objects.create(user=user, title='Card title')
+        client.login(username='testuser', password='12345')
+        assert client.get(reverse('login:upload_card', args=[uploaded_file.pk])).status_code == 403
+        client.login(username='staffuser', password='12345')
+        response = client.get(reverse('login:upload_card', args=[uploaded_file.pk]))
+        assert response.content.decode().strip().startswith('<ul data-upload-id="%d">' % uploaded_file.pk)
+        assert b'Card title' in response.content
+
+    def test_change_feed_waits_for_young_gaps(self):
+        now = timezone.now()
+        rows = [UploadEvent(id=1, created_at=now), UploadEvent(id=3, created_at=now),
+                UploadEvent(id=4, created_at=now)]
+        assert [row.id for row in live.published(0, rows, now)] == [1]
+        assert [row.id for row in live.published(0, rows, now + live.GAP_TIMEOUT)] == [1, 3, 4]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_async_event_stream(self, async_views, settings):
+        settings.UPLOAD_EVENTS_POLL_INTERVAL = 0.01
+        client = AsyncClient()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        before = Upload.objects.create(title='Before')
+
+        async def read_stream():
+            response = await client.get(reverse('login:upload_events'), {'since': before_id})
+            chunks = aiter(response.streaming_content)
+            assert await anext(chunks) == b'retry: 5000\n\n'
+            assert b'"action": "created"' in await asyncio.wait_for(anext(chunks), 5)
+            assert live.hubs
+            created = await sync_to_async(Upload.objects.create)(title='Live')
+            received = await asyncio.wait_for(anext(chunks), 5)
+            assert ('"id": %d, "action": "created"' % created.pk).encode() in received
+
+        before_id = UploadEvent.objects.get(upload_id=before.pk).id - 1
+        async_to_sync(read_stream)()
+        assert not live.hubs
+
+    @pytest.mark.django_db
+    def test_api_lists_pages_with_sparse_fields(self, settings):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        other = User.objects.create_user(username='other', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        for i in range(5):
+            Upload.objects.create(user=user, title='Report %d' % i, priority=i + 1, user_comment='Long ' * 100,
+                                  sha256='a' * 64 if i < 2 else '')
+        Upload.objects.create(user=other, title='Other', status='Resolved')
+        assert client.get(reverse('login:api_reports')).status_code == 403
+
+        client.login(username='testuser', password='12345')
+        response = client.get(reverse('login:api_reports'), {'limit': 2})
+        data = response.json()
+        assert [item['title'] for item in data['results']] == ['Report 4', 'Report 3']
+        assert 'user_comment' not in data['results'][0] and 'duplicates' not in data['results'][0]
+        data = client.get(reverse('login:api_reports'), {'limit': 2, 'cursor': data['next']}).json()
+        assert [item['title'] for item in data['results']] == ['Report 2', 'Report 1']
+        assert data['previous']
+        assert client.get(reverse('login:api_reports'), {'fields': 'duplicates'}).status_code == 400
+        assert client.get(reverse('login:api_reports'), {'sort_by': 'sideways'}).status_code == 400
+        assert client.get(reverse('login:api_reports'), {'limit': 1000}).status_code == 400
+
+        client.login(username='staffuser', password='12345')
+        data = client.get(reverse('login:api_reports'), {'sort_by': 'priority', 'fields': 'id,title,user_comment'}).json()
+        assert list(data['results'][0]) == ['id', 'title', 'user_comment']
+        assert [item['title'] for item in data['results']][:2] == ['Report 4', 'Report 3']
+        assert len(data['results']) == 6
+        data = client.get(reverse('login:api_reports'), {'sort_by': 'hide_resolved', 'fields': 'title,duplicates'}).json()
+        assert 'Other' not in [item['title'] for item in data['results']]
+        assert {item['title']: item['duplicates'] for item in data['results']}['Report 0'] == 1
+
+    @pytest.mark.django_db
+    def test_api_list_queries_do_not_grow_with_the_page(self):
+        client = Client()
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        client.login(username='staffuser', password='12345')
+        fields = 'id,title,status,file_url,preview_url,duplicates'
+
+        def list_queries(count):
+            Upload.objects.all().delete()
+            for i in range(count):
+                Upload.objects.create(title='Report %d' % i, sha256='%064d' % (i % 3), file='report%d.txt' % i)
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('login:api_reports'), {'fields': fields, 'limit': 50})
+            assert len(response.json()['results']) == count
+            return [query['sql'] for query in queries]
+
+        few, many = list_queries(3), list_queries(30)
+        assert len(few) == len(many)
+        page_query = next(sql for sql in many if 'ORDER BY' in sql and 'LIMIT' in sql)
+        assert 'user_comment' not in page_query and 'extracted_text' not in page_query
+
+    @pytest.mark.django_db
+    def test_api_detail_and_writes(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        User.objects.create_user(username='other', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        uploaded_file = Upload.objects.create(user=user, title='Report', status='New', user_comment='Details')
+        url = reverse('login:api_report', args=[uploaded_file.pk])
+
+        client.login(username='other', password='12345')
+        assert client.get(url).status_code == 403
+        client.login(username='testuser', password='12345')
+        data = client.get(url).json()
+        assert data['user_comment'] == 'Details' and 'duplicates' not in data
+        assert client.post(reverse('login:api_resolve', args=[uploaded_file.pk]), {'comment': 'Done'}).status_code == 403
+        assert client.get(reverse('login:api_report', args=[uploaded_file.pk + 1])).status_code == 404
+
+        client.login(username='staffuser', password='12345')
+        assert client.get(url, {'fields': 'status'}).json() == {'status': 'New'}
+        response = client.post(reverse('login:api_priority', args=[uploaded_file.pk]), {'priority': 9})
+        assert response.status_code == 400
+        response = client.post(reverse('login:api_priority', args=[uploaded_file.pk]),
+                               json.dumps({'priority': 4}), content_type='application/json')
+        assert response.json()['priority'] == 4
+        response = client.post(reverse('login:api_resolve', args=[uploaded_file.pk]), {'comment': 'Done'})
+        assert response.json()['status'] == 'Resolved' and response.json()['admin_comment'] == 'Done'
+        assert client.post(reverse('login:api_resolve', args=[uploaded_file.pk + 1]), {'comment': 'Done'}).status_code == 404
+        assert list(UploadEvent.objects.filter(upload_id=uploaded_file.pk).values_list('action', flat=True)
+                    .order_by('id')) == ['created', 'priority', 'status']
+
+    @pytest.mark.django_db
+    def test_comment_excerpts_follow_every_write(self):
+        long_comment = 'x' * 500
+        uploaded_file = Upload.objects.create(user_comment=long_comment)
+        assert uploaded_file.user_comment_excerpt == 'x' * 159 + '…'
+        assert Upload.objects.get(pk=uploaded_file.pk).admin_comment_excerpt == 'No comment yet'
+
+        Upload.objects.filter(pk=uploaded_file.pk).update(admin_comment='Short')
+        Upload.objects.filter(pk=uploaded_file.pk).update(user_comment=Concat(Value('y' * 200), Value('z')))
+        uploaded_file.refresh_from_db()
+        assert uploaded_file.admin_comment_excerpt == 'Short'
+        assert uploaded_file.user_comment_excerpt == 'y' * 159 + '…'
+
+        uploaded_file.user_comment = 'Edited'
+        uploaded_file.save(update_fields=['user_comment'])
+        assert Upload.objects.get(pk=uploaded_file.pk).user_comment_excerpt == 'Edited'
+        Upload.objects.bulk_create([Upload(title='Bulk', user_comment=long_comment)])
+        assert len(Upload.objects.get(title='Bulk').user_comment_excerpt) == 160
+
+    @pytest.mark.django_db
+    def test_bulk_created_reports_are_ranked(self):
+        Upload.objects.bulk_create([Upload(title=status, status=status) for status in ('Resolved', 'In Progress', 'New')])
+        assert dict(Upload.objects.values_list('title', 'status_rank')) == {'Resolved': 2, 'In Progress': 1, 'New': 0}
+
+    @pytest.mark.django_db
+    def test_queues_read_excerpts_and_detail_reads_full_comments(self):
+        client = Client()
+        user = User.objects.create_user(username='testuser', password='12345')
+        User.objects.create_user(username='staffuser', password='12345', is_staff=True)
+        uploaded_file = Upload.objects.create(user=user, user_comment='Start ' + 'middle ' * 100 + 'end')
+        client.login(username='staffuser', password='12345')
+
+        for name in ('login:staffpage', 'login:mainpage'):
+            if name == 'login:mainpage':
+                client.login(username='testuser', password='12345')
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse(name))
+            assert b'Start middle' in response.content and b'middle end' not in response.content
+            queue_queries = [query['sql'] for query in queries if 'FROM "s3_upload"' in query['sql']]
+            assert queue_queries
+            assert all('."user_comment"' not in sql and '."admin_comment"' not in sql for sql in queue_queries)
+
+        response = client.get(reverse('login:upload_detail', args=[uploaded_file.pk]))
+        assert b'middle end' in response.content
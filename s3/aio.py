@@ -0,0 +1,47 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+
+# Helpers for the async views served under ASGI (see mysite/asgi.py).
+#
+# boto3 has no asyncio API, so instead of stalling the event loop the blocking S3 calls
+# of those views run on a pool of threads kept for S3 alone. The threads live as long as
+# the process, and so does the boto3 client S3Boto3Storage keeps per thread. Database
+# work stays on the request's own thread through sync_to_async, as Django's async ORM
+# methods do.
+
+executor_lock = threading.Lock()
+executor = None
+
+
+def threads():
+    return getattr(settings, 'ASYNC_S3_THREADS', 32)
+
+
+def get_executor():
+    global executor
+    with executor_lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=threads(), thread_name_prefix='s3')
+        return executor
+
+
+async def run(func, *args, **kwargs):
+    """Await func(*args, **kwargs) run on the S3 threads, in the caller's context."""
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), call)
+
+
+async def request_user(request):
+    """Load request.user, which AuthenticationMiddleware leaves to a lazy (blocking)
+    query, off the event loop. The session is loaded along with it."""
+    user = await sync_to_async(get_user)(request)
+    request.user = user
+    return user
@@ -1,6 +1,13 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_migrate
 
 
 class S3Config(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 's3'
+
+    def ready(self):
+        # Importing events connects the change feed to s3.signals.upload_changed.
+        from . import events, search, stats
+        post_migrate.connect(search.ensure_sqlite_triggers, sender=self)
+        post_migrate.connect(stats.ensure_sqlite_triggers, sender=self)
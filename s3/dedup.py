@@ -0,0 +1,86 @@
+import hashlib
+
+from django.db import transaction
+from django.db.models import F
+
+from . import deletion
+from .models import StoredObject, Upload
+from .signals import upload_changed
+
+# Reports with byte-identical files share one stored object. Form uploads are hashed
+# while they stream in (S3MultipartUploadHandler, or file_digest for the other upload
+# handlers), and a file that is already stored is not written to the bucket again.
+# Direct-to-bucket uploads can only be hashed once they are stored, so the
+# deduplicate_upload processing step hashes them and drops the extra copy.
+# StoredObject.references counts the reports using each object; see
+# s3.deletion.release_file for the other half.
+
+CHUNK_SIZE = 64 * 1024
+
+
+def file_digest(content):
+    """SHA-256 of an uploaded or stored file, read in chunks. Leaves it rewound."""
+    digest = getattr(content, 'sha256', None)
+    if digest:
+        return digest
+    sha256 = hashlib.sha256()
+    content.seek(0)
+    for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+        sha256.update(chunk)
+    content.seek(0)
+    return sha256.hexdigest()
+
+
+def stored_name(digest):
+    return StoredObject.objects.filter(sha256=digest).values_list('name', flat=True).first()
+
+
+@transaction.atomic
+def link(upload, digest):
+    """Count a saved `upload` as a reference to the stored object for `digest`, pointing
+    it at the existing file (and queueing its own copy for deletion) if there is one."""
+    stored, created = StoredObject.objects.select_for_update().get_or_create(
+        sha256=digest, defaults={'name': upload.file.name, 'size': upload.file.size},
+    )
+    if not created:
+        StoredObject.objects.filter(pk=stored.pk).update(references=F('references') + 1)
+    own_copy = upload.file.name
+    Upload.objects.filter(pk=upload.pk).update(file=stored.name, sha256=digest)
+    upload.file.name = stored.name
+    upload.sha256 = digest
+    if own_copy != stored.name:
+        deletion.schedule([own_copy])
+        upload_changed.send(sender=Upload, upload_id=upload.pk, user_id=upload.user_id, action='changed')
+
+
+def save_upload(upload):
+    """Save a new upload whose file has not been stored yet, reusing the stored copy of
+    an identical file if there is one."""
+    content = upload.file.file
+    digest = file_digest(content)
+    existing = stored_name(digest)
+    if existing is not None:
+        if getattr(content, 'stored_name', None) not in (None, existing):
+            content.discard()
+        upload.file.name = existing
+        upload.file._committed = True
+    with transaction.atomic():
+        upload.save()
+        link(upload, digest)
+    return upload
+
+
+def deduplicate_upload(upload):
+    """Processing step: hash uploads that were stored without one (direct uploads)."""
+    if upload.sha256 or not upload.file:
+        return
+    with upload.file.open('rb') as stored_file:
+        digest = file_digest(stored_file)
+    link(upload, digest)
+
+
+def duplicates(upload):
+    """Other reports with identical evidence."""
+    if not upload.sha256:
+        return Upload.objects.none()
+    return Upload.objects.filter(sha256=upload.sha256).exclude(pk=upload.pk).order_by('-id')
@@ -0,0 +1,103 @@
+import logging
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import DeletedObject, StoredObject, Upload
+
+# Deleting a report no longer waits on the bucket: login.views.delete records the
+# report's stored files in the DeletedObject outbox in the same transaction that
+# deletes the row, and the process_deletions command removes them in batches (one S3
+# DeleteObjects request per 1000 files). A failed deletion stays in the outbox and is
+# retried with a growing delay, so a row and its files can no longer drift apart
+# because of a single failed S3 call.
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+RETRY_DELAY = timedelta(seconds=30)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+
+def get_storage():
+    return Upload._meta.get_field('file').storage
+
+
+def schedule(names):
+    """Queue stored files for deletion. Empty names are ignored."""
+    DeletedObject.objects.bulk_create([DeletedObject(name=name) for name in names if name])
+
+
+def release_file(upload):
+    """Drop `upload`'s reference to its stored file. Returns True if no other report
+    uses the file any more, so it can be deleted."""
+    if upload.sha256:
+        stored = StoredObject.objects.select_for_update().filter(sha256=upload.sha256).first()
+        if stored is not None:
+            if stored.references > 1:
+                StoredObject.objects.filter(pk=stored.pk).update(references=F('references') - 1)
+                return False
+            stored.delete()
+    return not Upload.objects.filter(file=upload.file.name).exclude(pk=upload.pk).exists()
+
+
+def schedule_upload(upload):
+    """Queue the stored files of a report that is being deleted. Call inside the
+    transaction that deletes it."""
+    names = [upload.preview.name]
+    if release_file(upload):
+        names.append(upload.file.name)
+    schedule(names)
+
+
+def retry_delay(attempts):
+    return min(RETRY_DELAY * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+
+def delete_files(storage, names):
+    """Delete files, in batches where the storage supports it. Returns {name: error}."""
+    if hasattr(storage, 'delete_many'):
+        return storage.delete_many(names)
+    errors = {}
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception as error:
+            errors[name] = repr(error)
+    return errors
+
+
+def drain(batch_size=BATCH_SIZE):
+    """Delete up to batch_size queued files. Returns (deleted, failed)."""
+    storage = get_storage()
+    now = timezone.now()
+    with transaction.atomic():
+        ready = DeletedObject.objects.filter(available_at__lte=now).order_by('available_at', 'id')
+        if connection.features.has_select_for_update_skip_locked:
+            # Concurrent drainers skip each other's batches instead of deleting twice.
+            ready = ready.select_for_update(skip_locked=True)
+        batch = list(ready[:batch_size])
+        if not batch:
+            return 0, 0
+        names = set(entry.name for entry in batch)
+        # A file queued for deletion can have been taken up again by an identical upload
+        # (s3.dedup) before the queue got to it; such files are kept.
+        in_use = set()
+        for file_name, preview_name in Upload.objects.filter(Q(file__in=names) | Q(preview__in=names)).values_list('file', 'preview'):
+            in_use.update((file_name, preview_name))
+        try:
+            errors = delete_files(storage, sorted(names - in_use))
+        except Exception as error:
+            logger.exception("Deleting %d stored files failed", len(batch))
+            errors = {entry.name: repr(error) for entry in batch}
+        failed = [entry for entry in batch if entry.name in errors]
+        for entry in failed:
+            entry.attempts += 1
+            entry.last_error = errors[entry.name]
+            entry.available_at = now + retry_delay(entry.attempts)
+            logger.warning("Could not delete %s (attempt %s): %s", entry.name, entry.attempts, entry.last_error)
+        DeletedObject.objects.bulk_update(failed, ['attempts', 'last_error', 'available_at'])
+        DeletedObject.objects.filter(pk__in=[entry.pk for entry in batch if entry.name not in errors]).delete()
+    return len(batch) - len(failed), len(failed)
@@ -0,0 +1,47 @@
+from datetime import timedelta
+
+from django.db.models import Max
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import UploadEvent
+from .signals import upload_changed
+
+# The change feed of reports: every upload_changed signal is recorded as an UploadEvent
+# in the writer's own transaction, so the feed has exactly the committed writes, in the
+# order of their ids. login.live streams it to the staff queue. Events older than
+# EVENT_TTL are removed by the prune_upload_events command.
+
+EVENT_TTL = timedelta(days=1)
+
+# Feed action for each upload_changed action; anything else is "changed".
+FEED_ACTIONS = {
+    'created': 'created',
+    'status': 'status',
+    'resolved': 'status',
+    'priority': 'priority',
+    'deleted': 'deleted',
+}
+
+
+@receiver(upload_changed)
+def record(sender, upload_id, user_id, action, **kwargs):
+    UploadEvent.objects.create(upload_id=upload_id, user_id=user_id, action=FEED_ACTIONS.get(action, 'changed'))
+
+
+def latest_id():
+    return UploadEvent.objects.aggregate(latest=Max('id'))['latest'] or 0
+
+
+def since(cursor, limit, upto=None):
+    """Up to `limit` events after feed position `cursor` (and not after `upto`), oldest first."""
+    events = UploadEvent.objects.filter(id__gt=cursor)
+    if upto is not None:
+        events = events.filter(id__lte=upto)
+    return list(events.order_by('id')[:limit])
+
+
+def prune(max_age=EVENT_TTL):
+    """Delete events older than max_age. Returns how many were deleted."""
+    deleted, _ = UploadEvent.objects.filter(created_at__lt=timezone.now() - max_age).delete()
+    return deleted
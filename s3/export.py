@@ -0,0 +1,179 @@
+import collections
+import csv
+import io
+import json
+import logging
+import posixpath
+import shutil
+import tempfile
+import zipfile
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import aio
+from .previews import file_kind
+
+# ZIP bundles of reports for handover: each report's file under reports/<id>/, then a
+# manifest of the report fields as CSV and JSON. The archive is written while it is
+# sent (zipfile supports unseekable output, writing each member's sizes after its
+# data), and the files are fetched from storage EXPORT_PREFETCH at a time ahead of the
+# one being written, on the S3 threads of s3.aio. A fetched file stays in memory up to
+# SPOOL_SIZE and goes to a temporary file past that, so an export holds at most
+# EXPORT_PREFETCH * SPOOL_SIZE of evidence in memory however large it is.
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+MANIFEST_FIELDS = ['id', 'title', 'status', 'priority', 'user_comment', 'admin_comment', 'created_at',
+                   'sha256', 'file']
+# Already compressed formats are stored as they are.
+STORED_KINDS = ('image', 'pdf')
+
+
+def max_reports():
+    return getattr(settings, 'EXPORT_MAX_REPORTS', 500)
+
+
+def prefetch():
+    return getattr(settings, 'EXPORT_PREFETCH', 4)
+
+
+class ZipOutput:
+    """Unseekable file zipfile writes into; take() returns what was written since."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def discard(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def fetch(storage, name):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        if hasattr(storage, 'download'):
+            storage.download(name, spool)
+        else:
+            with storage.open(name, 'rb') as source:
+                shutil.copyfileobj(source, spool, CHUNK_SIZE)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def fetched(storage, names):
+    """Yield (name, open file or None if it could not be fetched) for each of names, in
+    order, fetching up to prefetch() of them concurrently ahead of the caller."""
+    names = iter(names)
+    pending = collections.deque()
+
+    def submit():
+        for name in names:
+            pending.append((name, aio.get_executor().submit(fetch, storage, name)))
+            return
+
+    try:
+        for _ in range(prefetch()):
+            submit()
+        while pending:
+            name, future = pending.popleft()
+            submit()
+            try:
+                stored_file = future.result()
+            except Exception:
+                logger.exception("Fetching %s for an export failed", name)
+                stored_file = None
+            try:
+                yield name, stored_file
+            finally:
+                if stored_file is not None:
+                    stored_file.close()
+    finally:
+        # The export was abandoned: drop whatever is still being fetched.
+        for name, future in pending:
+            future.cancel()
+            future.add_done_callback(discard)
+
+
+def member_path(upload):
+    return 'reports/%d/%s' % (upload.pk, posixpath.basename(upload.file.name))
+
+
+def manifest_row(upload, included):
+    return {
+        'id': upload.pk, 'title': upload.title, 'status': upload.status, 'priority': upload.priority,
+        'user_comment': upload.user_comment, 'admin_comment': upload.admin_comment,
+        'created_at': upload.created_at.isoformat(), 'sha256': upload.sha256,
+        # Blank if the report has no file or it could not be fetched.
+        'file': member_path(upload) if upload.file.name in included else '',
+    }
+
+
+def manifest_csv(rows):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, MANIFEST_FIELDS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue().encode()
+
+
+def zip_info(path, compress_type, modified):
+    if timezone.is_aware(modified):
+        modified = timezone.localtime(modified)
+    info = zipfile.ZipInfo(path, modified.timetuple()[:6])
+    info.compress_type = compress_type
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def stream(storage, uploads):
+    """Yield a ZIP of `uploads` (a list, in manifest order) and their files."""
+    output = ZipOutput()
+    by_name = collections.defaultdict(list)
+    for upload in uploads:
+        if upload.file.name:
+            by_name[upload.file.name].append(upload)
+    included = set()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # Reports sharing a stored file (s3.dedup) each get a copy, fetched once.
+        for name, stored_file in fetched(storage, by_name):
+            if stored_file is None:
+                continue
+            kind = file_kind(stored_file)
+            compress_type = zipfile.ZIP_STORED if kind in STORED_KINDS else zipfile.ZIP_DEFLATED
+            for upload in by_name[name]:
+                stored_file.seek(0)
+                with archive.open(zip_info(member_path(upload), compress_type, upload.created_at), 'w') as member:
+                    for chunk in iter(lambda: stored_file.read(CHUNK_SIZE), b''):
+                        member.write(chunk)
+                        yield from sent(output)
+                yield from sent(output)
+            included.add(name)
+        rows = [manifest_row(upload, included) for upload in uploads]
+        now = timezone.now()
+        archive.writestr(zip_info('manifest.csv', zipfile.ZIP_DEFLATED, now), manifest_csv(rows))
+        archive.writestr(zip_info('manifest.json', zipfile.ZIP_DEFLATED, now), json.dumps(rows, indent=2))
+    yield from sent(output)
+
+
+def sent(output):
+    data = output.take()
+    if data:
+        yield data
@@ -15,3 +15,28 @@ class CommentForm(forms.ModelForm):
         model = Upload
         fields = ['admin_comment']
 
+class DirectUploadForm(UploadForm):
+    # The file itself goes straight from the browser to the bucket; see s3.views.presign_upload.
+    class Meta(UploadForm.Meta):
+        fields = ['title', 'user_comment', 'priority']
+
+
+class ExportForm(forms.Form):
+    # Filters of a report export (s3.export); left blank, a filter matches every report.
+    status = forms.ChoiceField(choices=[('', 'Any status')] + list(Upload.STATUS_CHOICES), required=False)
+    priority = forms.TypedChoiceField(choices=[('', 'Any priority')] + list(Upload.PRIORITY_CHOICES),
+                                      coerce=int, empty_value=None, required=False)
+    created_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    created_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def filter(self, uploads):
+        data = self.cleaned_data
+        if data['status']:
+            uploads = uploads.filter(status=data['status'])
+        if data['priority'] is not None:
+            uploads = uploads.filter(priority=data['priority'])
+        if data['created_from']:
+            uploads = uploads.filter(created_at__date__gte=data['created_from'])
+        if data['created_to']:
+            uploads = uploads.filter(created_at__date__lte=data['created_to'])
+        return uploads
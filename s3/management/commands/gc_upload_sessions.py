@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from s3 import deletion, resumable
+from mysite.storage_backends import PublicMediaStorage
+
+
+class Command(BaseCommand):
+    help = "Abort resumable uploads left unfinished and forget the finished ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=int(resumable.SESSION_TTL.total_seconds()),
+                            help="Abort uploads that received nothing for this many seconds.")
+
+    def handle(self, *args, **options):
+        storage = deletion.get_storage()
+        if not isinstance(storage, PublicMediaStorage):
+            raise CommandError("Resumable uploads need the S3 media storage.")
+        aborted = resumable.collect_garbage(storage, timedelta(seconds=options["max_age"]))
+        self.stdout.write("Aborted %d abandoned upload(s)" % aborted)
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from s3.deletion import BATCH_SIZE, drain
+
+
+class Command(BaseCommand):
+    help = "Delete the stored files of deleted reports, queued in the deletion outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Files to delete per batch.")
+        parser.add_argument("--poll-interval", type=float, default=5.0,
+                            help="Seconds to wait when no deletion is ready.")
+        parser.add_argument("--once", action="store_true", help="Exit once no deletion is ready.")
+
+    def handle(self, *args, **options):
+        while True:
+            deleted, failed = drain(options["batch_size"])
+            if deleted or failed:
+                self.stdout.write("Deleted %d file(s), %d failed" % (deleted, failed))
+            elif options["once"]:
+                return
+            else:
+                time.sleep(options["poll_interval"])
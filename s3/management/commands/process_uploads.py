@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from s3.processing import process_batch, worker_id
+
+
+class Command(BaseCommand):
+    help = "Run queued post-upload processing jobs from the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10, help="Jobs to claim at a time.")
+        parser.add_argument("--poll-interval", type=float, default=2.0,
+                            help="Seconds to wait when no job is ready.")
+        parser.add_argument("--once", action="store_true", help="Exit once no job is ready.")
+
+    def handle(self, *args, **options):
+        worker = worker_id()
+        self.stdout.write("Processing uploads as %s" % worker)
+        while True:
+            claimed = process_batch(worker, options["batch_size"])
+            if claimed:
+                self.stdout.write("Processed %d job(s)" % claimed)
+            elif options["once"]:
+                return
+            else:
+                time.sleep(options["poll_interval"])
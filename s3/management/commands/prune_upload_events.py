@@ -0,0 +1,17 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from s3 import events
+
+
+class Command(BaseCommand):
+    help = "Delete old entries of the report change feed."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-age", type=int, default=int(events.EVENT_TTL.total_seconds()),
+                            help="Delete events older than this many seconds.")
+
+    def handle(self, *args, **options):
+        deleted = events.prune(timedelta(seconds=options["max_age"]))
+        self.stdout.write("Deleted %d event(s)" % deleted)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from s3 import stats
+
+
+class Command(BaseCommand):
+    help = "Recount the staff dashboard counters (UploadCounter) from the reports."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only report the counters that drifted.")
+
+    def handle(self, *args, **options):
+        drift = stats.rebuild(dry_run=options["dry_run"])
+        for (status, priority), ((count, _), (expected, _)) in drift.items():
+            self.stdout.write("%s, priority %s: %d counted, %d stored" % (status, priority, expected, count))
+        verb = "Found" if options["dry_run"] else "Fixed"
+        self.stdout.write("%s %d drifted counter(s)" % (verb, len(drift)))
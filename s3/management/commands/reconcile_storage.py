@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from s3 import deletion
+from s3.models import DeletedObject, Upload
+
+
+class Command(BaseCommand):
+    help = ("Compare the bucket with the database: list stored files no report refers to "
+            "and reports whose file is missing.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-age", type=int, default=24 * 60 * 60,
+                            help="Ignore files younger than this many seconds; they may "
+                                 "belong to an upload still being submitted.")
+        parser.add_argument("--delete-orphans", action="store_true",
+                            help="Queue the orphaned files in the deletion outbox.")
+
+    def handle(self, *args, **options):
+        storage = deletion.get_storage()
+        if not hasattr(storage, "list_names"):
+            raise CommandError("The file storage cannot list its files; reconciliation needs S3.")
+
+        # List the bucket before reading the reports, so a report created meanwhile can
+        # only make a file look referenced, never orphaned.
+        stored = dict(storage.list_names())
+        pending = set(DeletedObject.objects.values_list("name", flat=True))
+        referenced = set()
+        missing = []
+        for pk, file_name, preview_name in Upload.objects.values_list("pk", "file", "preview").iterator():
+            referenced.update((file_name, preview_name))
+            if file_name and file_name not in stored:
+                missing.append((pk, file_name))
+
+        cutoff = timezone.now() - timedelta(seconds=options["min_age"])
+        orphans = sorted(
+            name for name, last_modified in stored.items()
+            if name not in referenced and name not in pending and last_modified < cutoff
+        )
+
+        for name in orphans:
+            self.stdout.write("orphaned file: %s" % name)
+        for pk, name in missing:
+            self.stdout.write("report %s: missing file %s" % (pk, name))
+        self.stdout.write("%d orphaned file(s), %d report(s) with a missing file" % (len(orphans), len(missing)))
+        if options["delete_orphans"] and orphans:
+            deletion.schedule(orphans)
+            self.stdout.write("Queued %d orphaned file(s) for deletion" % len(orphans))
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0009_alter_upload_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='status_rank',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
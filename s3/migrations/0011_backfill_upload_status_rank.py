@@ -0,0 +1,35 @@
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+STATUS_RANKS = {
+    'New': 0,
+    'In Progress': 1,
+    'Resolved': 2,
+}
+
+
+def backfill_status_rank(apps, schema_editor):
+    # Walk the table in primary key ranges so each UPDATE commits on its own and only
+    # ever locks one batch of rows. New rows already default to rank 0 ('New').
+    Upload = apps.get_model('s3', 'Upload')
+    last_pk = Upload.objects.order_by('-pk').values_list('pk', flat=True).first()
+    if last_pk is None:
+        return
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        batch = Upload.objects.filter(pk__gte=start, pk__lt=start + BATCH_SIZE)
+        for status, rank in STATUS_RANKS.items():
+            if rank:
+                batch.filter(status=status).exclude(status_rank=rank).update(status_rank=rank)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('s3', '0010_upload_status_rank'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_status_rank, migrations.RunPython.noop),
+    ]
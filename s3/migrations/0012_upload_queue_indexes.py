@@ -0,0 +1,64 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:11
+
+from django.db import migrations, models
+
+# The queue indexes are built without locking s3_upload against writes: with CREATE
+# INDEX CONCURRENTLY on PostgreSQL, which cannot run in a transaction (hence atomic =
+# False), and as usual on other databases. This is what
+# django.contrib.postgres.operations.AddIndexConcurrently does, without needing psycopg
+# installed to import it.
+
+
+class AddIndexConcurrently(migrations.AddIndex):
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('s3', '0011_backfill_upload_status_rank'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['status_rank', '-id'], name='upload_rank_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['-priority', 'status_rank', '-id'], name='upload_priority_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['status_rank', '-priority', '-id'], name='upload_rank_priority_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['user', '-id'], name='upload_user_recent_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['user', 'status_rank', '-id'], name='upload_user_rank_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['user', '-priority', 'status_rank', '-id'], name='upload_user_priority_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='upload',
+            index=models.Index(fields=['user', 'status_rank', '-priority', '-id'], name='upload_user_rank_prio_idx'),
+        ),
+    ]
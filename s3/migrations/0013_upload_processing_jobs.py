@@ -0,0 +1,37 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0012_upload_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='processing_status',
+            field=models.CharField(blank=True, choices=[('', 'Not queued'), ('Queued', 'Queued'), ('Processing', 'Processing'), ('Done', 'Done'), ('Failed', 'Failed')], default='', editable=False, max_length=20),
+        ),
+        migrations.CreateModel(
+            name='ProcessingJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('Queued', 'Queued'), ('Running', 'Running'), ('Done', 'Done'), ('Failed', 'Failed')], default='Queued', max_length=20)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_by', models.CharField(blank=True, default='', max_length=64)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='processing_jobs', to='s3.upload')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['state', 'available_at'], name='processingjob_ready_idx')],
+            },
+        ),
+    ]
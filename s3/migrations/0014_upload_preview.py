@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0013_upload_processing_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='preview',
+            field=models.FileField(blank=True, default='', editable=False, upload_to=''),
+        ),
+    ]
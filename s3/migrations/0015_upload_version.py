@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0014_upload_preview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+    ]
@@ -0,0 +1,88 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:42
+
+from django.db import migrations, models
+
+# The full-text index is kept by the database itself, so every write path (save(),
+# set-based update(), bulk_create) updates it: a stored generated tsvector column with a
+# GIN index on PostgreSQL, and an external-content FTS5 table kept in step by triggers
+# on SQLite. Other databases get no index; s3.search falls back to LIKE there.
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE s3_upload ADD COLUMN search_vector tsvector GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(user_comment, '') || ' ' || coalesce(admin_comment, '')), 'B') ||
+        setweight(to_tsvector('english', coalesce(extracted_text, '')), 'C')
+    ) STORED
+    """,
+    "CREATE INDEX upload_search_idx ON s3_upload USING GIN (search_vector)",
+]
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS upload_search_idx",
+    "ALTER TABLE s3_upload DROP COLUMN IF EXISTS search_vector",
+]
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE s3_upload_fts USING fts5(
+        title, user_comment, admin_comment, extracted_text,
+        content='s3_upload', content_rowid='id'
+    )
+    """,
+    """
+    CREATE TRIGGER s3_upload_fts_insert AFTER INSERT ON s3_upload BEGIN
+        INSERT INTO s3_upload_fts(rowid, title, user_comment, admin_comment, extracted_text)
+        VALUES (new.id, new.title, new.user_comment, new.admin_comment, new.extracted_text);
+    END
+    """,
+    """
+    CREATE TRIGGER s3_upload_fts_delete AFTER DELETE ON s3_upload BEGIN
+        INSERT INTO s3_upload_fts(s3_upload_fts, rowid, title, user_comment, admin_comment, extracted_text)
+        VALUES ('delete', old.id, old.title, old.user_comment, old.admin_comment, old.extracted_text);
+    END
+    """,
+    # Status, priority and version updates do not touch the indexed columns and skip
+    # the reindex.
+    """
+    CREATE TRIGGER s3_upload_fts_update AFTER UPDATE OF title, user_comment, admin_comment, extracted_text
+    ON s3_upload BEGIN
+        INSERT INTO s3_upload_fts(s3_upload_fts, rowid, title, user_comment, admin_comment, extracted_text)
+        VALUES ('delete', old.id, old.title, old.user_comment, old.admin_comment, old.extracted_text);
+        INSERT INTO s3_upload_fts(rowid, title, user_comment, admin_comment, extracted_text)
+        VALUES (new.id, new.title, new.user_comment, new.admin_comment, new.extracted_text);
+    END
+    """,
+    "INSERT INTO s3_upload_fts(s3_upload_fts) VALUES ('rebuild')",
+]
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS s3_upload_fts_update",
+    "DROP TRIGGER IF EXISTS s3_upload_fts_delete",
+    "DROP TRIGGER IF EXISTS s3_upload_fts_insert",
+    "DROP TABLE IF EXISTS s3_upload_fts",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0017_upload_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='extracted_text',
+            field=models.TextField(blank=True, default='', editable=False),
+        ),
+        migrations.RunPython(
+            run_for_vendor({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            run_for_vendor({'postgresql': POSTGRES_REVERSE, 'sqlite': SQLITE_REVERSE}),
+        ),
+    ]
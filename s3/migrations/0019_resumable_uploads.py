@@ -0,0 +1,49 @@
+# Generated by Django 4.2.4 on 2026-10-18 14:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('s3', '0018_upload_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('session_key', models.CharField(blank=True, default='', max_length=40)),
+                ('name', models.CharField(max_length=100)),
+                ('size', models.PositiveBigIntegerField()),
+                ('multipart_upload_id', models.CharField(max_length=1024)),
+                ('state', models.CharField(choices=[('Open', 'Open'), ('Completed', 'Completed'), ('Aborted', 'Aborted')], default='Open', max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='UploadSessionPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField()),
+                ('size', models.PositiveIntegerField()),
+                ('etag', models.CharField(max_length=255)),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='s3.uploadsession')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='uploadsessionpart',
+            constraint=models.UniqueConstraint(fields=('session', 'number'), name='uploadsessionpart_unique'),
+        ),
+        migrations.AddIndex(
+            model_name='uploadsession',
+            index=models.Index(fields=['state', 'updated_at'], name='uploadsession_state_idx'),
+        ),
+    ]
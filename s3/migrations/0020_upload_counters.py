@@ -0,0 +1,137 @@
+# Generated by Django 4.2.4 on 2026-10-18 15:17
+
+from django.db import migrations, models
+import django.utils.timezone
+
+# UploadCounter is kept by the database itself, so every write path (save(), set-based
+# update(), bulk_create, deletes and cascades) moves reports between its buckets in the
+# same statement: a PL/pgSQL trigger on PostgreSQL, and three triggers on SQLite. Other
+# databases get no triggers; s3.stats counts with GROUP BY there. Reports filed before
+# this migration get its time as created_at.
+
+POSTGRES_FORWARD = [
+    """
+    CREATE FUNCTION s3_uploadcounter_add(counted_status varchar, counted_priority integer, delta integer,
+                                         created timestamptz) RETURNS void AS $$
+        INSERT INTO s3_uploadcounter (status, priority, count, created_total)
+        VALUES (counted_status, counted_priority, delta, delta * EXTRACT(EPOCH FROM created)::bigint)
+        ON CONFLICT (status, priority) DO UPDATE SET
+            count = s3_uploadcounter.count + EXCLUDED.count,
+            created_total = s3_uploadcounter.created_total + EXCLUDED.created_total;
+    $$ LANGUAGE sql
+    """,
+    """
+    CREATE FUNCTION s3_upload_count() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            PERFORM s3_uploadcounter_add(NEW.status, NEW.priority, 1, NEW.created_at);
+        ELSIF TG_OP = 'DELETE' THEN
+            PERFORM s3_uploadcounter_add(OLD.status, OLD.priority, -1, OLD.created_at);
+        ELSIF (OLD.status, OLD.priority, OLD.created_at) IS DISTINCT FROM (NEW.status, NEW.priority, NEW.created_at) THEN
+            -- Lock the two buckets in a fixed order, so opposite moves cannot deadlock.
+            IF (OLD.status, OLD.priority) < (NEW.status, NEW.priority) THEN
+                PERFORM s3_uploadcounter_add(OLD.status, OLD.priority, -1, OLD.created_at);
+                PERFORM s3_uploadcounter_add(NEW.status, NEW.priority, 1, NEW.created_at);
+            ELSE
+                PERFORM s3_uploadcounter_add(NEW.status, NEW.priority, 1, NEW.created_at);
+                PERFORM s3_uploadcounter_add(OLD.status, OLD.priority, -1, OLD.created_at);
+            END IF;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER s3_upload_count AFTER INSERT OR DELETE OR UPDATE OF status, priority, created_at
+    ON s3_upload FOR EACH ROW EXECUTE FUNCTION s3_upload_count()
+    """,
+    """
+    INSERT INTO s3_uploadcounter (status, priority, count, created_total)
+    SELECT status, priority, COUNT(*), SUM(EXTRACT(EPOCH FROM created_at)::bigint)
+    FROM s3_upload GROUP BY status, priority
+    """,
+]
+POSTGRES_REVERSE = [
+    "DROP TRIGGER IF EXISTS s3_upload_count ON s3_upload",
+    "DROP FUNCTION IF EXISTS s3_upload_count()",
+    "DROP FUNCTION IF EXISTS s3_uploadcounter_add(varchar, integer, integer, timestamptz)",
+]
+
+# created_at in Unix seconds; s3.stats.CREATED_SECONDS must stay the same expression.
+SQLITE_CREATED_SECONDS = "CAST(ROUND((julianday({0}.created_at) - 2440587.5) * 86400) AS INTEGER)"
+SQLITE_UPSERT = """
+    INSERT INTO s3_uploadcounter (status, priority, count, created_total)
+    VALUES ({0}.status, {0}.priority, {1}, {1} * %s)
+    ON CONFLICT (status, priority) DO UPDATE SET
+        count = count + excluded.count, created_total = created_total + excluded.created_total;
+""" % SQLITE_CREATED_SECONDS
+
+SQLITE_FORWARD = [
+    """
+    CREATE TRIGGER s3_upload_count_insert AFTER INSERT ON s3_upload BEGIN
+        %s
+    END
+    """ % SQLITE_UPSERT.format('new', 1),
+    """
+    CREATE TRIGGER s3_upload_count_delete AFTER DELETE ON s3_upload BEGIN
+        %s
+    END
+    """ % SQLITE_UPSERT.format('old', -1),
+    """
+    CREATE TRIGGER s3_upload_count_update AFTER UPDATE OF status, priority, created_at ON s3_upload
+    WHEN old.status IS NOT new.status OR old.priority IS NOT new.priority OR old.created_at IS NOT new.created_at
+    BEGIN
+        %s
+        %s
+    END
+    """ % (SQLITE_UPSERT.format('old', -1), SQLITE_UPSERT.format('new', 1)),
+    """
+    INSERT INTO s3_uploadcounter (status, priority, count, created_total)
+    SELECT status, priority, COUNT(*), SUM(%s) FROM s3_upload GROUP BY status, priority
+    """ % SQLITE_CREATED_SECONDS.format('s3_upload'),
+]
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS s3_upload_count_update",
+    "DROP TRIGGER IF EXISTS s3_upload_count_delete",
+    "DROP TRIGGER IF EXISTS s3_upload_count_insert",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0019_resumable_uploads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(max_length=20)),
+                ('priority', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+                ('created_total', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='uploadcounter',
+            constraint=models.UniqueConstraint(fields=('status', 'priority'), name='uploadcounter_unique'),
+        ),
+        migrations.RunPython(
+            run_for_vendor({'postgresql': POSTGRES_FORWARD, 'sqlite': SQLITE_FORWARD}),
+            run_for_vendor({'postgresql': POSTGRES_REVERSE, 'sqlite': SQLITE_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-18 15:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0020_upload_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('upload_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField(blank=True, null=True)),
+                ('action', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='uploadevent_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('s3', '0021_upload_events'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upload',
+            name='admin_comment_excerpt',
+            field=models.CharField(blank=True, default='', editable=False, max_length=160),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='user_comment_excerpt',
+            field=models.CharField(blank=True, default='', editable=False, max_length=160),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+from django.db.models.functions import Concat, Left, Length
+from django.db.models.lookups import GreaterThan
+
+BATCH_SIZE = 1000
+
+# As s3.models.EXCERPT_LENGTH when the excerpt columns were added.
+EXCERPT_LENGTH = 160
+
+
+def excerpt(field):
+    return models.Case(
+        models.When(GreaterThan(Length(field), EXCERPT_LENGTH),
+                    then=Concat(Left(field, EXCERPT_LENGTH - 1), models.Value('…'))),
+        default=models.F(field),
+        output_field=models.CharField(),
+    )
+
+
+def backfill_excerpts(apps, schema_editor):
+    # In primary key ranges, like 0011_backfill_upload_status_rank, so each UPDATE
+    # commits on its own and only locks one batch of rows.
+    Upload = apps.get_model('s3', 'Upload')
+    last_pk = Upload.objects.order_by('-pk').values_list('pk', flat=True).first()
+    if last_pk is None:
+        return
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        Upload.objects.filter(pk__gte=start, pk__lt=start + BATCH_SIZE).update(
+            user_comment_excerpt=excerpt('user_comment'),
+            admin_comment_excerpt=excerpt('admin_comment'),
+        )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('s3', '0022_upload_comment_excerpts'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_excerpts, migrations.RunPython.noop),
+    ]
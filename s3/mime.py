@@ -0,0 +1,44 @@
+import os
+import threading
+
+import magic
+
+# Building a magic.Magic loads and parses the whole magic database, which used to
+# happen on every validation. MimeDetector keeps one handle per thread instead:
+# libmagic handles must not be shared between threads, and a handle created before a
+# fork (gunicorn --preload) is replaced in the child the first time it is used.
+
+def sniff_mime_type(head):
+    """Recognise PDF and JPEG files from their magic numbers without libmagic.
+
+    Returns None for anything else so the caller falls back to libmagic. Text is left
+    to libmagic too: telling plain text from scripts, markup and other text/* types
+    takes its full set of rules.
+    """
+    if head.startswith(b'%PDF-'):
+        return 'application/pdf'
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    return None
+
+
+class MimeDetector:
+    def __init__(self):
+        self.local = threading.local()
+
+    def handle(self):
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.handle = magic.Magic(mime=True)
+            self.local.pid = pid
+        return self.local.handle
+
+    def from_buffer(self, head):
+        return sniff_mime_type(head) or self.handle().from_buffer(head)
+
+
+detector = MimeDetector()
+
+
+def detect_mime_type(head):
+    return detector.from_buffer(head)
@@ -1,24 +1,83 @@
 from django.db import models
 import datetime
-import magic
+import uuid
+from django.utils import timezone
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from django.db.models.functions import Concat, Left, Length
+from django.db.models.lookups import GreaterThan
+from .mime import detect_mime_type
+from .signals import upload_changed
+
+
+MAX_UPLOAD_SIZE = 1024*1024*10
+SUPPORTED_MIME_TYPES = ['application/pdf', 'image/jpeg', 'image/jpg', 'text/plain']
+# How much of the start of a file is handed to libmagic to detect its type.
+MIME_SNIFF_SIZE = 2048
+# Longest comment excerpt stored for the queue cards, ellipsis included.
+EXCERPT_LENGTH = 160
+# Excerpt column kept for each comment column.
+EXCERPT_FIELDS = {
+    'user_comment': 'user_comment_excerpt',
+    'admin_comment': 'admin_comment_excerpt',
+}
+
+
+def excerpt(text):
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    return text[:EXCERPT_LENGTH - 1] + '\u2026'
+
+
+def excerpt_expression(value):
+    # excerpt() in SQL, for updates that set a comment to an expression.
+    return models.Case(
+        models.When(GreaterThan(Length(value), EXCERPT_LENGTH),
+                    then=Concat(Left(value, EXCERPT_LENGTH - 1), models.Value('\u2026'))),
+        default=value,
+        output_field=models.CharField(),
+    )
+
+
+class UploadQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        # Keep the stored status_rank, comment excerpts and version in step for
+        # set-based updates too.
+        if 'status' in kwargs and 'status_rank' not in kwargs:
+            kwargs['status_rank'] = Upload.STATUS_RANKS[kwargs['status']]
+        for field, excerpt_field in EXCERPT_FIELDS.items():
+            if field in kwargs and excerpt_field not in kwargs:
+                value = kwargs[field]
+                kwargs[excerpt_field] = excerpt(value) if isinstance(value, str) else excerpt_expression(value)
+        kwargs.setdefault('version', models.F('version') + 1)
+        return super().update(**kwargs)
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.sync_stored_fields()
+        return super().bulk_create(objs, *args, **kwargs)
 
 
 class Upload(models.Model):
     def validate_mime_type(value):
-        if value.size > 1024*1024*10:
+        if value.size > MAX_UPLOAD_SIZE:
             raise ValidationError(u'File size must be less than 10MB.')
-        supported_types=['application/pdf','image/jpeg','image/jpg','text/plain']
-        m = magic.Magic(mime=True)
-        mime_type = m.from_buffer(value.file.read(2048))
+        mime_type = detect_mime_type(value.file.read(MIME_SNIFF_SIZE))
         value.file.seek(0)
-        if mime_type not in supported_types:
+        if mime_type not in SUPPORTED_MIME_TYPES:
             raise ValidationError(u'Unsupported file type.')
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     title = models.CharField(default="", max_length=40)
     file = models.FileField(validators=[validate_mime_type])
+    # Bounded-size derivative of file for the staff pages; see s3.previews.
+    preview = models.FileField(blank=True, default='', editable=False)
+    # SHA-256 of the file content, hex encoded; blank until known. Reports with the same
+    # hash share one stored file (see StoredObject and s3.dedup).
+    sha256 = models.CharField(max_length=64, blank=True, default='', editable=False)
+    # Text of TXT/PDF files for full-text search, filled in by s3.search.extract_text.
+    extracted_text = models.TextField(blank=True, default='', editable=False)
 
     PRIORITY_CHOICES = (
         (1, 'Lowest Priority'),
@@ -35,9 +94,223 @@ class Upload(models.Model):
     )
     user_comment = models.TextField(default="")
     admin_comment = models.TextField(default="No comment yet")
+    # The start of each comment (see excerpt()), kept in step by save() and update() so
+    # the queue cards never read the full text.
+    user_comment_excerpt = models.CharField(max_length=EXCERPT_LENGTH, blank=True, default='', editable=False)
+    admin_comment_excerpt = models.CharField(max_length=EXCERPT_LENGTH, blank=True, default='', editable=False)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='New')
     priority = models.IntegerField(choices=PRIORITY_CHOICES, default=1)
+    # Position of each status in the "not yet seen" ordering. Stored on the row (instead
+    # of sorting on a CASE expression) so the queue orderings can be served from indexes.
+    STATUS_RANKS = {
+        'New': 0,
+        'In Progress': 1,
+        'Resolved': 2,
+    }
+    status_rank = models.PositiveSmallIntegerField(default=0, editable=False)
+
+    # State of the background processing job (see s3.processing), blank if none was queued.
+    PROCESSING_CHOICES = (
+        ('', 'Not queued'),
+        ('Queued', 'Queued'),
+        ('Processing', 'Processing'),
+        ('Done', 'Done'),
+        ('Failed', 'Failed'),
+    )
+    processing_status = models.CharField(max_length=20, choices=PROCESSING_CHOICES, default='', blank=True, editable=False)
+
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    # Bumped on every write so cached renderings of the row (the queue card fragments)
+    # can be keyed on (id, version).
+    version = models.PositiveIntegerField(default=1, editable=False)
+
+    # Columns a queue card shows, and status_rank that the queues sort on. The list
+    # queries load only these; the detail page reads the full comments.
+    CARD_FIELDS = ['id', 'title', 'status', 'status_rank', 'priority', 'preview', 'user_comment_excerpt',
+                   'admin_comment_excerpt', 'version']
+
+    PRIORITY_IMAGE_NAMES = {
+        1: 'lowest',
+        2: 'low',
+        3: 'mod',
+        4: 'high',
+        5: 'highest',
+    }
+
+    objects = UploadQuerySet.as_manager()
+
+    class Meta:
+        # One index per queue sort mode in login.views.QUEUE_ORDERINGS, for the staff
+        # queue and for a single reporter's queue.
+        indexes = [
+            models.Index(fields=['status_rank', '-id'], name='upload_rank_idx'),
+            models.Index(fields=['-priority', 'status_rank', '-id'], name='upload_priority_idx'),
+            models.Index(fields=['status_rank', '-priority', '-id'], name='upload_rank_priority_idx'),
+            models.Index(fields=['user', '-id'], name='upload_user_recent_idx'),
+            models.Index(fields=['user', 'status_rank', '-id'], name='upload_user_rank_idx'),
+            models.Index(fields=['user', '-priority', 'status_rank', '-id'], name='upload_user_priority_idx'),
+            models.Index(fields=['user', 'status_rank', '-priority', '-id'], name='upload_user_rank_prio_idx'),
+            models.Index(fields=['sha256'], name='upload_sha256_idx'),
+        ]
+
+    @property
+    def priority_image(self):
+        # File name of the priority badge in login/static/images, greyed out once resolved.
+        level = self.PRIORITY_IMAGE_NAMES.get(self.priority)
+        if level is None:
+            return ''
+        return '%s-%s.jpg' % ('res' if self.status == 'Resolved' else 'new', level)
+
+    @property
+    def has_image_preview(self):
+        return bool(self.preview) and self.preview.name.endswith('.jpg')
+
+    def sync_stored_fields(self):
+        # status_rank and the comment excerpts are derived from other columns; recompute
+        # the ones whose source is loaded.
+        deferred = self.get_deferred_fields()
+        if 'status' not in deferred:
+            self.status_rank = self.STATUS_RANKS.get(self.status, 0)
+        for field, excerpt_field in EXCERPT_FIELDS.items():
+            if field not in deferred:
+                setattr(self, excerpt_field, excerpt(getattr(self, field)))
+
+    def save(self, *args, **kwargs):
+        self.sync_stored_fields()
+        created = self._state.adding
+        if not created:
+            self.version += 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'version'}
+            if 'status' in update_fields:
+                kwargs['update_fields'].add('status_rank')
+            kwargs['update_fields'].update(EXCERPT_FIELDS[field] for field in update_fields if field in EXCERPT_FIELDS)
+        super().save(*args, **kwargs)
+        upload_changed.send(sender=Upload, upload_id=self.pk, user_id=self.user_id,
+                            action='created' if created else 'changed')
+
+    def delete(self, *args, **kwargs):
+        upload_id = self.pk
+        result = super().delete(*args, **kwargs)
+        upload_changed.send(sender=Upload, upload_id=upload_id, user_id=self.user_id, action='deleted')
+        return result
+
+
+class UploadCounter(models.Model):
+    """How many reports have each (status, priority), and the sum of their creation
+    times in Unix seconds, so the staff dashboard (s3.stats) never counts Upload rows.
+    Database triggers on s3_upload keep the rows current inside every writing statement;
+    see migration 0020_upload_counters and the rebuild_upload_counters command."""
+    status = models.CharField(max_length=20)
+    priority = models.IntegerField()
+    count = models.IntegerField(default=0)
+    created_total = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['status', 'priority'], name='uploadcounter_unique'),
+        ]
+
+
+class UploadEvent(models.Model):
+    """One entry of the change feed of reports, recorded by s3.events in the transaction
+    of every write that sends upload_changed. The id is the feed position the live staff
+    queue (login.live) resumes from. Not a foreign key, so deletions are kept too."""
+    upload_id = models.BigIntegerField()
+    user_id = models.BigIntegerField(null=True, blank=True)
+    action = models.CharField(max_length=20)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='uploadevent_created_idx'),
+        ]
+
+
+class ProcessingJob(models.Model):
+    """A unit of post-upload work, queued in the database and run by the
+    process_uploads management command."""
+    STATE_CHOICES = (
+        ('Queued', 'Queued'),
+        ('Running', 'Running'),
+        ('Done', 'Done'),
+        ('Failed', 'Failed'),
+    )
+    upload = models.ForeignKey(Upload, on_delete=models.CASCADE, related_name='processing_jobs')
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='Queued')
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=64, blank=True, default='')
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'available_at'], name='processingjob_ready_idx'),
+        ]
+
+
+class StoredObject(models.Model):
+    """A stored file shared by every report whose content has this SHA-256. references
+    counts those reports; the file is deleted once the last of them is."""
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255)
+    size = models.PositiveIntegerField(default=0)
+    references = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
+class DeletedObject(models.Model):
+    """A stored file whose report is gone, waiting in the deletion outbox for the
+    process_deletions management command to remove it from storage."""
+    name = models.CharField(max_length=255)
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['available_at'], name='deletedobject_ready_idx'),
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable upload: the file arrives in numbered chunks, each stored as one part
+    of an S3 multipart upload, and becomes a report once all have arrived. See
+    s3.resumable."""
+    STATE_CHOICES = (
+        ('Open', 'Open'),
+        ('Completed', 'Completed'),
+        ('Aborted', 'Aborted'),
+    )
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    # The owner: the reporter if logged in, otherwise the browser session.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    session_key = models.CharField(max_length=40, blank=True, default='')
+    name = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    multipart_upload_id = models.CharField(max_length=1024)
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default='Open')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'updated_at'], name='uploadsession_state_idx'),
+        ]
 
 
+class UploadSessionPart(models.Model):
+    session = models.ForeignKey(UploadSession, on_delete=models.CASCADE, related_name='parts')
+    number = models.PositiveIntegerField()
+    size = models.PositiveIntegerField()
+    etag = models.CharField(max_length=255)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['session', 'number'], name='uploadsessionpart_unique'),
+        ]
@@ -0,0 +1,105 @@
+import io
+import logging
+
+import pypdfium2
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .mime import detect_mime_type
+from .models import MIME_SNIFF_SIZE, Upload
+from .signals import upload_changed
+
+# Small derivatives of report files, so staff pages do not download the full 10MB
+# original just to look at a report: a resized JPEG for images, a JPEG of the first
+# page for PDFs and the start of the file for text. generate_preview runs as a
+# processing step (s3.processing) and on demand from login.views.upload_preview.
+# The renderer is picked from the file's content, as validated on upload, not from its
+# name; a file it cannot render (a truncated PDF or JPEG) just gets no preview.
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SIZE = (800, 800)
+PREVIEW_QUALITY = 80
+# PDF pages are rendered at this scale (72dpi * 1.5) before being shrunk to PREVIEW_SIZE.
+PDF_RENDER_SCALE = 1.5
+TEXT_EXCERPT_SIZE = 4096
+# Preview kind for each supported MIME type (SUPPORTED_MIME_TYPES).
+MIME_KINDS = {
+    'image/jpeg': 'image',
+    'image/jpg': 'image',
+    'application/pdf': 'pdf',
+    'text/plain': 'text',
+}
+
+
+def file_kind(source):
+    """Preview kind of the open file `source` from its first bytes. Leaves it rewound."""
+    head = source.read(MIME_SNIFF_SIZE)
+    source.seek(0)
+    return MIME_KINDS.get(detect_mime_type(head))
+
+
+def preview_name(upload, kind):
+    extension = '.txt' if kind == 'text' else '.jpg'
+    return 'previews/%s/preview%s' % (upload.pk, extension)
+
+
+def encode_jpeg(image):
+    image.thumbnail(PREVIEW_SIZE)
+    output = io.BytesIO()
+    image.convert('RGB').save(output, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def render_image(source):
+    with Image.open(source) as image:
+        # Let the JPEG decoder downscale while decoding instead of decoding full size.
+        image.draft('RGB', PREVIEW_SIZE)
+        # Apply the EXIF rotation; the re-encoded thumbnail carries no EXIF metadata.
+        return encode_jpeg(ImageOps.exif_transpose(image))
+
+
+def render_pdf(source):
+    document = pypdfium2.PdfDocument(source.read())
+    try:
+        return encode_jpeg(document[0].render(scale=PDF_RENDER_SCALE).to_pil())
+    finally:
+        document.close()
+
+
+def render_text(source):
+    excerpt = source.read(TEXT_EXCERPT_SIZE + 1)
+    text = excerpt[:TEXT_EXCERPT_SIZE].decode('utf-8', errors='ignore')
+    if len(excerpt) > TEXT_EXCERPT_SIZE:
+        text += '\n[...]'
+    return text.encode('utf-8')
+
+
+RENDERERS = {
+    'image': render_image,
+    'pdf': render_pdf,
+    'text': render_text,
+}
+
+
+def generate_preview(upload):
+    """Create the preview for `upload` if it has none yet. Returns True if one exists afterwards."""
+    if upload.preview:
+        return True
+    if not upload.file:
+        return False
+    with upload.file.open('rb') as source:
+        kind = file_kind(source)
+        if kind is None:
+            return False
+        try:
+            data = RENDERERS[kind](source)
+        except Exception:
+            logger.warning("Could not render a preview of upload %s", upload.pk, exc_info=True)
+            return False
+    upload.preview.save(preview_name(upload, kind), ContentFile(data), save=False)
+    with transaction.atomic():
+        Upload.objects.filter(pk=upload.pk).update(preview=upload.preview.name)
+        upload_changed.send(sender=Upload, upload_id=upload.pk, user_id=upload.user_id, action='preview')
+    return True
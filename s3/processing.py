@@ -0,0 +1,101 @@
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import ProcessingJob, Upload
+
+# Post-upload work runs outside the submit request: UploadCreateView and finalize_upload
+# only queue a ProcessingJob, and the process_uploads command picks jobs up in batches.
+# The steps are listed in settings.UPLOAD_PROCESSORS as dotted paths to callables that
+# take an Upload, the same way MIDDLEWARE is configured.
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROCESSORS = [
+    's3.dedup.deduplicate_upload',
+    's3.previews.generate_preview',
+    's3.search.extract_text',
+]
+MAX_ATTEMPTS = 5
+RETRY_DELAY = timedelta(seconds=30)
+# A job still Running after this long is assumed to belong to a dead worker.
+LEASE_TIMEOUT = timedelta(minutes=10)
+
+
+def get_processors():
+    return [import_string(path) for path in getattr(settings, 'UPLOAD_PROCESSORS', DEFAULT_PROCESSORS)]
+
+
+def enqueue(upload):
+    ProcessingJob.objects.create(upload=upload)
+    Upload.objects.filter(pk=upload.pk).update(processing_status='Queued')
+    upload.processing_status = 'Queued'
+
+
+def retry_delay(attempts):
+    return RETRY_DELAY * 2 ** (attempts - 1)
+
+
+def worker_id():
+    return '%s:%s:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def claim_jobs(worker, batch_size):
+    now = timezone.now()
+    ready = ProcessingJob.objects.filter(
+        Q(state='Queued', available_at__lte=now) | Q(state='Running', locked_at__lt=now - LEASE_TIMEOUT)
+    ).order_by('available_at', 'id')
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            ready = ready.select_for_update(skip_locked=True)
+        ids = list(ready.values_list('id', flat=True)[:batch_size])
+        # The state check makes the claim safe on databases without SKIP LOCKED: a job
+        # another worker claimed in the meantime no longer matches and is not updated.
+        ProcessingJob.objects.filter(id__in=ids).filter(
+            Q(state='Queued') | Q(state='Running', locked_at__lt=now - LEASE_TIMEOUT)
+        ).update(state='Running', locked_by=worker, locked_at=now, attempts=F('attempts') + 1)
+    jobs = list(ProcessingJob.objects.filter(id__in=ids, locked_by=worker, state='Running').select_related('upload'))
+    Upload.objects.filter(pk__in=[job.upload_id for job in jobs]).update(processing_status='Processing')
+    return jobs
+
+
+def run_job(job, processors):
+    try:
+        for processor in processors:
+            processor(job.upload)
+    except Exception as error:
+        logger.exception("Processing upload %s failed (attempt %s)", job.upload_id, job.attempts)
+        if job.attempts >= MAX_ATTEMPTS:
+            finish_job(job, 'Failed', 'Failed', last_error=repr(error))
+        else:
+            finish_job(job, 'Queued', 'Queued', last_error=repr(error),
+                       available_at=timezone.now() + retry_delay(job.attempts))
+        return False
+    finish_job(job, 'Done', 'Done', last_error='')
+    return True
+
+
+def finish_job(job, state, processing_status, **fields):
+    with transaction.atomic():
+        ProcessingJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+            state=state, locked_by='', locked_at=None, **fields
+        )
+        Upload.objects.filter(pk=job.upload_id).update(processing_status=processing_status)
+
+
+def process_batch(worker, batch_size=10):
+    """Claim and run up to batch_size ready jobs. Returns the number of jobs claimed."""
+    jobs = claim_jobs(worker, batch_size)
+    if jobs:
+        processors = get_processors()
+        for job in jobs:
+            run_job(job, processors)
+    return len(jobs)
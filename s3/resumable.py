@@ -0,0 +1,140 @@
+import posixpath
+import uuid
+from datetime import timedelta
+
+from botocore.exceptions import ClientError
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from storages.utils import clean_name
+
+from .models import MIME_SNIFF_SIZE, SUPPORTED_MIME_TYPES, UploadSession, UploadSessionPart, detect_mime_type
+from .upload_handlers import PART_SIZE
+
+# Resumable uploads for large files on unreliable connections. The browser opens an
+# UploadSession for a file of a given size, then PUTs it in CHUNK_SIZE chunks (the last
+# one shorter); chunk i goes straight into part i + 1 of an S3 multipart upload, so a
+# dropped connection costs at most one chunk. PUTting a chunk again replaces the part,
+# which makes retries safe, and the session lists the chunks it has so a reload can
+# continue where it stopped. Completing the session assembles the parts into one object.
+# Sessions left open longer than SESSION_TTL are aborted by gc_upload_sessions.
+
+CHUNK_SIZE = PART_SIZE
+SESSION_TTL = timedelta(hours=24)
+# Longest file name kept in the storage name, which must fit Upload.file (100 chars).
+MAX_FILENAME_LENGTH = 50
+
+
+def max_upload_size():
+    return getattr(settings, 'RESUMABLE_MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+
+
+def chunk_count(size):
+    return (size + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+
+def chunk_size(upload_session, index):
+    """The exact size chunk `index` of the session must have."""
+    return min(CHUNK_SIZE, upload_session.size - index * CHUNK_SIZE)
+
+
+def storage_key(storage, upload_session):
+    return storage._normalize_name(clean_name(upload_session.name))
+
+
+def storage_name(filename):
+    filename = get_valid_filename(posixpath.basename(filename.replace('\\', '/')) or 'report')
+    root, extension = posixpath.splitext(filename)
+    if len(filename) > MAX_FILENAME_LENGTH:
+        filename = root[:MAX_FILENAME_LENGTH - len(extension)] + extension
+    return 'resumable/%s/%s' % (uuid.uuid4().hex, filename)
+
+
+def start(storage, filename, size, user=None, session_key=''):
+    if not 0 < size <= max_upload_size():
+        raise ValidationError('File size must be less than %dMB.' % (max_upload_size() // (1024 * 1024)))
+    name = storage_name(filename)
+    key = storage._normalize_name(clean_name(name))
+    response = storage.connection.meta.client.create_multipart_upload(
+        Bucket=storage.bucket_name, Key=key, **storage._get_write_parameters(key)
+    )
+    return UploadSession.objects.create(
+        user=user, session_key=session_key, name=name, size=size, multipart_upload_id=response['UploadId'],
+    )
+
+
+def describe(upload_session):
+    return {
+        'id': str(upload_session.id),
+        'state': upload_session.state,
+        'size': upload_session.size,
+        'chunk_size': CHUNK_SIZE,
+        'chunk_count': chunk_count(upload_session.size),
+        'received': sorted(number - 1 for number in upload_session.parts.values_list('number', flat=True)),
+    }
+
+
+def store_chunk(storage, upload_session, index, data):
+    if upload_session.state != 'Open':
+        raise ValidationError('This upload is no longer open.')
+    if not 0 <= index < chunk_count(upload_session.size):
+        raise ValidationError('There is no chunk %d.' % index)
+    if len(data) != chunk_size(upload_session, index):
+        raise ValidationError('Chunk %d must be %d bytes.' % (index, chunk_size(upload_session, index)))
+    if index == 0 and detect_mime_type(data[:MIME_SNIFF_SIZE]) not in SUPPORTED_MIME_TYPES:
+        abort(storage, upload_session)
+        raise ValidationError('Unsupported file type.')
+    response = storage.connection.meta.client.upload_part(
+        Bucket=storage.bucket_name, Key=storage_key(storage, upload_session),
+        UploadId=upload_session.multipart_upload_id, PartNumber=index + 1, Body=data,
+    )
+    UploadSessionPart.objects.update_or_create(
+        session=upload_session, number=index + 1, defaults={'size': len(data), 'etag': response['ETag']},
+    )
+    UploadSession.objects.filter(pk=upload_session.pk).update(updated_at=timezone.now())
+
+
+def complete(storage, upload_session):
+    """Assemble the uploaded chunks into the stored file. Returns its storage name."""
+    with transaction.atomic():
+        upload_session = UploadSession.objects.select_for_update().get(pk=upload_session.pk)
+        if upload_session.state != 'Open':
+            raise ValidationError('This upload is no longer open.')
+        parts = list(upload_session.parts.order_by('number'))
+        if [part.number for part in parts] != list(range(1, chunk_count(upload_session.size) + 1)):
+            raise ValidationError('Some chunks have not been uploaded yet.')
+        storage.connection.meta.client.complete_multipart_upload(
+            Bucket=storage.bucket_name, Key=storage_key(storage, upload_session),
+            UploadId=upload_session.multipart_upload_id,
+            MultipartUpload={'Parts': [{'ETag': part.etag, 'PartNumber': part.number} for part in parts]},
+        )
+        upload_session.state = 'Completed'
+        upload_session.save(update_fields=['state', 'updated_at'])
+    return upload_session.name
+
+
+def abort(storage, upload_session):
+    try:
+        storage.connection.meta.client.abort_multipart_upload(
+            Bucket=storage.bucket_name, Key=storage_key(storage, upload_session),
+            UploadId=upload_session.multipart_upload_id,
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'NoSuchUpload':
+            raise
+    UploadSession.objects.filter(pk=upload_session.pk, state='Open').update(state='Aborted')
+    upload_session.parts.all().delete()
+    upload_session.state = 'Aborted'
+
+
+def collect_garbage(storage, max_age=SESSION_TTL):
+    """Abort sessions idle for longer than max_age and forget finished ones. Returns the
+    number of sessions aborted."""
+    cutoff = timezone.now() - max_age
+    stale = list(UploadSession.objects.filter(state='Open', updated_at__lt=cutoff))
+    for upload_session in stale:
+        abort(storage, upload_session)
+    UploadSession.objects.filter(state__in=['Completed', 'Aborted'], updated_at__lt=cutoff).delete()
+    return len(stale)
@@ -0,0 +1,145 @@
+import re
+
+import pypdfium2
+from django.db import connection, connections
+from django.db.models import Q
+
+from .models import Upload
+from .previews import file_kind
+
+# Full-text search over report titles, comments and the text of TXT/PDF evidence. The
+# index lives in the database (see migration 0018_upload_search): a GIN-indexed
+# tsvector column on PostgreSQL and an FTS5 table on SQLite, both ranked with the
+# title weighted above the comments and the comments above the file text. Other
+# databases fall back to an unranked LIKE scan.
+
+# Only this much of a file's text is indexed.
+EXTRACT_LIMIT = 100 * 1024
+PDF_EXTRACT_PAGES = 20
+MAX_TERMS = 10
+
+# bm25() weights of the title, user_comment, admin_comment and extracted_text columns.
+SQLITE_WEIGHTS = (10.0, 4.0, 4.0, 1.0)
+
+# SQLite drops a table's triggers when a migration rebuilds it, so they are checked
+# (and the FTS table rebuilt if any were missing) after every migrate.
+SQLITE_TRIGGERS = {
+    's3_upload_fts_insert': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_fts_insert AFTER INSERT ON s3_upload BEGIN
+            INSERT INTO s3_upload_fts(rowid, title, user_comment, admin_comment, extracted_text)
+            VALUES (new.id, new.title, new.user_comment, new.admin_comment, new.extracted_text);
+        END
+    """,
+    's3_upload_fts_delete': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_fts_delete AFTER DELETE ON s3_upload BEGIN
+            INSERT INTO s3_upload_fts(s3_upload_fts, rowid, title, user_comment, admin_comment, extracted_text)
+            VALUES ('delete', old.id, old.title, old.user_comment, old.admin_comment, old.extracted_text);
+        END
+    """,
+    's3_upload_fts_update': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_fts_update
+        AFTER UPDATE OF title, user_comment, admin_comment, extracted_text ON s3_upload BEGIN
+            INSERT INTO s3_upload_fts(s3_upload_fts, rowid, title, user_comment, admin_comment, extracted_text)
+            VALUES ('delete', old.id, old.title, old.user_comment, old.admin_comment, old.extracted_text);
+            INSERT INTO s3_upload_fts(rowid, title, user_comment, admin_comment, extracted_text)
+            VALUES (new.id, new.title, new.user_comment, new.admin_comment, new.extracted_text);
+        END
+    """,
+}
+
+
+def ensure_sqlite_triggers(sender=None, using='default', **kwargs):
+    # Connected to post_migrate in S3Config.ready.
+    database = connections[using]
+    if database.vendor != 'sqlite':
+        return
+    with database.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE %s",
+                       ['s3_upload_fts%'])
+        existing = {row[0] for row in cursor.fetchall()}
+        if 's3_upload_fts' not in existing or existing.issuperset(SQLITE_TRIGGERS):
+            return
+        for name, statement in SQLITE_TRIGGERS.items():
+            if name not in existing:
+                cursor.execute(statement)
+        cursor.execute("INSERT INTO s3_upload_fts(s3_upload_fts) VALUES ('rebuild')")
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)[:MAX_TERMS]
+
+
+def ranked_ids(terms, offset, limit):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT id FROM s3_upload, plainto_tsquery('english', %s) query "
+                "WHERE search_vector @@ query "
+                "ORDER BY ts_rank(search_vector, query) DESC, id DESC LIMIT %s OFFSET %s",
+                [' '.join(terms), limit, offset],
+            )
+        else:
+            # Every term is quoted, so user input can never be read as FTS5 syntax; the
+            # last one also matches as a prefix, for search-as-you-type.
+            match = ' '.join('"%s"' % term for term in terms) + '*'
+            cursor.execute(
+                "SELECT rowid FROM s3_upload_fts WHERE s3_upload_fts MATCH %%s "
+                "ORDER BY bm25(s3_upload_fts, %s), rowid DESC LIMIT %%s OFFSET %%s"
+                % ', '.join(str(weight) for weight in SQLITE_WEIGHTS),
+                [match, limit, offset],
+            )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def search(query, offset=0, limit=25):
+    """Return (reports matching `query` best first, whether there are more)."""
+    terms = search_terms(query)
+    if not terms:
+        return [], False
+    if connection.vendor in ('postgresql', 'sqlite'):
+        ids = ranked_ids(terms, offset, limit + 1)
+        uploads = Upload.objects.only(*Upload.CARD_FIELDS).in_bulk(ids[:limit])
+        return [uploads[pk] for pk in ids[:limit] if pk in uploads], len(ids) > limit
+    matches = Q()
+    for term in terms:
+        matches &= (Q(title__icontains=term) | Q(user_comment__icontains=term)
+                    | Q(admin_comment__icontains=term) | Q(extracted_text__icontains=term))
+    uploads = list(Upload.objects.only(*Upload.CARD_FIELDS).filter(matches).order_by('-id')[offset:offset + limit + 1])
+    return uploads[:limit], len(uploads) > limit
+
+
+def extract_pdf_text(source):
+    document = pypdfium2.PdfDocument(source.read())
+    try:
+        parts = []
+        length = 0
+        for index in range(min(len(document), PDF_EXTRACT_PAGES)):
+            text = document[index].get_textpage().get_text_range()
+            parts.append(text)
+            length += len(text)
+            if length >= EXTRACT_LIMIT:
+                break
+        return '\n'.join(parts)
+    finally:
+        document.close()
+
+
+def extract_text(upload):
+    """Processing step: store the text of TXT and PDF files for the search index."""
+    if not upload.file or upload.extracted_text:
+        return
+    with upload.file.open('rb') as source:
+        # Picked from the content like the preview; an unreadable PDF has no text.
+        kind = file_kind(source)
+        if kind == 'text':
+            text = source.read(EXTRACT_LIMIT).decode('utf-8', errors='ignore')
+        elif kind == 'pdf':
+            try:
+                text = extract_pdf_text(source)
+            except pypdfium2.PdfiumError:
+                return
+        else:
+            return
+    text = text.replace('\x00', '')[:EXTRACT_LIMIT]
+    Upload.objects.filter(pk=upload.pk).update(extracted_text=text)
+    upload.extracted_text = text
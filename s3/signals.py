@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent whenever a report is created, changed or deleted, with upload_id, user_id (the
+# reporter, may be None) and action ("created", "status", "resolved", "priority",
+# "comment", "preview", "changed" or "deleted"). Upload.save()/delete() send it themselves; code
+# that writes with a set-based .update() must send it explicitly, since that bypasses
+# the model. Receivers run inside the writer's transaction.
+upload_changed = Signal()
@@ -0,0 +1,156 @@
+import datetime
+from collections import defaultdict
+
+from django.db import connection, connections, transaction
+from django.db.models import Count
+
+from .models import Upload, UploadCounter
+
+# Aggregate numbers for the staff dashboard. They are read from UploadCounter, one row
+# per (status, priority), which triggers on s3_upload keep current in the same
+# statement as every insert, update and delete (see migration 0020_upload_counters), so
+# bulk_create() and set-based update() are counted too. Building the dashboard costs
+# the same however many reports there are: one query over those few rows, plus an
+# index seek on upload_rank_idx per open status for the oldest report. On databases
+# without the triggers the numbers are counted with GROUP BY instead.
+
+OPEN_STATUSES = [status for status, _ in Upload.STATUS_CHOICES if status != 'Resolved']
+
+# created_at in Unix seconds, as the triggers compute it; rebuild() sums the same
+# expression so the two always agree.
+CREATED_SECONDS = {
+    'postgresql': "EXTRACT(EPOCH FROM {0}.created_at)::bigint",
+    'sqlite': "CAST(ROUND((julianday({0}.created_at) - 2440587.5) * 86400) AS INTEGER)",
+}
+
+SQLITE_UPSERT = """
+    INSERT INTO s3_uploadcounter (status, priority, count, created_total)
+    VALUES ({0}.status, {0}.priority, {1}, {1} * %s)
+    ON CONFLICT (status, priority) DO UPDATE SET
+        count = count + excluded.count, created_total = created_total + excluded.created_total;
+""" % CREATED_SECONDS['sqlite']
+
+# SQLite drops a table's triggers when a migration rebuilds it; they are put back (and
+# the counters recounted) after every migrate, like the search triggers.
+SQLITE_TRIGGERS = {
+    's3_upload_count_insert': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_count_insert AFTER INSERT ON s3_upload BEGIN
+            %s
+        END
+    """ % SQLITE_UPSERT.format('new', 1),
+    's3_upload_count_delete': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_count_delete AFTER DELETE ON s3_upload BEGIN
+            %s
+        END
+    """ % SQLITE_UPSERT.format('old', -1),
+    's3_upload_count_update': """
+        CREATE TRIGGER IF NOT EXISTS s3_upload_count_update AFTER UPDATE OF status, priority, created_at ON s3_upload
+        WHEN old.status IS NOT new.status OR old.priority IS NOT new.priority OR old.created_at IS NOT new.created_at
+        BEGIN
+            %s
+            %s
+        END
+    """ % (SQLITE_UPSERT.format('old', -1), SQLITE_UPSERT.format('new', 1)),
+}
+
+
+def counted(database=None):
+    return (database or connection).vendor in CREATED_SECONDS
+
+
+def ensure_sqlite_triggers(sender=None, using='default', **kwargs):
+    # Connected to post_migrate in S3Config.ready.
+    database = connections[using]
+    if database.vendor != 'sqlite':
+        return
+    with database.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger') AND name LIKE %s",
+                       ['s3_upload%'])
+        existing = {row[0] for row in cursor.fetchall()}
+    if 's3_uploadcounter' not in existing or existing.issuperset(SQLITE_TRIGGERS):
+        return
+    with transaction.atomic(using=using), database.cursor() as cursor:
+        for name, statement in SQLITE_TRIGGERS.items():
+            if name not in existing:
+                cursor.execute(statement)
+    rebuild(using=using)
+
+
+def count_uploads(using='default'):
+    """{(status, priority): (count, created_total)} counted from the Upload table."""
+    database = connections[using]
+    with database.cursor() as cursor:
+        cursor.execute(
+            "SELECT status, priority, COUNT(*), SUM(%s) FROM s3_upload GROUP BY status, priority"
+            % CREATED_SECONDS[database.vendor].format('s3_upload')
+        )
+        return {(status, priority): (count, int(total)) for status, priority, count, total in cursor.fetchall()}
+
+
+def rebuild(dry_run=False, using='default'):
+    """Recount UploadCounter from the Upload table and return the buckets that had
+    drifted, as {(status, priority): (stored (count, created_total), recounted)}.
+
+    On PostgreSQL the counter table is locked before the reports are read, so a write
+    that lands meanwhile is either in the recount or applies its change after the
+    rebuild commits. SQLite lets one writer in at a time anyway."""
+    database = connections[using]
+    with transaction.atomic(using=using):
+        if database.vendor == 'postgresql':
+            with database.cursor() as cursor:
+                cursor.execute("LOCK TABLE s3_uploadcounter IN SHARE ROW EXCLUSIVE MODE")
+        stored = {(c.status, c.priority): c for c in UploadCounter.objects.using(using)}
+        recounted = count_uploads(using)
+        drift = {}
+        for key in sorted(set(stored) | set(recounted)):
+            current = (stored[key].count, stored[key].created_total) if key in stored else (0, 0)
+            expected = recounted.get(key, (0, 0))
+            if current != expected:
+                drift[key] = (current, expected)
+        if not dry_run:
+            for (status, priority), (current, (count, created_total)) in drift.items():
+                UploadCounter.objects.using(using).update_or_create(
+                    status=status, priority=priority, defaults={'count': count, 'created_total': created_total},
+                )
+    return drift
+
+
+def bucket_counts():
+    if counted():
+        return [(c.status, c.priority, c.count, c.created_total) for c in UploadCounter.objects.filter(count__gt=0)]
+    return [(row['status'], row['priority'], row['count'], None)
+            for row in Upload.objects.order_by().values('status', 'priority').annotate(count=Count('id'))]
+
+
+def dashboard():
+    by_status = defaultdict(int)
+    by_priority = defaultdict(int)
+    open_count = 0
+    open_created_total = 0
+    for status, priority, count, created_total in bucket_counts():
+        by_status[status] += count
+        if status in OPEN_STATUSES:
+            by_priority[priority] += count
+            open_count += count
+            if created_total is not None:
+                open_created_total += created_total
+    # Ids grow with created_at, so the lowest open id is the oldest open report.
+    oldest = [
+        Upload.objects.filter(status_rank=Upload.STATUS_RANKS[status]).order_by('id')
+        .values_list('created_at', flat=True).first()
+        for status in OPEN_STATUSES
+    ]
+    oldest = min((created_at for created_at in oldest if created_at is not None), default=None)
+    mean_open_created = None
+    if open_count and counted():
+        mean_open_created = datetime.datetime.fromtimestamp(open_created_total / open_count, datetime.timezone.utc)
+    return {
+        'total': sum(by_status.values()),
+        'by_status': [(label, by_status[status]) for status, label in Upload.STATUS_CHOICES],
+        # Priorities of the reports still open, highest first.
+        'open_by_priority': [(label, by_priority[priority]) for priority, label in reversed(Upload.PRIORITY_CHOICES)],
+        'open': open_count,
+        # When the average and the oldest open report were filed; the template shows their age.
+        'mean_open_created': mean_open_created,
+        'oldest_open_created': oldest,
+    }
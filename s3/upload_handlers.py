@@ -0,0 +1,157 @@
+import hashlib
+import io
+import uuid
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from storages.utils import clean_name
+
+from .dedup import stored_name as stored_name_for
+from .models import MAX_UPLOAD_SIZE, MIME_SNIFF_SIZE, SUPPORTED_MIME_TYPES, detect_mime_type
+
+# S3 rejects multipart parts smaller than 5MB, except for the last one.
+PART_SIZE = 5 * 1024 * 1024
+
+
+class S3StreamedFile(UploadedFile):
+    """A file that S3MultipartUploadHandler has already written to the bucket.
+
+    Only the first MIME_SNIFF_SIZE bytes are kept in memory, which is all
+    Upload.validate_mime_type reads. stored_name is the storage name of the object, or
+    None if the upload was rejected and nothing was stored. sha256 is the hash of the
+    whole file; if it matched an already stored file, stored_name is that file's name
+    and reused is True.
+    """
+
+    def __init__(self, storage, stored_name, head, name, content_type, size, charset, content_type_extra,
+                 sha256=None, reused=False):
+        super().__init__(io.BytesIO(head), name, content_type, size, charset, content_type_extra)
+        self.storage = storage
+        self.stored_name = stored_name
+        self.sha256 = sha256
+        self.reused = reused
+
+    def discard(self):
+        # A reused file belongs to other reports and stays.
+        if self.stored_name is not None and not self.reused:
+            self.storage.delete(self.stored_name)
+            self.stored_name = None
+
+
+class S3MultipartUploadHandler(FileUploadHandler):
+    """Streams uploaded files into the bucket while the request body is still being read.
+
+    Data is sent to S3 in PART_SIZE multipart parts, so a worker never holds more than
+    one part of a file, and the file is not uploaded a second time when the form is
+    saved (see PublicMediaStorage.save). The file is hashed on the way, and if an
+    identical file is already stored the last part is never sent and the multipart
+    upload is aborted instead (see s3.dedup). Files over MAX_UPLOAD_SIZE, or whose first
+    bytes are not a supported type, are dropped as soon as that is known; the rest of
+    their data is only counted so the form can report the error.
+    """
+
+    def __init__(self, request=None, storage=None):
+        super().__init__(request)
+        self.storage = storage
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        # The object is only written once the whole file has arrived, so a name checked
+        # for availability now could be taken by then; a random directory keeps
+        # concurrent uploads of the same file name apart, as presign_upload does.
+        self.stored_name = self.storage.generate_filename('uploads/%s/%s' % (uuid.uuid4().hex, file_name))
+        self.key = self.storage._normalize_name(clean_name(self.stored_name))
+        self.client = self.storage.connection.meta.client
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.head = b''
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.rejected = content_length is not None and content_length > MAX_UPLOAD_SIZE
+        # Keep the default memory/temporary-file handlers from buffering a second copy.
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.size += len(raw_data)
+        if self.rejected:
+            return None
+        if len(self.head) < MIME_SNIFF_SIZE:
+            self.head += raw_data[:MIME_SNIFF_SIZE - len(self.head)]
+            if len(self.head) == MIME_SNIFF_SIZE and not self.is_supported():
+                self.reject()
+                return None
+        if self.size > MAX_UPLOAD_SIZE:
+            self.reject()
+            return None
+        self.sha256.update(raw_data)
+        self.buffer += raw_data
+        if len(self.buffer) >= PART_SIZE:
+            self.upload_part()
+        return None
+
+    def file_complete(self, file_size):
+        if not self.rejected and len(self.head) < MIME_SNIFF_SIZE and not self.is_supported():
+            self.reject()
+        stored_name = None
+        digest = None
+        reused = False
+        if not self.rejected and self.size:
+            digest = self.sha256.hexdigest()
+            stored_name = stored_name_for(digest)
+            reused = stored_name is not None
+            if reused:
+                if self.upload_id is not None:
+                    self.abort()
+            elif self.upload_id is None:
+                # Small files fit in a single request; no need for a multipart upload.
+                self.client.put_object(
+                    Bucket=self.storage.bucket_name, Key=self.key, Body=bytes(self.buffer), **self.write_parameters()
+                )
+                stored_name = self.stored_name
+            else:
+                if self.buffer:
+                    self.upload_part()
+                self.client.complete_multipart_upload(
+                    Bucket=self.storage.bucket_name, Key=self.key, UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts},
+                )
+                stored_name = self.stored_name
+        self.buffer = bytearray()
+        return S3StreamedFile(
+            self.storage, stored_name, self.head, self.file_name, self.content_type, self.size,
+            self.charset, self.content_type_extra, sha256=digest, reused=reused,
+        )
+
+    def upload_interrupted(self):
+        if getattr(self, 'upload_id', None) is not None:
+            self.abort()
+
+    def is_supported(self):
+        return detect_mime_type(self.head) in SUPPORTED_MIME_TYPES
+
+    def write_parameters(self):
+        return self.storage._get_write_parameters(self.key)
+
+    def upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.storage.bucket_name, Key=self.key, **self.write_parameters()
+            )['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.storage.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer),
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def abort(self):
+        self.client.abort_multipart_upload(Bucket=self.storage.bucket_name, Key=self.key, UploadId=self.upload_id)
+        self.upload_id = None
+
+    def reject(self):
+        if self.upload_id is not None:
+            self.abort()
+        self.rejected = True
+        self.buffer = bytearray()
@@ -1,8 +1,20 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# See login/urls.py.
+ASYNC_VIEWS = getattr(settings, "ASYNC_VIEWS", False)
+
 app_name = "s3"
 urlpatterns = [
     path("", views.UploadCreateView.as_view(), name="submission_page"),
     path("submit", views.submit, name="submit"),
-]
\ No newline at end of file
+    path("direct", views.direct_submission_page, name="direct_submission_page"),
+    path("direct/presign", views.presign_upload, name="presign_upload"),
+    path("direct/finalize", views.afinalize_upload if ASYNC_VIEWS else views.finalize_upload, name="finalize_upload"),
+    path("resumable", views.resumable_submission_page, name="resumable_submission_page"),
+    path("resumable/start", views.start_resumable_upload, name="start_resumable_upload"),
+    path("resumable/<uuid:session_id>", views.resumable_upload_status, name="resumable_upload_status"),
+    path("resumable/<uuid:session_id>/chunks/<int:index>", views.upload_chunk, name="upload_chunk"),
+    path("resumable/<uuid:session_id>/complete", views.complete_resumable_upload, name="complete_resumable_upload"),
+]
@@ -1,18 +1,44 @@
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
-from django.shortcuts import render, redirect
+import posixpath
+import uuid
+from asgiref.sync import sync_to_async
+from botocore.exceptions import ClientError
+from django.http import Http404, HttpResponseNotAllowed, JsonResponse
+from django.core.exceptions import ValidationError
+from django.shortcuts import get_object_or_404, render, redirect
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
 from django.views.generic.edit import CreateView
-from .forms import UploadForm
-from .models import Upload
-from django.urls import reverse_lazy
+from .forms import UploadForm, DirectUploadForm
+from .models import Upload, UploadSession, MAX_UPLOAD_SIZE, MIME_SNIFF_SIZE, SUPPORTED_MIME_TYPES, detect_mime_type
+from django.urls import reverse, reverse_lazy
+from django.utils.text import get_valid_filename
 from django.views.generic import View
 from django.contrib import messages
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from mysite.storage_backends import PublicMediaStorage
+from .upload_handlers import S3MultipartUploadHandler
+from .processing import enqueue
+from .dedup import save_upload
+from . import aio, resumable
+from .aio import request_user
 
 
+# CSRF is checked in dispatch() instead of by the middleware: the middleware reads
+# request.POST, and upload handlers can only be changed before the body is parsed.
+@method_decorator(csrf_exempt, name='dispatch')
 class UploadCreateView(CreateView):
     model = Upload
     form_class = UploadForm
     success_url = reverse_lazy("s3:submit")
+
+    def dispatch(self, request, *args, **kwargs):
+        storage = Upload._meta.get_field('file').storage
+        if isinstance(storage, PublicMediaStorage):
+            request.upload_handlers.insert(0, S3MultipartUploadHandler(request, storage))
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         uploads = Upload.objects.all()
@@ -24,8 +50,189 @@ class UploadCreateView(CreateView):
     def form_valid(self, form):
         if self.request.user.is_authenticated:
             form.instance.user = self.request.user
-        return super().form_valid(form)
+        self.object = save_upload(form.save(commit=False))
+        enqueue(self.object)
+        return redirect(self.get_success_url())
+
+    def form_invalid(self, form):
+        # A streamed file is already in the bucket by the time the form is validated.
+        for uploaded_file in self.request.FILES.values():
+            if hasattr(uploaded_file, 'discard'):
+                uploaded_file.discard()
+        return super().form_invalid(form)
 
 def submit(request):
     return redirect('login:mainpage')
 
+# Direct-to-bucket submissions: the browser asks presign_upload for a presigned POST,
+# uploads the file to S3 itself, then calls finalize_upload to validate the object and
+# create the report. Only the form fields and a 2KB ranged read touch the web tier.
+
+DIRECT_UPLOAD_SESSION_KEY = 'direct_upload_names'
+
+def direct_upload_storage():
+    storage = Upload._meta.get_field('file').storage
+    if not isinstance(storage, PublicMediaStorage):
+        raise Http404("Direct uploads need the S3 media storage.")
+    return storage
+
+def direct_submission_page(request):
+    direct_upload_storage()
+    return render(request, 's3/direct_upload_form.html', {
+        'form': DirectUploadForm(),
+        'max_upload_size': MAX_UPLOAD_SIZE,
+        'supported_types': SUPPORTED_MIME_TYPES,
+    })
+
+@require_POST
+def presign_upload(request):
+    storage = direct_upload_storage()
+    content_type = request.POST.get('content_type', '')
+    if content_type not in SUPPORTED_MIME_TYPES:
+        return JsonResponse({'error': 'Unsupported file type.'}, status=400)
+    filename = get_valid_filename(posixpath.basename(request.POST.get('filename', '').replace('\\', '/')) or 'report')
+    name = 'direct/%s/%s' % (uuid.uuid4().hex, filename)
+    post = storage.presigned_post(name, content_type, MAX_UPLOAD_SIZE)
+    # Remember which names this browser may finalize so nobody can claim another's object.
+    request.session[DIRECT_UPLOAD_SESSION_KEY] = request.session.get(DIRECT_UPLOAD_SESSION_KEY, [])[-9:] + [name]
+    return JsonResponse({'name': name, 'url': post['url'], 'fields': post['fields']})
+
+def stored_file_error(head, size):
+    if size > MAX_UPLOAD_SIZE:
+        return 'File size must be less than 10MB.'
+    if detect_mime_type(head) not in SUPPORTED_MIME_TYPES:
+        return 'Unsupported file type.'
+    return None
+
+def unreadable_file_response(error):
+    # NoSuchKey: the browser never finished its POST to the bucket.
+    if error.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+        return JsonResponse({'error': 'The file was not uploaded.'}, status=404)
+    return JsonResponse({'error': 'The file could not be read.'}, status=400)
+
+def create_direct_upload(request, form, name):
+    form.instance.file = name
+    if request.user.is_authenticated:
+        form.instance.user = request.user
+    enqueue(form.save())
+    request.session[DIRECT_UPLOAD_SESSION_KEY] = [n for n in request.session[DIRECT_UPLOAD_SESSION_KEY] if n != name]
+
+@require_POST
+def finalize_upload(request):
+    storage = direct_upload_storage()
+    name = request.POST.get('name', '')
+    if name not in request.session.get(DIRECT_UPLOAD_SESSION_KEY, []):
+        return JsonResponse({'error': 'Unknown upload.'}, status=403)
+    form = DirectUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    try:
+        head, size = storage.read_head(name, MIME_SNIFF_SIZE)
+    except ClientError as client_error:
+        return unreadable_file_response(client_error)
+    error = stored_file_error(head, size)
+    if error:
+        storage.delete(name)
+        return JsonResponse({'error': error}, status=400)
+    create_direct_upload(request, form, name)
+    return JsonResponse({'redirect': reverse('s3:submit')})
+
+async def afinalize_upload(request):
+    # Async version of finalize_upload, routed in its place when settings.ASYNC_VIEWS is
+    # on. The ranged GET (and the delete of a rejected file) run on the S3 threads of
+    # s3.aio, so waiting on the bucket does not hold a thread of the request's own.
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    storage = direct_upload_storage()
+    await request_user(request)
+    name = request.POST.get('name', '')
+    if name not in request.session.get(DIRECT_UPLOAD_SESSION_KEY, []):
+        return JsonResponse({'error': 'Unknown upload.'}, status=403)
+    form = DirectUploadForm(request.POST)
+    if not await sync_to_async(form.is_valid)():
+        return JsonResponse({'errors': form.errors}, status=400)
+    try:
+        head, size = await aio.run(storage.read_head, name, MIME_SNIFF_SIZE)
+    except ClientError as client_error:
+        return unreadable_file_response(client_error)
+    error = stored_file_error(head, size)
+    if error:
+        await aio.run(storage.delete, name)
+        return JsonResponse({'error': error}, status=400)
+    await sync_to_async(create_direct_upload)(request, form, name)
+    return JsonResponse({'redirect': reverse('s3:submit')})
+
+# Resumable chunked submissions for large files; the protocol is described in
+# s3.resumable. Every call after the first checks that the session belongs to the
+# logged-in reporter, or to this browser for anonymous reports.
+
+def resumable_submission_page(request):
+    direct_upload_storage()
+    return render(request, 's3/resumable_upload_form.html', {
+        'form': DirectUploadForm(),
+        'max_upload_size': resumable.max_upload_size(),
+        'supported_types': SUPPORTED_MIME_TYPES,
+    })
+
+def owned_upload_session(request, session_id):
+    upload_session = get_object_or_404(UploadSession, pk=session_id)
+    if upload_session.user_id is not None:
+        owner = request.user.is_authenticated and request.user.pk == upload_session.user_id
+    else:
+        owner = bool(upload_session.session_key) and upload_session.session_key == request.session.session_key
+    if not owner:
+        raise Http404("No such upload.")
+    return upload_session
+
+@require_POST
+def start_resumable_upload(request):
+    storage = direct_upload_storage()
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'error': 'Missing file size.'}, status=400)
+    if request.user.is_authenticated:
+        owner = {'user': request.user}
+    else:
+        if request.session.session_key is None:
+            request.session.save()
+        owner = {'session_key': request.session.session_key}
+    try:
+        upload_session = resumable.start(storage, request.POST.get('filename', ''), size, **owner)
+    except ValidationError as error:
+        return JsonResponse({'error': error.messages[0]}, status=400)
+    return JsonResponse(resumable.describe(upload_session), status=201)
+
+@require_GET
+def resumable_upload_status(request, session_id):
+    return JsonResponse(resumable.describe(owned_upload_session(request, session_id)))
+
+@require_http_methods(['PUT'])
+def upload_chunk(request, session_id, index):
+    storage = direct_upload_storage()
+    upload_session = owned_upload_session(request, session_id)
+    # Read the body directly: request.body would refuse anything over
+    # DATA_UPLOAD_MAX_MEMORY_SIZE, and a chunk is never more than CHUNK_SIZE.
+    data = request.read(resumable.CHUNK_SIZE + 1)
+    try:
+        resumable.store_chunk(storage, upload_session, index, data)
+    except ValidationError as error:
+        return JsonResponse({'error': error.messages[0]}, status=400)
+    return JsonResponse({'received': index})
+
+@require_POST
+def complete_resumable_upload(request, session_id):
+    storage = direct_upload_storage()
+    upload_session = owned_upload_session(request, session_id)
+    form = DirectUploadForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    try:
+        name = resumable.complete(storage, upload_session)
+    except ValidationError as error:
+        return JsonResponse({'error': error.messages[0]}, status=400)
+    form.instance.file = name
+    if request.user.is_authenticated:
+        form.instance.user = request.user
+    enqueue(form.save())
+    return JsonResponse({'redirect': reverse('s3:submit')})